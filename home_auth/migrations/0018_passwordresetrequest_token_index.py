@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home_auth', '0017_alter_passwordresetrequest_token'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='passwordresetrequest',
+            name='token',
+            field=models.CharField(default='8QHLUBuuYNgncSy7tn59ZOZL8EIIHUWs', editable=False, max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='passwordresetrequest',
+            index=models.Index(fields=['token'], name='password_reset_token_idx'),
+        ),
+    ]
@@ -36,7 +36,8 @@ class CustomUser(AbstractUser):
 
     @property
     def unread_notification_count(self):
-        return self.notifications.filter(is_read=False).count()
+        from school.notifications import get_unread_count
+        return get_unread_count(self)
 
     def get_full_name(self):
         return f"{self.first_name} {self.last_name}"
@@ -54,6 +55,11 @@ class PasswordResetRequest(models.Model):
 
     TOKEN_VALIDITY_PERIOD = timezone.timedelta(hours=1)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['token'], name='password_reset_token_idx'),
+        ]
+
     def is_valid(self):
         return timezone.now() <= self.created_at + self.TOKEN_VALIDITY_PERIOD
     
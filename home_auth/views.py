@@ -7,6 +7,7 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.utils.crypto import get_random_string
 from school.models import Notification
+from school.notifications import get_unread_count
 from school.models import Timetable
 from django.contrib.auth import get_user_model
 from django.views import View
@@ -73,10 +74,7 @@ def edit_profile(request):
         'user': request.user,
         'class_options': CLASS_CHOICES,
         'section_options': SECTION_CHOICES,
-        'unread_notification_count': Notification.objects.filter(
-            user=request.user, 
-            is_read=False
-        ).count()
+        'unread_notification_count': get_unread_count(request.user)
     }
     
     if request.user.is_student:
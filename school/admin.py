@@ -1,6 +1,9 @@
 # school/admin
 from django.contrib import admin
 from .models import *
+from django.contrib.admin.views.main import ChangeList
+from .mailbox import attach_recipient_preview, with_recipient_count
+from .search import matching_messages
 # Register your models here.
 
 admin.site.register(Notification)
@@ -12,15 +15,38 @@ class ExamAdmin(admin.ModelAdmin):
     search_fields = ('name', 'subject', 'student_class')
 
 
+class MessageChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        # Names for this page only, in one query
+        self.result_list = attach_recipient_preview(self.result_list)
+
+
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('subject', 'sender', 'sent_at', 'recipients_list')
     list_filter = ('sent_at', 'sender')
+    list_select_related = ('sender', 'broadcast__department')
     search_fields = ('subject', 'sender__first_name', 'sender__last_name', 'body')
     filter_horizontal = ('recipients',)
     
+    def get_search_results(self, request, queryset, search_term):
+        # Served from the full-text index rather than LIKE scans over body
+        if not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        return matching_messages(queryset, search_term), False
+
+    def get_queryset(self, request):
+        return with_recipient_count(super().get_queryset(request))
+
+    def get_changelist(self, request, **kwargs):
+        return MessageChangeList
+
     def recipients_list(self, obj):
-        return ", ".join([r.get_full_name() for r in obj.recipients.all()])
+        names = ", ".join(obj.recipient_preview)
+        if obj.more_recipients:
+            names += f" and {obj.more_recipients} more"
+        return names
     recipients_list.short_description = 'Recipients'
 
 
@@ -6,4 +6,5 @@ class SchoolConfig(AppConfig):
     name = 'school'
 
     def ready(self):
-        import school.signals
\ No newline at end of file
+        import school.checks
+        import school.signals
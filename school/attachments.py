@@ -0,0 +1,317 @@
+# school/attachments
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+from datetime import timedelta
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, http_date
+
+from .models import AttachmentBlob, AttachmentUpload, MailboxEntry, Message, MessageAttachment
+
+BLOB_DIR = 'attachment_blobs'
+STREAM_CHUNK_SIZE = 64 * 1024
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def blob_path(digest):
+    return f"{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+def _reference(digest, size, content):
+    """Take one more reference on the blob for ``digest``, storing ``content`` if it is new."""
+    if AttachmentBlob.objects.filter(sha256=digest).update(ref_count=F('ref_count') + 1):
+        return AttachmentBlob.objects.get(sha256=digest)
+    content.seek(0)
+    name = default_storage.save(blob_path(digest), File(content))
+    blob, created = AttachmentBlob.objects.get_or_create(
+        sha256=digest,
+        defaults={'file': name, 'size': size, 'ref_count': 1}
+    )
+    if not created:
+        # Lost a race with a concurrent upload of the same bytes
+        default_storage.delete(name)
+        AttachmentBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+    return blob
+
+
+def store_blob(chunks):
+    """
+    Spool ``chunks`` (an iterable of bytes) to a temporary file while hashing
+    them, then file the content under its digest. Returns the blob with a
+    reference taken for the caller.
+    """
+    digest, size = hashlib.sha256(), 0
+    with tempfile.TemporaryFile(dir=settings.FILE_UPLOAD_TEMP_DIR) as spool:
+        for chunk in chunks:
+            digest.update(chunk)
+            spool.write(chunk)
+            size += len(chunk)
+        return _reference(digest.hexdigest(), size, spool)
+
+
+def attach_files(message, files):
+    """Attach uploaded ``files`` to ``message``, sharing storage with identical uploads."""
+    for upload in files:
+        blob = store_blob(upload.chunks())
+        MessageAttachment.objects.create(message=message, blob=blob, name=os.path.basename(upload.name))
+
+
+class UploadOffsetMismatch(Exception):
+    """A chunk did not start where the upload left off; ``offset`` is where to resume."""
+
+    def __init__(self, offset):
+        super().__init__(f"expected a chunk at offset {offset}")
+        self.offset = offset
+
+
+def _upload_setting(name):
+    return getattr(settings, f'ATTACHMENT_UPLOAD_{name}')
+
+
+def _part_path(upload):
+    return os.path.join(_upload_setting('DIR'), f"{upload.pk}.part")
+
+
+def start_upload(user, filename, size, sha256='', draft=None):
+    """
+    Open a resumable upload of ``size`` bytes into ``draft``, one of ``user``'s
+    draft messages; a new draft is created when none is given.
+    """
+    if not 0 < size <= _upload_setting('MAX_SIZE'):
+        raise ValueError(f"uploads must be between 1 and {_upload_setting('MAX_SIZE')} bytes")
+    if sha256 and not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        raise ValueError("sha256 must be 64 lowercase hex digits")
+    if draft is None:
+        draft = Message.objects.create(sender=user, subject='', body='', is_draft=True)
+    return AttachmentUpload.objects.create(
+        user=user,
+        message=draft,
+        filename=os.path.basename(filename)[:255] or 'attachment',
+        size=size,
+        sha256=sha256
+    )
+
+
+def write_chunk(upload, offset, data, checksum):
+    """
+    Write one chunk at ``offset`` after checking its SHA-256 ``checksum``.
+    Offsets are claimed atomically, so a retried or duplicated chunk is
+    rejected with UploadOffsetMismatch instead of being appended twice. The
+    final chunk assembles the file; returns the upload, with ``attachment``
+    set once complete.
+    """
+    if upload.attachment_id:
+        raise UploadOffsetMismatch(upload.size)
+    if not upload.message.is_draft:
+        raise ValueError("the message has already been sent")
+    if not data or len(data) > _upload_setting('CHUNK_SIZE') or offset + len(data) > upload.size:
+        raise ValueError("chunk is empty, too large or runs past the declared size")
+    if hashlib.sha256(data).hexdigest() != checksum.lower():
+        raise ValueError("chunk checksum mismatch")
+
+    end = offset + len(data)
+    with transaction.atomic():
+        if not AttachmentUpload.objects.filter(pk=upload.pk, received=offset).update(received=end):
+            raise UploadOffsetMismatch(AttachmentUpload.objects.get(pk=upload.pk).received)
+        path = _part_path(upload)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as part:
+            part.seek(offset)
+            part.write(data)
+    upload.received = end
+    if end == upload.size:
+        _assemble(upload)
+    return upload
+
+
+def _read_part(path):
+    with open(path, 'rb') as part:
+        while chunk := part.read(STREAM_CHUNK_SIZE):
+            yield chunk
+
+
+def _assemble(upload):
+    path = _part_path(upload)
+    blob = store_blob(_read_part(path))
+    if upload.sha256 and blob.sha256 != upload.sha256:
+        # Start over rather than attach corrupted bytes
+        release_blob(blob.pk)
+        AttachmentUpload.objects.filter(pk=upload.pk).update(received=0)
+        upload.received = 0
+        os.remove(path)
+        raise ValueError("assembled file does not match the declared sha256; upload restarted")
+    upload.attachment = MessageAttachment.objects.create(message=upload.message, blob=blob, name=upload.filename)
+    upload.save(update_fields=['attachment', 'updated_at'])
+    os.remove(path)
+
+
+def expire_uploads(now=None):
+    """
+    Remove uploads left unfinished past ATTACHMENT_UPLOAD_EXPIRY_HOURS and
+    drafts with no upload activity since then. Returns the number of uploads
+    removed.
+    """
+    cutoff = (now or timezone.now()) - timedelta(hours=_upload_setting('EXPIRY_HOURS'))
+    stale = list(AttachmentUpload.objects.filter(attachment__isnull=True, updated_at__lt=cutoff))
+    for upload in stale:
+        if os.path.exists(_part_path(upload)):
+            os.remove(_part_path(upload))
+    AttachmentUpload.objects.filter(pk__in=[upload.pk for upload in stale]).delete()
+    # Attachments of abandoned drafts release their blobs as they are deleted
+    Message.objects.filter(is_draft=True, sent_at__lt=cutoff).exclude(uploads__updated_at__gte=cutoff).delete()
+    return len(stale)
+
+
+def release_blob(blob_id):
+    """Drop one reference; the blob is collected once the transaction commits if none remain."""
+    AttachmentBlob.objects.filter(pk=blob_id, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+    transaction.on_commit(lambda: collect_blob(blob_id))
+
+
+def collect_blob(blob_id):
+    blob = AttachmentBlob.objects.filter(pk=blob_id, ref_count=0).first()
+    if blob is None:
+        return False
+    # Re-check in the DELETE itself so a reference taken meanwhile wins
+    deleted, _ = AttachmentBlob.objects.filter(pk=blob_id, ref_count=0).delete()
+    if deleted:
+        blob.file.delete(save=False)
+    return bool(deleted)
+
+
+def collect_blobs(batch_size=500):
+    """
+    Recount references from the attachment rows, then delete every blob that
+    nothing uses. Returns ``(recounted, collected)``.
+    """
+    references = (
+        MessageAttachment.objects.filter(blob=OuterRef('pk'))
+        .values('blob')
+        .annotate(total=Count('pk'))
+        .values('total')
+    )
+    recounted = (
+        AttachmentBlob.objects.annotate(actual=Coalesce(Subquery(references), 0))
+        .exclude(ref_count=F('actual'))
+        .update(ref_count=Coalesce(Subquery(references), 0))
+    )
+    collected = 0
+    while True:
+        ids = list(AttachmentBlob.objects.filter(ref_count=0).values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return recounted, collected
+        collected += sum(collect_blob(blob_id) for blob_id in ids)
+
+
+def can_download(user, attachment):
+    """Admins, the message's sender and anyone with its conversation in their mailbox."""
+    # Drafts belong to no thread yet, so only their sender reaches them
+    if user.is_admin or attachment.message.sender_id == user.pk:
+        return True
+    return MailboxEntry.objects.filter(user=user, message_id=attachment.message.thread_root_id).exists()
+
+
+def parse_byte_range(header, size):
+    """
+    The inclusive ``(start, end)`` span asked for by a single-range ``Range``
+    header. Returns None when the whole file should be sent (no header, a
+    malformed one or a multi-range request); raises ValueError when the range
+    lies outside the file.
+    """
+    match = _RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError("empty suffix range")
+        return max(size - suffix, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        raise ValueError("range starts past the end of the file")
+    return start, min(end, size - 1)
+
+
+def _read_span(content, length):
+    try:
+        while length > 0:
+            chunk = content.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        content.close()
+
+
+def _stream_blob(request, blob, etag, content_type):
+    if request.headers.get('If-Range', etag) != etag:
+        byte_range = None
+    else:
+        try:
+            byte_range = parse_byte_range(request.headers.get('Range'), blob.size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f"bytes */{blob.size}"
+            return response
+
+    content = default_storage.open(blob.file.name, 'rb')
+    if byte_range is None:
+        response = FileResponse(content, content_type=content_type)
+    else:
+        start, end = byte_range
+        content.seek(start)
+        response = StreamingHttpResponse(_read_span(content, end - start + 1), status=206, content_type=content_type)
+        response['Content-Range'] = f"bytes {start}-{end}/{blob.size}"
+        response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def attachment_response(request, attachment, as_attachment=False):
+    """
+    Serve ``attachment``'s bytes. With ATTACHMENT_SENDFILE_HEADER set the
+    transfer is handed to the front server; otherwise Django streams the file,
+    honouring Range and conditional requests. The blob digest is the ETag.
+    """
+    blob = attachment.blob
+    etag = f'"{blob.sha256}"'
+    last_modified = int(blob.created_at.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = mimetypes.guess_type(attachment.name)[0] or 'application/octet-stream'
+        header = getattr(settings, 'ATTACHMENT_SENDFILE_HEADER', None)
+        if header == 'X-Sendfile':
+            response = HttpResponse(content_type=content_type)
+            response[header] = blob.file.path
+        elif header:
+            prefix = getattr(settings, 'ATTACHMENT_SENDFILE_PREFIX', '/protected-media/')
+            response = HttpResponse(content_type=content_type)
+            response[header] = prefix.rstrip('/') + '/' + quote(blob.file.name)
+        else:
+            response = _stream_blob(request, blob, etag, content_type)
+        if response.status_code == 416:
+            return response
+        response['Content-Disposition'] = content_disposition_header(as_attachment, attachment.name)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, max_age=3600)
+    return response
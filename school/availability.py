@@ -0,0 +1,235 @@
+# school/availability
+import time as clock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from .models import Timetable
+
+# Bump when the cached layout changes so maps of the old shape are ignored
+AVAILABILITY_FORMAT = 2
+AVAILABILITY_CACHE_PREFIX = 'timetable-availability'
+# Seconds before a lock left by a crashed worker is given up
+AVAILABILITY_LOCK_TIMEOUT = 5
+
+
+def minute_mask(start_time, end_time):
+    """Bit ``n`` set for each minute ``n`` of the day that ``[start_time, end_time)`` touches."""
+    start = start_time.hour * 60 + start_time.minute
+    end = end_time.hour * 60 + end_time.minute + bool(end_time.second or end_time.microsecond)
+    return ((1 << max(end - start, 0)) - 1) << start
+
+
+def room_key(name):
+    return (name or '').strip().casefold()
+
+
+def _owners(teacher_id, room):
+    return (('teachers', teacher_id), ('rooms', room)) if room else (('teachers', teacher_id),)
+
+
+def _union(masks):
+    bits = 0
+    for mask in masks:
+        bits |= mask
+    return bits
+
+
+def _add(availability, pk, teacher_id, classroom, start_time, end_time):
+    mask, room = minute_mask(start_time, end_time), room_key(classroom)
+    availability['entries'][pk] = (teacher_id, room, mask)
+    for kind, owner in _owners(teacher_id, room):
+        availability['bookings'][kind].setdefault(owner, {})[pk] = mask
+        availability[kind][owner] = availability[kind].get(owner, 0) | mask
+
+
+def _remove(availability, pk):
+    if pk not in availability['entries']:
+        return
+    teacher_id, room, _ = availability['entries'].pop(pk)
+    for kind, owner in _owners(teacher_id, room):
+        bookings = availability['bookings'][kind][owner]
+        del bookings[pk]
+        if bookings:
+            # Only this owner's bookings, as the removed one may overlap them
+            availability[kind][owner] = _union(bookings.values())
+        else:
+            del availability['bookings'][kind][owner], availability[kind][owner]
+
+
+def build_day(entries):
+    """
+    A day's bookings as bitsets: ``teachers`` and ``rooms`` map each teacher
+    id and room key to the minutes they are booked, ``bookings`` keeps each
+    owner's entries and their masks, and ``entries`` each entry's owners, so
+    one entry can be moved or left out by touching its owners alone.
+    """
+    availability = {'teachers': {}, 'rooms': {}, 'bookings': {'teachers': {}, 'rooms': {}}, 'entries': {}}
+    for entry in entries:
+        _add(availability, *entry)
+    return availability
+
+
+def _add_room(rooms, pk, classroom):
+    room = room_key(classroom)
+    if not room:
+        return
+    rooms['entries'][pk] = room
+    spellings = rooms['spellings'].setdefault(room, {})
+    spellings[pk] = classroom.strip()
+    rooms['names'][room] = spellings[min(spellings)]
+
+
+def _remove_room(rooms, pk):
+    room = rooms['entries'].pop(pk, None)
+    if room is None:
+        return
+    spellings = rooms['spellings'][room]
+    del spellings[pk]
+    if spellings:
+        rooms['names'][room] = spellings[min(spellings)]
+    else:
+        del rooms['spellings'][room], rooms['names'][room]
+
+
+def _timeout():
+    # Maps are replaced under a new version on every edit, which needs the
+    # default cache to be shared between workers (school.checks.check_shared_cache)
+    return getattr(settings, 'TIMETABLE_GRID_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+def _version_key(scope):
+    return f"{AVAILABILITY_CACHE_PREFIX}:version:{scope}"
+
+
+def _key(scope, version):
+    return f"{AVAILABILITY_CACHE_PREFIX}:{AVAILABILITY_FORMAT}:{scope}:{version}"
+
+
+def _version(scope):
+    # As timetables.cache_version: a lost counter restarts from the clock
+    version = cache.get(_version_key(scope))
+    if version is None:
+        cache.add(_version_key(scope), clock.time_ns(), None)
+        version = cache.get(_version_key(scope), 0)
+    return version
+
+
+def _cached(scope, build):
+    key = _key(scope, _version(scope))
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, _timeout())
+    return value
+
+
+def _update(scope, change=None):
+    """
+    Publish the cached map of ``scope`` with ``change`` applied under the next
+    version; without a change, or with nothing cached, the next reader rebuilds
+    it. Updates of a scope take turns on a lock, so no worker's change is lost
+    to another's. A reader that rebuilt from older rows stores them under the
+    version it read, which no one asks for any more.
+    """
+    lock = f"{AVAILABILITY_CACHE_PREFIX}:lock:{scope}"
+    while not cache.add(lock, True, AVAILABILITY_LOCK_TIMEOUT):
+        clock.sleep(0.005)
+    try:
+        version = _version(scope)
+        value = cache.get(_key(scope, version)) if change else None
+        if value is not None:
+            change(value)
+            cache.set(_key(scope, version + 1), value, _timeout())
+        cache.set(_version_key(scope), version + 1, None)
+    finally:
+        cache.delete(lock)
+
+
+def day_availability(day):
+    """The cached bitsets of ``day``, kept up to date by record_entry."""
+    return _cached(
+        f"day:{day}",
+        lambda: build_day(
+            Timetable.objects.filter(day=day).values_list('pk', 'teacher_id', 'classroom', 'start_time', 'end_time')
+        ),
+    )
+
+
+def room_names():
+    """Every classroom the timetable uses, by room key, as first spelled."""
+    def build():
+        rooms = {'names': {}, 'spellings': {}, 'entries': {}}
+        for pk, classroom in Timetable.objects.exclude(classroom='').exclude(classroom__isnull=True).values_list(
+            'pk', 'classroom'
+        ):
+            _add_room(rooms, pk, classroom)
+        return rooms
+
+    return _cached('rooms', build)['names']
+
+
+def record_entry(pk, previous_day=None, entry=None):
+    """
+    Move entry ``pk`` in the cached maps once its change is committed: out of
+    ``previous_day`` (None for a new entry) and into ``entry``, its ``(day,
+    teacher_id, classroom, start_time, end_time)``, or nowhere once deleted.
+    Only the owners it is booked for are recomputed, whatever the day's size.
+    """
+    day = entry[0] if entry else None
+    for scope_day in {previous_day, day} - {None}:
+        def change(availability, scope_day=scope_day):
+            _remove(availability, pk)
+            if scope_day == day:
+                _add(availability, pk, *entry[1:])
+
+        _update(f"day:{scope_day}", change)
+
+    def change_rooms(rooms):
+        _remove_room(rooms, pk)
+        if entry:
+            _add_room(rooms, pk, entry[2])
+
+    _update('rooms', change_rooms)
+
+
+def forget_days(days):
+    """Have the maps of ``days`` rebuilt, after changes that sent no signals (bulk_create)."""
+    for day in days:
+        _update(f"day:{day}")
+    _update('rooms')
+
+
+def _busy(availability, kind, mask, ignore=None):
+    """Owners (teacher ids or room keys) booked at any minute of ``mask``, leaving out entry ``ignore``."""
+    busy = {owner for owner, bits in availability[kind].items() if bits & mask}
+    if ignore in availability['entries']:
+        teacher_id, room, _ = availability['entries'][ignore]
+        owner = teacher_id if kind == 'teachers' else room
+        # Just this owner's other bookings, as the ignored entry may overlap them
+        others = availability['bookings'][kind].get(owner, {})
+        if not _union(bits for pk, bits in others.items() if pk != ignore) & mask:
+            busy.discard(owner)
+    return busy
+
+
+def busy_teacher_ids(day, start_time, end_time, ignore=None):
+    """Ids of the teachers booked at any point of the window; ``ignore`` is an entry id to leave out."""
+    return _busy(day_availability(day), 'teachers', minute_mask(start_time, end_time), ignore)
+
+
+def free_teachers(day, start_time, end_time, department=None, ignore=None):
+    """Teachers, optionally of one department, with nothing booked in the window."""
+    teachers = get_user_model().objects.filter(is_teacher=True, is_active=True)
+    if department is not None:
+        teachers = teachers.filter(department=department)
+    return teachers.exclude(pk__in=busy_teacher_ids(day, start_time, end_time, ignore)).order_by(
+        'first_name', 'last_name', 'pk'
+    )
+
+
+def free_rooms(day, start_time, end_time, ignore=None):
+    """Names of the known classrooms with nothing booked in the window, sorted."""
+    busy = _busy(day_availability(day), 'rooms', minute_mask(start_time, end_time), ignore)
+    return sorted((name for room, name in room_names().items() if room not in busy), key=str.casefold)
@@ -0,0 +1,24 @@
+# school/checks
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',)
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Cached timetable grids and availability maps are invalidated by bumping a
+    version in the cache, which other worker processes never see in a
+    per-process cache; they would serve edited timetables for up to
+    TIMETABLE_GRID_CACHE_TIMEOUT.
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    message = f"The default cache ({backend}) is not shared between worker processes."
+    hint = "Use the database cache, Redis or Memcached for CACHES['default']."
+    if settings.DEBUG:
+        # The development server runs a single process
+        return [Warning(message, hint=hint, id='school.W001')]
+    return [Error(message, hint=hint, id='school.E001')]
@@ -0,0 +1,274 @@
+# school/conflicts
+import random
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import time
+
+from django.db.models import Q
+
+from .models import Timetable
+
+
+@dataclass(frozen=True)
+class Slot:
+    """
+    One timetable period, either saved (``pk`` set) or proposed. ``ref`` is
+    how a caller identifies a proposed slot again, e.g. its row in an import.
+    """
+    day: str
+    start_time: time
+    end_time: time
+    student_class: str
+    section: str
+    teacher_id: int | None = None
+    classroom: str = ''
+    subject: str = ''
+    pk: int | None = None
+    ref: object = None
+
+    @classmethod
+    def from_entry(cls, entry, **extra):
+        return cls(
+            day=entry.day,
+            start_time=entry.start_time,
+            end_time=entry.end_time,
+            student_class=entry.student_class,
+            section=entry.section,
+            teacher_id=entry.teacher_id,
+            classroom=entry.classroom or '',
+            subject=str(entry.subject) if entry.subject_id else '',
+            pk=entry.pk,
+            **extra
+        )
+
+    def keys(self):
+        """The (kind, key) pairs whose periods this slot must not overlap."""
+        keys = [('class', (self.day, self.student_class, self.section))]
+        if self.teacher_id is not None:
+            keys.append(('teacher', (self.day, self.teacher_id)))
+        if self.classroom.strip():
+            keys.append(('classroom', (self.day, self.classroom.strip().casefold())))
+        return keys
+
+    def describe(self):
+        what = self.subject or 'A period'
+        return (f"{what} for {self.student_class} {self.section} on {self.day} "
+                f"{self.start_time:%H:%M}-{self.end_time:%H:%M}")
+
+
+@dataclass(frozen=True)
+class Conflict:
+    kind: str
+    slot: Slot
+    other: Slot
+
+    def message(self):
+        if self.kind == 'class':
+            return f"{self.slot.student_class} {self.slot.section} already has {self.other.describe()}"
+        if self.kind == 'teacher':
+            return f"The teacher is already booked for {self.other.describe()}"
+        return f"Room {self.other.classroom} is already booked for {self.other.describe()}"
+
+
+class _Node:
+    __slots__ = ('start', 'end', 'order', 'slot', 'priority', 'reach', 'left', 'right')
+
+    def __init__(self, slot, order):
+        self.start, self.end, self.order, self.slot = slot.start_time, slot.end_time, order, slot
+        self.priority = random.random()
+        self.reach = slot.end_time
+        self.left = self.right = None
+
+    def key(self):
+        return (self.start, self.end, self.order)
+
+    def update(self):
+        self.reach = max(
+            self.end,
+            self.left.reach if self.left else time.min,
+            self.right.reach if self.right else time.min
+        )
+
+
+class _Intervals:
+    """
+    Periods of one key in an interval tree: a treap ordered by start time,
+    each node carrying the latest end time below it. Subtrees that end
+    before the window or start after it are skipped, so an insert takes
+    O(log n) and a lookup O(log n + matches) expected time however long or
+    overlapping the periods are.
+    """
+
+    def __init__(self):
+        self.root = None
+        self._count = 0
+
+    def add(self, slot):
+        self._count += 1
+        self.root = self._insert(self.root, _Node(slot, self._count))
+
+    def _insert(self, node, new):
+        if node is None:
+            return new
+        if new.key() < node.key():
+            node.left = self._insert(node.left, new)
+            if node.left.priority > node.priority:
+                node = self._rotate_right(node)
+        else:
+            node.right = self._insert(node.right, new)
+            if node.right.priority > node.priority:
+                node = self._rotate_left(node)
+        node.update()
+        return node
+
+    @staticmethod
+    def _rotate_right(node):
+        child = node.left
+        node.left, child.right = child.right, node
+        node.update()
+        child.update()
+        return child
+
+    @staticmethod
+    def _rotate_left(node):
+        child = node.right
+        node.right, child.left = child.left, node
+        node.update()
+        child.update()
+        return child
+
+    def overlapping(self, start, end):
+        """Periods overlapping ``[start, end)``, by start time."""
+        found, stack, node = [], [], self.root
+        # In-order walk that only descends where something can still overlap
+        while stack or node is not None:
+            if node is not None and node.reach > start:
+                stack.append(node)
+                node = node.left
+                continue
+            if not stack:
+                break
+            node = stack.pop()
+            if node.start >= end:
+                # It and everything to its right start too late
+                break
+            if node.end > start:
+                found.append(node.slot)
+            node = node.right
+        return found
+
+
+class ConflictIndex:
+    """Sorted interval indexes per (day, class-section), (day, teacher) and (day, classroom)."""
+
+    def __init__(self, slots=()):
+        self._intervals = defaultdict(_Intervals)
+        for slot in slots:
+            self.add(slot)
+
+    def add(self, slot):
+        for key in slot.keys():
+            self._intervals[key].add(slot)
+
+    def overlapping(self, kind, key, start, end):
+        """Periods indexed under ``(kind, key)`` that overlap ``[start, end)``."""
+        intervals = self._intervals.get((kind, key))
+        return intervals.overlapping(start, end) if intervals else []
+
+    def conflicts(self, slot):
+        """Every indexed period ``slot`` would clash with, other than itself."""
+        found = []
+        for kind, key in slot.keys():
+            for other in self.overlapping(kind, key, slot.start_time, slot.end_time):
+                same_row = slot.pk is not None and other.pk == slot.pk
+                if other is not slot and not same_row:
+                    found.append(Conflict(kind, slot, other))
+        return found
+
+
+def _saved_slots(entries):
+    return [Slot.from_entry(entry) for entry in entries.select_related('subject')]
+
+
+# Past this many slots, load whole days rather than OR-ing a filter per slot
+RELATED_QUERY_LIMIT = 50
+
+
+def _related_entries(slots):
+    """Saved entries sharing a day with any of ``slots`` and a class, teacher or room."""
+    if len(slots) > RELATED_QUERY_LIMIT:
+        return Timetable.objects.filter(day__in={slot.day for slot in slots})
+    query = Q()
+    for slot in slots:
+        same = Q(student_class=slot.student_class, section=slot.section)
+        if slot.teacher_id is not None:
+            same |= Q(teacher_id=slot.teacher_id)
+        if slot.classroom.strip():
+            same |= Q(classroom__iexact=slot.classroom.strip())
+        query |= Q(day=slot.day) & same
+    return Timetable.objects.filter(query) if query else Timetable.objects.none()
+
+
+def slot_conflicts(slot):
+    """Clashes between ``slot`` and the saved timetable; used to validate a single entry."""
+    return ConflictIndex(_saved_slots(_related_entries([slot]))).conflicts(slot)
+
+
+def validate_slots(slots, replacing=None):
+    """
+    Check a batch of proposed slots against the saved timetable and each
+    other. ``replacing`` is a queryset of saved entries the batch supersedes
+    (e.g. the class's current week), which are left out. Returns the
+    conflicts in the order of ``slots``.
+    """
+    slots = list(slots)
+    if not slots:
+        return []
+    saved = _related_entries(slots)
+    if replacing is not None:
+        saved = saved.exclude(pk__in=replacing.values('pk'))
+    index = ConflictIndex(_saved_slots(saved))
+    conflicts = []
+    for slot in slots:
+        if slot.end_time <= slot.start_time:
+            continue
+        conflicts.extend(index.conflicts(slot))
+        index.add(slot)
+    return conflicts
+
+
+def parse_slot(data, ref=None, **defaults):
+    """
+    A Slot from a mapping of strings, e.g. one entry of a proposed week or
+    one import row, with ``defaults`` filling blank fields. Raises ValueError
+    naming the first bad field.
+    """
+    values = {**defaults, **{name: value for name, value in data.items() if value not in (None, '')}}
+    if values.get('day') not in dict(Timetable.CLASS_DAYS):
+        raise ValueError(f"day must be one of {', '.join(dict(Timetable.CLASS_DAYS))}")
+    times = {}
+    for name in ('start_time', 'end_time'):
+        try:
+            times[name] = time.fromisoformat(str(values[name]))
+        except (KeyError, ValueError):
+            raise ValueError(f"{name} must be a time such as 09:30")
+    if times['end_time'] <= times['start_time']:
+        raise ValueError("end_time must be after start_time")
+    for name in ('student_class', 'section'):
+        if not values.get(name):
+            raise ValueError(f"{name} is required")
+    teacher_id = values.get('teacher_id')
+    try:
+        teacher_id = int(teacher_id) if teacher_id is not None else None
+    except (TypeError, ValueError):
+        raise ValueError("teacher_id must be a user id")
+    return Slot(
+        day=values['day'],
+        student_class=str(values['student_class']),
+        section=str(values['section']),
+        teacher_id=teacher_id,
+        classroom=str(values.get('classroom', '')),
+        subject=str(values.get('subject', '')),
+        ref=ref,
+        **times
+    )
@@ -1,13 +1,13 @@
 # school/context_processors
-from django.contrib.auth import get_user_model
-from .models import Notification
+from .notifications import get_state, unread_notifications_for
 
 def notifications(request):
     context = {}
     if request.user.is_authenticated:
         user = request.user
+        state = get_state(user)
         context.update({
-            'unread_notifications': user.notifications.filter(is_read=False).order_by('-created_at')[:5],
-            'unread_notification_count': user.notifications.filter(is_read=False).count()
+            'unread_notifications': unread_notifications_for(user, state)[:5] if state.unread_count else [],
+            'unread_notification_count': state.unread_count
         })
-    return context
\ No newline at end of file
+    return context
@@ -0,0 +1,64 @@
+# school/events
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class LocalBroker:
+    """
+    In-process pub/sub keyed by user id. Subscribers are asyncio queues that
+    live on the event loop serving the stream; publishers may run on any
+    thread, so delivery is handed to the loop thread-safely.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, user_id):
+        queue = asyncio.Queue(maxsize=1)
+        subscription = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            self._subscribers[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def publish(self, user_ids):
+        with self._lock:
+            targets = [sub for user_id in user_ids for sub in self._subscribers.get(user_id, ())]
+        for loop, queue in targets:
+            try:
+                loop.call_soon_threadsafe(_notify, queue)
+            except RuntimeError:
+                # Loop already closed; the stream's cleanup will drop it
+                pass
+
+
+def _notify(queue):
+    # A pending wake-up already covers this change
+    if not queue.full():
+        queue.put_nowait(True)
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = import_string(getattr(settings, 'NOTIFICATION_BROKER', 'school.events.LocalBroker'))()
+    return _broker
+
+
+def publish(user_ids):
+    get_broker().publish(list(user_ids))
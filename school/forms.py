@@ -1,11 +1,14 @@
 # school/forms
 from django import forms
+from django_select2.forms import ModelSelect2MultipleWidget, ModelSelect2Widget
 from .models import Exam, Timetable
 from django.core.exceptions import ValidationError
 from .models import CustomUser
 from django.contrib.auth import get_user_model
 from .models import Department
-from .models import Message, Holiday, MessageAttachment, Subject
+from .availability import free_rooms, free_teachers
+from .conflicts import Slot, slot_conflicts
+from .models import Broadcast, Message, Holiday, MessageAttachment, Subject
 
 User = get_user_model()
 
@@ -37,7 +40,7 @@ class TimetableForm(forms.ModelForm):
     
     class Meta:
         model = Timetable
-        fields = ['day', 'start_time', 'end_time', 'subject', 'student_class', 'section', 'classroom', 'color']
+        fields = ['day', 'start_time', 'end_time', 'subject', 'teacher', 'student_class', 'section', 'classroom', 'color']
         widgets = {
             'day': forms.Select(attrs={'class': 'form-control'}),
             'start_time': forms.TimeInput(attrs={'type': 'time', 'class': 'form-control'}),
@@ -45,7 +48,7 @@ class TimetableForm(forms.ModelForm):
             'subject': forms.Select(attrs={'class': 'form-control'}),
             'student_class': forms.Select(attrs={'class': 'form-control'}),
             'section': forms.Select(attrs={'class': 'form-control'}),
-            'classroom': forms.TextInput(attrs={'class': 'form-control'}),
+            'classroom': forms.TextInput(attrs={'class': 'form-control', 'list': 'free-rooms', 'autocomplete': 'off'}),
             'color': forms.HiddenInput(),
         }
 
@@ -55,6 +58,54 @@ class TimetableForm(forms.ModelForm):
         
         if request and request.user.is_teacher:
             self.fields['subject'].queryset = Subject.objects.filter(teachers=request.user)
+            # Known before validation, so the teacher's bookings are checked too
+            if self.instance.teacher_id is None:
+                self.instance.teacher = request.user
+            del self.fields['teacher']
+        else:
+            self.fields['teacher'].widget = UserSelect2Widget(
+                attrs={'class': 'form-control', 'data-placeholder': 'Search teachers', 'data-width': '100%'}
+            )
+            self.fields['teacher'].queryset = CustomUser.objects.filter(is_teacher=True)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start_time, end_time = cleaned_data.get('start_time'), cleaned_data.get('end_time')
+        if start_time and end_time and end_time <= start_time:
+            self.add_error('end_time', 'End time must be after the start time.')
+            return cleaned_data
+        if self.errors:
+            return cleaned_data
+
+        teacher = cleaned_data['teacher'] if 'teacher' in self.fields else self.instance.teacher
+        day = cleaned_data['day']
+        slot = Slot(
+            day=day,
+            start_time=start_time,
+            end_time=end_time,
+            student_class=cleaned_data['student_class'],
+            section=cleaned_data['section'],
+            teacher_id=teacher.pk,
+            classroom=cleaned_data.get('classroom') or '',
+            pk=self.instance.pk
+        )
+        conflicts = slot_conflicts(slot)
+        if not conflicts:
+            return cleaned_data
+
+        errors = [conflict.message() for conflict in conflicts]
+        kinds = {conflict.kind for conflict in conflicts}
+        if 'teacher' in kinds and 'teacher' in self.fields:
+            substitutes = free_teachers(
+                day, start_time, end_time, department=cleaned_data['subject'].department_id, ignore=self.instance.pk
+            )[:5]
+            if substitutes:
+                errors.append("Teachers free then: " + ", ".join(user.get_full_name() or user.username for user in substitutes))
+        if 'classroom' in kinds:
+            rooms = free_rooms(day, start_time, end_time, ignore=self.instance.pk)[:5]
+            if rooms:
+                errors.append("Rooms free then: " + ", ".join(rooms))
+        raise ValidationError(errors)
 
 class ExamForm(forms.ModelForm):
     class Meta:
@@ -89,12 +140,69 @@ class MultipleFileField(forms.FileField):
             result = single_file_clean(data, initial)
         return result
 
+
+class UserSelect2Mixin:
+    """
+    Users are searched over AJAX from the user_autocomplete endpoint, by name,
+    username or email prefix, so only the selected users are rendered.
+    """
+    search_fields = [
+        'first_name__istartswith',
+        'last_name__istartswith',
+        'username__istartswith',
+        'email__istartswith',
+    ]
+    max_results = 20
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('data_view', 'user_autocomplete')
+        super().__init__(*args, **kwargs)
+
+    def label_from_instance(self, user):
+        return f"{user.get_full_name() or user.username} <{user.email}>"
+
+    def optgroups(self, name, value, attrs=None):
+        # An invalid bound form is re-rendered with the submitted value; only
+        # look up ids, so a tampered query string cannot break the pk filter
+        value = [item for item in value if str(item).isdigit()]
+        return super().optgroups(name, value, attrs)
+
+
+class UserSelect2Widget(UserSelect2Mixin, ModelSelect2Widget):
+    pass
+
+
+class UserSelect2MultipleWidget(UserSelect2Mixin, ModelSelect2MultipleWidget):
+    pass
+
+
 class MessageForm(forms.ModelForm):
     attachments = MultipleFileField(required=False)
     recipients = forms.ModelMultipleChoiceField(
         queryset=User.objects.all(),
-        widget=forms.SelectMultiple(attrs={'class': 'select2'}),
-        required=True
+        widget=UserSelect2MultipleWidget(attrs={'data-placeholder': 'Search by name or email', 'data-width': '100%'}),
+        required=False
+    )
+    # Broadcast fields; dropped unless the form is built with can_broadcast=True
+    audience = forms.ChoiceField(
+        choices=[('', 'Selected recipients')] + list(Broadcast.AUDIENCES),
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    audience_class = forms.ChoiceField(
+        choices=[('', '---------')] + CLASS_CHOICES,
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    audience_section = forms.ChoiceField(
+        choices=[('', 'All sections')] + SECTION_CHOICES,
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    audience_department = forms.ModelChoiceField(
+        queryset=Department.objects.all(),
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-control'})
     )
 
     class Meta:
@@ -116,6 +224,7 @@ class MessageForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         # Remove 'user' from kwargs if it exists
         self.user = kwargs.pop('user', None)
+        can_broadcast = kwargs.pop('can_broadcast', False)
         super().__init__(*args, **kwargs)
         
         # If we have a user, we can customize the form
@@ -123,6 +232,45 @@ class MessageForm(forms.ModelForm):
             # Example: Exclude current user from recipients
             self.fields['recipients'].queryset = User.objects.exclude(id=self.user.id)
 
+        if not can_broadcast:
+            for name in ('audience', 'audience_class', 'audience_section', 'audience_department'):
+                del self.fields[name]
+
+    def clean(self):
+        cleaned_data = super().clean()
+        audience = cleaned_data.get('audience')
+        if audience == 'class_section' and not cleaned_data.get('audience_class'):
+            self.add_error('audience_class', 'Choose the class to broadcast to.')
+        elif audience == 'department' and not cleaned_data.get('audience_department'):
+            self.add_error('audience_department', 'Choose the department to broadcast to.')
+        elif not audience and not cleaned_data.get('recipients'):
+            self.add_error('recipients', 'Choose at least one recipient.')
+        return cleaned_data
+
+    def broadcast(self, message):
+        """An unsaved Broadcast for ``message``, or None when sending to chosen recipients."""
+        audience = self.cleaned_data.get('audience')
+        if not audience:
+            return None
+        return Broadcast(
+            message=message,
+            audience=audience,
+            student_class=self.cleaned_data.get('audience_class', '') if audience == 'class_section' else '',
+            section=self.cleaned_data.get('audience_section', '') if audience == 'class_section' else '',
+            department=self.cleaned_data.get('audience_department') if audience == 'department' else None
+        )
+
+
+class AdminMessageFilterForm(forms.Form):
+    sender = forms.ModelChoiceField(
+        queryset=User.objects.all(),
+        required=False,
+        widget=UserSelect2Widget(attrs={'data-placeholder': 'Any sender', 'data-width': '100%'})
+    )
+    date_from = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control'}))
+    date_to = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control'}))
+    subject = forms.CharField(required=False, widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Subject contains'}))
+
 
 class DepartmentForm(forms.ModelForm):
     class Meta:
@@ -130,7 +278,7 @@ class DepartmentForm(forms.ModelForm):
         fields = ['name', 'code', 'description', 'head']
         widgets = {
             'description': forms.Textarea(attrs={'rows': 3}),
-            'head': forms.Select(attrs={'class': 'form-control select2'}),
+            'head': UserSelect2Widget(attrs={'class': 'form-control', 'data-placeholder': 'Search teachers', 'data-width': '100%'}),
         }
 
     def __int__(self, *args, **kwargs):
@@ -158,7 +306,7 @@ class SubjectForm(forms.ModelForm):
         fields = ['name', 'code', 'description', 'department', 'teachers', 'student_class', 'section']
         widgets = {
             'description': forms.Textarea(attrs={'rows': 3}),
-            'teachers': forms.SelectMultiple(attrs={'class': 'select2'}),
+            'teachers': UserSelect2MultipleWidget(attrs={'data-placeholder': 'Search teachers', 'data-width': '100%'}),
             'department': forms.Select(attrs={'class': 'form-control'})
         }
     
@@ -0,0 +1,335 @@
+# school/mailbox
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest, RowNumber
+from django.db.models.expressions import Window
+from django.utils import timezone
+
+from .models import Broadcast, MailboxEntry, Message, ThreadSummary
+from student.models import Parent
+
+MAILBOX_PAGE_SIZE = 10
+THREAD_PAGE_SIZE = 20
+BROADCAST_BATCH_SIZE = 500
+ADMIN_PAGE_SIZE = 25
+RECIPIENT_PREVIEW_SIZE = 3
+MAILBOX_FOLDERS = ('all', 'inbox', 'sent', 'archived')
+
+
+def thread_root(message):
+    if message.thread_root_id in (None, message.pk):
+        return message
+    return message.thread_root
+
+
+def thread_messages(message):
+    """Every message in ``message``'s conversation, replies nested under what they answer."""
+    return (
+        Message.objects.filter(thread_root_id=message.thread_root_id)
+        .select_related('sender')
+        .prefetch_related('recipients', 'attachments__blob')
+        .order_by('path')
+    )
+
+
+def thread_page(message, page=None, per_page=THREAD_PAGE_SIZE):
+    """
+    One window of the conversation; without ``page`` the latest one. Loads in
+    a fixed number of queries however long the thread is.
+    """
+    paginator = Paginator(thread_messages(message), per_page)
+    return paginator.get_page(page or paginator.num_pages)
+
+
+def _recipient_names(users):
+    names = ', '.join(user.get_full_name() or user.username for user in users)
+    limit = MailboxEntry._meta.get_field('recipient_names').max_length
+    return names if len(names) <= limit else names[:limit - 3] + '...'
+
+
+def _denormalized(message):
+    broadcast = Broadcast.objects.filter(message=message).select_related('department').first()
+    return {
+        'sender_id': message.sender_id,
+        'subject': message.subject,
+        'recipient_names': broadcast.label() if broadcast else _recipient_names(message.recipients.all()),
+        'has_attachments': message.attachments.exists(),
+        'sent_at': message.sent_at,
+        'last_activity_at': ThreadSummary.objects.filter(root=message).values_list(
+            'last_activity_at', flat=True
+        ).first() or message.sent_at,
+    }
+
+
+def record_thread_activity(message):
+    """Fold a newly saved ``message`` into its thread summary and the participants' entries."""
+    if message.thread_root_id == message.pk:
+        ThreadSummary.objects.create(
+            root=message,
+            last_activity_at=message.sent_at,
+            last_sender_id=message.sender_id,
+            participant_count=1
+        )
+        return
+    ThreadSummary.objects.filter(root_id=message.thread_root_id).update(
+        reply_count=F('reply_count') + 1,
+        last_activity_at=Greatest('last_activity_at', Value(message.sent_at)),
+        last_sender_id=message.sender_id
+    )
+    MailboxEntry.objects.filter(
+        message_id=message.thread_root_id,
+        last_activity_at__lt=message.sent_at
+    ).update(last_activity_at=message.sent_at)
+
+
+def _participants(root_id):
+    senders = Message.objects.filter(thread_root_id=root_id).values('sender_id')
+    recipients = Message.recipients.through.objects.filter(message__thread_root_id=root_id).values(
+        Message.recipients.field.m2m_reverse_field_name()
+    )
+    return get_user_model().objects.filter(Q(pk__in=senders) | Q(pk__in=recipients))
+
+
+def refresh_participant_count(root_id):
+    ThreadSummary.objects.filter(root_id=root_id).update(participant_count=_participants(root_id).count())
+
+
+def refresh_thread_summary(root_id):
+    """Recount a thread from its messages, e.g. after replies were deleted."""
+    latest = (
+        Message.objects.filter(thread_root_id=root_id)
+        .order_by('-sent_at')
+        .values('sent_at', 'sender_id')
+        .first()
+    )
+    if latest is None:
+        return
+    ThreadSummary.objects.filter(root_id=root_id).update(
+        reply_count=Message.objects.filter(thread_root_id=root_id).exclude(pk=root_id).count(),
+        participant_count=_participants(root_id).count(),
+        last_activity_at=latest['sent_at'],
+        last_sender_id=latest['sender_id']
+    )
+    MailboxEntry.objects.filter(message_id=root_id).update(last_activity_at=latest['sent_at'])
+
+
+def detach_thread(root):
+    """
+    What a root's thread needs to outlive it: the ids of its replies and the
+    participants' mailbox state. Take it before the root is deleted, since
+    the replies are detached and the entries dropped along with it.
+    """
+    return {
+        'reply_ids': list(Message.objects.filter(thread_root_id=root.pk).exclude(pk=root.pk).values_list('pk', flat=True)),
+        'entries': list(
+            MailboxEntry.objects.filter(message=root).values('user_id', 'is_received', 'is_sent', 'is_read', 'is_archived')
+        ),
+    }
+
+
+def promote_thread_root(detached):
+    """
+    Make the earliest surviving reply of a deleted root the thread's new root,
+    carrying over the participants' mailbox entries. Returns the new root.
+    """
+    new_root = Message.objects.filter(pk__in=detached['reply_ids']).order_by('sent_at', 'pk').first()
+    if new_root is None:
+        return None
+    # Paths keep the old root's segment as a shared prefix, so they still sort
+    Message.objects.filter(pk__in=detached['reply_ids']).update(thread_root=new_root)
+    new_root.thread_root_id = new_root.pk
+    ThreadSummary.objects.create(root=new_root, last_activity_at=new_root.sent_at, last_sender_id=new_root.sender_id)
+
+    users = set(
+        get_user_model().objects.filter(pk__in=[entry['user_id'] for entry in detached['entries']])
+        .values_list('pk', flat=True)
+    )
+    fields = _denormalized(new_root)
+    MailboxEntry.objects.bulk_create(
+        [MailboxEntry(message=new_root, **entry, **fields) for entry in detached['entries'] if entry['user_id'] in users],
+        ignore_conflicts=True
+    )
+    refresh_thread_summary(new_root.pk)
+    return new_root
+
+
+def _upsert(message, user_ids, **state):
+    """Apply ``state`` to the users' entries for ``message``, creating any that are missing."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    existing = set(
+        MailboxEntry.objects.filter(message=message, user_id__in=user_ids).values_list('user_id', flat=True)
+    )
+    if existing:
+        MailboxEntry.objects.filter(message=message, user_id__in=existing).update(**state)
+    missing = user_ids - existing
+    if missing:
+        fields = _denormalized(message)
+        MailboxEntry.objects.bulk_create(
+            [MailboxEntry(user_id=user_id, message=message, **fields, **state) for user_id in missing],
+            ignore_conflicts=True
+        )
+
+
+@transaction.atomic
+def deliver(message):
+    """
+    File ``message`` in its participants' mailboxes. Call it once the
+    recipients and attachments are saved. A reply brings its conversation
+    back into the recipients' inboxes as unread.
+    """
+    root = thread_root(message)
+    recipient_ids = set(message.recipients.values_list('pk', flat=True))
+    others = recipient_ids - {message.sender_id}
+
+    if root.pk == message.pk:
+        _upsert(message, [message.sender_id], is_sent=True, is_received=message.sender_id in recipient_ids, is_read=True)
+    else:
+        _upsert(root, [message.sender_id], is_read=True)
+        if message.attachments.exists():
+            MailboxEntry.objects.filter(message=root).update(has_attachments=True)
+    _upsert(root, others, is_received=True, is_read=False, is_archived=False)
+
+
+def audience_users(broadcast):
+    """The users a broadcast reaches, resolved from its stored audience at delivery time."""
+    users = get_user_model().objects.filter(is_active=True)
+    if broadcast.audience == 'class_section':
+        users = users.filter(student_profile__student_class=broadcast.student_class)
+        if broadcast.section:
+            users = users.filter(student_profile__section=broadcast.section)
+        return users
+    if broadcast.audience == 'department':
+        return users.filter(is_teacher=True, department_id=broadcast.department_id)
+    if broadcast.audience == 'teachers':
+        return users.filter(is_teacher=True)
+    # Parents have no accounts of their own; reach the ones registered with a parent's email
+    return users.filter(
+        Q(email__in=Parent.objects.values('father_email')) | Q(email__in=Parent.objects.values('mother_email'))
+    )
+
+
+def deliver_broadcast(message_id, batch_size=BROADCAST_BATCH_SIZE):
+    """
+    File a broadcast in its audience's inboxes, one batch of users per
+    transaction. Progress is recorded after each batch, so an interrupted
+    delivery picks up where it stopped. Returns the number of users reached.
+    """
+    broadcast = Broadcast.objects.select_related('message', 'department').get(pk=message_id)
+    if broadcast.completed_at:
+        return 0
+    message = broadcast.message
+    fields = _denormalized(message)
+    delivered = 0
+    while True:
+        user_ids = list(
+            audience_users(broadcast)
+            .filter(pk__gt=broadcast.delivered_through)
+            .exclude(pk=message.sender_id)
+            .order_by('pk')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if not user_ids:
+            break
+        with transaction.atomic():
+            MailboxEntry.objects.bulk_create(
+                [MailboxEntry(user_id=user_id, message=message, is_received=True, **fields) for user_id in user_ids],
+                ignore_conflicts=True
+            )
+            Broadcast.objects.filter(pk=broadcast.pk).update(
+                delivered_through=user_ids[-1],
+                delivered_count=F('delivered_count') + len(user_ids)
+            )
+        broadcast.delivered_through = user_ids[-1]
+        delivered += len(user_ids)
+    Broadcast.objects.filter(pk=broadcast.pk).update(completed_at=timezone.now())
+    return delivered
+
+
+def mailbox_entries(user, folder='all'):
+    """``user``'s conversations in ``folder``, latest activity first, as one indexed range query."""
+    entries = MailboxEntry.objects.filter(user=user, is_archived=folder == 'archived')
+    if folder == 'inbox':
+        entries = entries.filter(is_received=True)
+    elif folder == 'sent':
+        entries = entries.filter(is_sent=True)
+    return entries.select_related(
+        'sender', 'message__thread_summary__last_sender'
+    ).order_by('-last_activity_at')
+
+
+def get_unread_message_count(user):
+    return MailboxEntry.objects.filter(user=user, is_received=True, is_read=False).count()
+
+
+def mark_thread_read(user, message):
+    MailboxEntry.objects.filter(user=user, message_id=message.thread_root_id, is_read=False).update(is_read=True)
+
+
+def set_archived(user, message_id, archived=True):
+    return MailboxEntry.objects.filter(user=user, message_id=message_id).update(is_archived=archived)
+
+
+def with_recipient_count(messages):
+    """Annotate ``recipient_count`` as a correlated subquery, so the rows are not grouped."""
+    recipients = (
+        Message.recipients.through.objects.filter(message=OuterRef('pk'))
+        .values('message')
+        .annotate(total=Count('pk'))
+        .values('total')
+    )
+    return messages.annotate(recipient_count=Coalesce(Subquery(recipients), 0))
+
+
+def attach_recipient_preview(messages, limit=RECIPIENT_PREVIEW_SIZE):
+    """
+    Set ``recipient_preview``, the names of the first ``limit`` recipients,
+    and ``more_recipients`` on each of ``messages`` (one page, annotated by
+    with_recipient_count) with a single query. Broadcasts show their audience
+    instead.
+    """
+    messages = list(messages)
+    user_field = Message.recipients.field.m2m_reverse_field_name()
+    ranked = (
+        Message.recipients.through.objects.filter(message_id__in=[message.pk for message in messages])
+        .annotate(rank=Window(RowNumber(), partition_by=F('message_id'), order_by=F(user_field).asc()))
+        .filter(rank__lte=limit)
+        .order_by('message_id', 'rank')
+        .values_list('message_id', f'{user_field}__first_name', f'{user_field}__last_name', f'{user_field}__username')
+    )
+    names = {}
+    for message_id, first_name, last_name, username in ranked:
+        names.setdefault(message_id, []).append(f"{first_name} {last_name}".strip() or username)
+    for message in messages:
+        broadcast = getattr(message, 'broadcast', None)
+        if broadcast is not None:
+            message.recipient_preview = [broadcast.label()]
+            message.more_recipients = 0
+        else:
+            message.recipient_preview = names.get(message.pk, [])
+            message.more_recipients = message.recipient_count - len(message.recipient_preview)
+    return messages
+
+
+def _start_of_day(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def admin_messages(sender=None, date_from=None, date_to=None, subject=''):
+    """Sent messages for the admin browser, newest first, filtered as given."""
+    messages = Message.objects.filter(is_draft=False)
+    if sender is not None:
+        messages = messages.filter(sender=sender)
+    # Whole local days as datetime ranges, so the sent_at index still applies
+    if date_from:
+        messages = messages.filter(sent_at__gte=_start_of_day(date_from))
+    if date_to:
+        messages = messages.filter(sent_at__lt=_start_of_day(date_to + timedelta(days=1)))
+    if subject:
+        messages = messages.filter(subject__icontains=subject)
+    return with_recipient_count(messages).select_related('sender', 'broadcast__department').order_by('-sent_at')
@@ -0,0 +1,44 @@
+# school/management/commands/benchmark_timetable_generator
+from django.core.management.base import BaseCommand
+
+from school.scheduling import DEFAULT_TIME_LIMIT, solve, synthetic_problem
+
+
+class Command(BaseCommand):
+    help = "Time the timetable generator on synthetic schools of growing size. Nothing is saved."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sections',
+            type=int,
+            nargs='+',
+            default=[10, 25, 50, 100, 200],
+            help="School sizes to solve, in class-sections"
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per size; the median time is reported")
+        parser.add_argument('--time-limit', type=float, default=DEFAULT_TIME_LIMIT)
+        parser.add_argument(
+            '--rooms-per-section',
+            type=float,
+            default=0.85,
+            help="Lower values make rooms scarcer and the schools harder"
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'sections':>8} {'lessons':>8} {'teachers':>8} {'rooms':>6} "
+                          f"{'seconds':>8} {'steps':>8} {'clashing':>8}")
+        for sections in options['sections']:
+            runs = []
+            for run in range(options['repeat']):
+                problem = synthetic_problem(
+                    sections, seed=options['seed'] + run, rooms_per_section=options['rooms_per_section']
+                )
+                runs.append(solve(problem, seed=options['seed'] + run, time_limit=options['time_limit']))
+            runs.sort(key=lambda solution: solution.seconds)
+            median = runs[len(runs) // 2]
+            teachers = {teacher_id for requirement in problem.requirements for teacher_id in requirement.teacher_ids}
+            self.stdout.write(
+                f"{sections:>8} {len(median.lessons):>8} {len(teachers):>8} {len(problem.rooms):>6} "
+                f"{median.seconds:>8.2f} {median.steps:>8} {max(run.violations for run in runs):>8}"
+            )
@@ -0,0 +1,23 @@
+# school/management/commands/collect_attachment_blobs
+from django.core.management.base import BaseCommand
+
+from school.attachments import collect_blobs, expire_uploads
+
+
+class Command(BaseCommand):
+    help = "Expire abandoned uploads, recount attachment blob references and delete blobs no message uses"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="Number of unreferenced blobs collected per pass"
+        )
+
+    def handle(self, *args, **options):
+        expired = expire_uploads()
+        recounted, collected = collect_blobs(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Expired {expired} uploads, fixed {recounted} reference counts, collected {collected} blobs"
+        ))
@@ -0,0 +1,24 @@
+# school/management/commands/deliver_broadcasts
+from django.core.management.base import BaseCommand
+
+from school.mailbox import BROADCAST_BATCH_SIZE, deliver_broadcast
+from school.models import Broadcast
+
+
+class Command(BaseCommand):
+    help = "Deliver queued broadcasts to their audience, resuming any that were interrupted"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=BROADCAST_BATCH_SIZE,
+            help="Number of mailboxes filled per transaction"
+        )
+
+    def handle(self, *args, **options):
+        pending = list(Broadcast.objects.filter(completed_at__isnull=True).values_list('pk', flat=True))
+        delivered = sum(deliver_broadcast(pk, batch_size=options['batch_size']) for pk in pending)
+        self.stdout.write(self.style.SUCCESS(
+            f"Delivered {len(pending)} broadcasts to {delivered} mailboxes"
+        ))
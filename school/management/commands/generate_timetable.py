@@ -0,0 +1,59 @@
+# school/management/commands/generate_timetable
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from school.conflicts import validate_slots
+from school.models import Timetable
+from school.scheduling import DEFAULT_TIME_LIMIT, build_problem, solution_entries, solution_slots, solve
+from school.timetables import replace_entries
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a clash-free week for the classes in a JSON plan (periods, rooms and their "
+        "capacities, each class's subject periods, teacher unavailability) and replace their "
+        "saved timetables with it. Other classes' bookings are left as they are and worked around."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('plan', help="JSON plan file")
+        parser.add_argument('--seed', type=int, default=None, help="Random seed, for a repeatable result")
+        parser.add_argument(
+            '--time-limit',
+            type=float,
+            default=DEFAULT_TIME_LIMIT,
+            help="Seconds to search before giving up"
+        )
+        parser.add_argument('--dry-run', action='store_true', help="Solve without saving")
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['plan'], encoding='utf-8') as source:
+                problem = build_problem(json.load(source))
+        except ValueError as error:
+            raise CommandError(f"Invalid plan: {error}")
+
+        solution = solve(problem, seed=options['seed'], time_limit=options['time_limit'])
+        if solution.violations:
+            raise CommandError(
+                f"Nothing saved: {solution.violations} of {len(solution.lessons)} lessons still clash after "
+                f"{solution.seconds:.1f}s. Allow more time, rooms or teachers."
+            )
+
+        classes = Q()
+        for requirement in problem.requirements:
+            classes |= Q(student_class=requirement.student_class, section=requirement.section)
+        replacing = Timetable.objects.filter(classes)
+        # The saved timetable may have changed while solving
+        conflicts = validate_slots(solution_slots(problem, solution), replacing=replacing)
+        if conflicts:
+            raise CommandError("Nothing saved:\n" + "\n".join(conflict.message() for conflict in conflicts))
+
+        summary = f"{len(solution.lessons)} lessons in {solution.seconds:.1f}s ({solution.steps} repair steps)"
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Solved {summary}"))
+            return
+        replaced = replace_entries(solution_entries(problem, solution), replacing)
+        self.stdout.write(self.style.SUCCESS(f"Generated {summary}, replaced {replaced} entries"))
@@ -0,0 +1,83 @@
+# school/management/commands/import_timetable
+import csv
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from school.conflicts import parse_slot, validate_slots
+from school.models import Subject, Timetable
+from school.timetables import replace_entries
+
+
+class Command(BaseCommand):
+    help = (
+        "Import timetable entries from a CSV with the columns day, start_time, end_time, "
+        "student_class, section, subject (code), teacher (email), classroom and color. "
+        "Nothing is saved if any row is invalid or clashes with another booking."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file to import")
+        parser.add_argument(
+            '--replace',
+            action='store_true',
+            help="Replace the saved weeks of the classes in the file instead of adding to them"
+        )
+        parser.add_argument('--dry-run', action='store_true', help="Only report problems")
+
+    def handle(self, *args, **options):
+        with open(options['path'], newline='', encoding='utf-8-sig') as source:
+            rows = list(csv.DictReader(source))
+
+        subjects = Subject.objects.in_bulk({row.get('subject', '') for row in rows}, field_name='code')
+        teachers = dict(
+            get_user_model().objects.filter(email__in={row.get('teacher', '') for row in rows})
+            .values_list('email', 'pk')
+        )
+
+        problems, slots, entries = [], [], []
+        for line, row in enumerate(rows, start=2):
+            subject, teacher_id = subjects.get(row.get('subject', '')), teachers.get(row.get('teacher', ''))
+            if subject is None:
+                problems.append(f"line {line}: unknown subject {row.get('subject')!r}")
+                continue
+            if teacher_id is None:
+                problems.append(f"line {line}: unknown teacher {row.get('teacher')!r}")
+                continue
+            try:
+                slot = parse_slot({**row, 'teacher_id': teacher_id, 'subject': str(subject)}, ref=line)
+            except ValueError as error:
+                problems.append(f"line {line}: {error}")
+                continue
+            slots.append(slot)
+            entries.append(Timetable(
+                day=slot.day,
+                start_time=slot.start_time,
+                end_time=slot.end_time,
+                student_class=slot.student_class,
+                section=slot.section,
+                subject=subject,
+                teacher_id=teacher_id,
+                classroom=slot.classroom,
+                color=row.get('color') or None
+            ))
+
+        replacing = Timetable.objects.none()
+        if options['replace']:
+            classes = Q()
+            for student_class, section in {(slot.student_class, slot.section) for slot in slots}:
+                classes |= Q(student_class=student_class, section=section)
+            replacing = Timetable.objects.filter(classes) if classes else replacing
+        for conflict in validate_slots(slots, replacing=replacing if options['replace'] else None):
+            other = f"line {conflict.other.ref}" if conflict.other.pk is None else f"entry {conflict.other.pk}"
+            problems.append(f"line {conflict.slot.ref}: {conflict.message()} ({other})")
+
+        if problems:
+            raise CommandError("Nothing imported:\n" + "\n".join(problems))
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"{len(entries)} entries would be imported"))
+            return
+
+        replaced = replace_entries(entries, replacing)
+        self.stdout.write(self.style.SUCCESS(f"Imported {len(entries)} entries, replaced {replaced}"))
@@ -0,0 +1,55 @@
+# school/management/commands/prune_notifications
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from school.notifications import drop_archived_months, prune_notifications
+
+
+class Command(BaseCommand):
+    help = "Prune notifications past their retention period, archiving them by month"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--read-days',
+            type=int,
+            default=getattr(settings, 'NOTIFICATION_RETENTION_READ_DAYS', None),
+            help="Prune read notifications older than this many days"
+        )
+        parser.add_argument(
+            '--all-days',
+            type=int,
+            default=getattr(settings, 'NOTIFICATION_RETENTION_ALL_DAYS', None),
+            help="Prune all notifications older than this many days"
+        )
+        parser.add_argument(
+            '--no-archive',
+            action='store_false',
+            dest='archive',
+            default=getattr(settings, 'NOTIFICATION_ARCHIVE', True),
+            help="Delete pruned notifications instead of archiving them"
+        )
+        parser.add_argument(
+            '--archive-months',
+            type=int,
+            default=getattr(settings, 'NOTIFICATION_ARCHIVE_MONTHS', None),
+            help="Drop archived notifications older than this many months"
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=getattr(settings, 'NOTIFICATION_PRUNE_BATCH_SIZE', 500),
+            help="Number of rows removed per transaction"
+        )
+
+    def handle(self, *args, **options):
+        pruned = prune_notifications(
+            read_days=options['read_days'],
+            all_days=options['all_days'],
+            archive=options['archive'],
+            batch_size=options['batch_size']
+        )
+        self.stdout.write(self.style.SUCCESS(f"Pruned {pruned} notifications"))
+
+        if options['archive_months'] is not None:
+            dropped = drop_archived_months(options['archive_months'], batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Dropped {dropped} archived notifications"))
@@ -0,0 +1,23 @@
+# school/management/commands/rebuild_message_search
+from django.core.management.base import BaseCommand
+
+from school.search import REBUILD_BATCH_SIZE, fts_enabled, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text message search index from the message table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=REBUILD_BATCH_SIZE,
+            help="Number of messages indexed per batch"
+        )
+
+    def handle(self, *args, **options):
+        if not fts_enabled():
+            self.stdout.write(self.style.WARNING("Full-text search needs SQLite; nothing to rebuild"))
+            return
+        indexed = rebuild_search_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} messages"))
@@ -0,0 +1,20 @@
+# school/management/commands/reconcile_notification_counts
+from django.core.management.base import BaseCommand
+
+from school.notifications import reconcile_unread_counts
+
+
+class Command(BaseCommand):
+    help = "Recount unread notifications per user and repair drifted counters"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="Number of users checked per transaction"
+        )
+
+    def handle(self, *args, **options):
+        checked, fixed = reconcile_unread_counts(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Checked {checked} users, fixed {fixed} counters"))
@@ -0,0 +1,21 @@
+# school/management/commands/send_exam_notifications
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from school.notifications import send_exam_notifications
+
+
+class Command(BaseCommand):
+    help = "Notify the classes of newly scheduled exams, resuming any run that was interrupted"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=getattr(settings, 'NOTIFICATION_FANOUT_BATCH_SIZE', 500),
+            help="Number of students notified per transaction"
+        )
+
+    def handle(self, *args, **options):
+        exams, created = send_exam_notifications(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Announced {exams} exams, created {created} notifications"))
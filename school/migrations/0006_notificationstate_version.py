@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0005_notification_dedupe_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationstate',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0009_notification_retention'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationPayload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(blank=True, max_length=100)),
+                ('message', models.TextField()),
+                ('related_url', models.URLField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        # The text columns keep their names; only the model fields are renamed
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name='notification',
+                    old_name='title',
+                    new_name='own_title',
+                ),
+                migrations.AlterField(
+                    model_name='notification',
+                    name='own_title',
+                    field=models.CharField(blank=True, db_column='title', max_length=100),
+                ),
+                migrations.RenameField(
+                    model_name='notification',
+                    old_name='message',
+                    new_name='own_message',
+                ),
+                migrations.AlterField(
+                    model_name='notification',
+                    name='own_message',
+                    field=models.TextField(blank=True, db_column='message'),
+                ),
+                migrations.RenameField(
+                    model_name='notification',
+                    old_name='related_url',
+                    new_name='own_related_url',
+                ),
+                migrations.AlterField(
+                    model_name='notification',
+                    name='own_related_url',
+                    field=models.URLField(blank=True, db_column='related_url', null=True),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='payload',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='school.notificationpayload'),
+        ),
+    ]
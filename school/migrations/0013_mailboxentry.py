@@ -0,0 +1,84 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_mailboxes(apps, schema_editor):
+    Message = apps.get_model('school', 'Message')
+    MailboxEntry = apps.get_model('school', 'MailboxEntry')
+    parents = dict(Message.objects.values_list('id', 'parent_id'))
+
+    def root_of(message_id):
+        seen = set()
+        while parents.get(message_id) and message_id not in seen:
+            seen.add(message_id)
+            message_id = parents[message_id]
+        return message_id
+
+    entries = {}
+    messages = Message.objects.select_related('sender').prefetch_related('recipients', 'attachments').order_by('sent_at')
+    roots = {message.id: message for message in messages if not message.parent_id}
+    for message in messages:
+        root = roots.get(root_of(message.id))
+        if root is None:
+            continue
+        for user in [message.sender, *message.recipients.all()]:
+            entry = entries.get((user.id, root.id))
+            if entry is None:
+                # Historical models lack custom methods such as get_full_name()
+                names = ', '.join(
+                    f"{r.first_name} {r.last_name}".strip() or r.username for r in root.recipients.all()
+                )
+                entry = entries[(user.id, root.id)] = MailboxEntry(
+                    user_id=user.id,
+                    message_id=root.id,
+                    is_read=True,
+                    sender_id=root.sender_id,
+                    subject=root.subject,
+                    recipient_names=names if len(names) <= 255 else names[:252] + '...',
+                    has_attachments=False,
+                    sent_at=root.sent_at,
+                )
+            if user.id == message.sender_id:
+                entry.is_sent = entry.is_sent or message.id == root.id
+            else:
+                entry.is_received = True
+                entry.is_read = message.is_read
+            entry.has_attachments = entry.has_attachments or bool(message.attachments.all())
+    MailboxEntry.objects.bulk_create(entries.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0012_notification_occurrences'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_received', models.BooleanField(default=False)),
+                ('is_sent', models.BooleanField(default=False)),
+                ('is_read', models.BooleanField(default=False)),
+                ('is_archived', models.BooleanField(default=False)),
+                ('subject', models.CharField(max_length=200)),
+                ('recipient_names', models.CharField(blank=True, max_length=255)),
+                ('has_attachments', models.BooleanField(default=False)),
+                ('sent_at', models.DateTimeField()),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_entries', to='school.message')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-sent_at'],
+                'indexes': [models.Index(fields=['user', 'is_archived', '-sent_at'], name='mailbox_user_listing_idx'), models.Index(fields=['user', 'is_received', 'is_read'], name='mailbox_user_unread_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'message'), name='unique_mailbox_entry')],
+            },
+        ),
+        migrations.RunPython(backfill_mailboxes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+MAX_THREAD_DEPTH = 20
+PATH_STEP = 11
+
+
+def backfill_thread_paths(apps, schema_editor):
+    Message = apps.get_model('school', 'Message')
+    parents = dict(Message.objects.values_list('id', 'parent_id'))
+    placed = {}
+
+    def place(message_id, seen=()):
+        if message_id in placed:
+            return placed[message_id]
+        parent_id = parents.get(message_id)
+        if parent_id is None or parent_id in seen:
+            root_id, prefix, depth = message_id, '', 0
+        else:
+            root_id, parent_path, parent_depth = place(parent_id, seen + (message_id,))
+            if parent_depth >= MAX_THREAD_DEPTH:
+                prefix, depth = parent_path[:-PATH_STEP], parent_depth
+            else:
+                prefix, depth = parent_path, parent_depth + 1
+        placed[message_id] = (root_id, f"{prefix}{message_id:010d}/", depth)
+        return placed[message_id]
+
+    messages = list(Message.objects.only('id'))
+    for message in messages:
+        message.thread_root_id, message.path, message.depth = place(message.id)
+    Message.objects.bulk_update(messages, ['thread_root', 'path', 'depth'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0013_mailboxentry'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='path',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='thread_root',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='thread_messages', to='school.message'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread_root', 'path'], name='message_thread_path_idx'),
+        ),
+        migrations.RunPython(backfill_thread_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:10
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_thread_summaries(apps, schema_editor):
+    Message = apps.get_model('school', 'Message')
+    ThreadSummary = apps.get_model('school', 'ThreadSummary')
+    MailboxEntry = apps.get_model('school', 'MailboxEntry')
+
+    threads = {}
+    for message in Message.objects.prefetch_related('recipients').order_by('sent_at', 'pk'):
+        if message.thread_root_id is None:
+            continue
+        summary = threads.setdefault(message.thread_root_id, {'replies': 0, 'participants': set()})
+        if message.pk != message.thread_root_id:
+            summary['replies'] += 1
+        summary['last'] = message
+        summary['participants'].add(message.sender_id)
+        summary['participants'].update(r.pk for r in message.recipients.all())
+
+    ThreadSummary.objects.bulk_create([
+        ThreadSummary(
+            root_id=root_id,
+            reply_count=summary['replies'],
+            participant_count=len(summary['participants']),
+            last_activity_at=summary['last'].sent_at,
+            last_sender_id=summary['last'].sender_id,
+        )
+        for root_id, summary in threads.items()
+    ], batch_size=500)
+    entries = list(MailboxEntry.objects.all())
+    for entry in entries:
+        summary = threads.get(entry.message_id)
+        entry.last_activity_at = summary['last'].sent_at if summary else entry.sent_at
+    MailboxEntry.objects.bulk_update(entries, ['last_activity_at'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0014_message_thread_path'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadSummary',
+            fields=[
+                ('root', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='thread_summary', serialize=False, to='school.message')),
+                ('reply_count', models.PositiveIntegerField(default=0)),
+                ('participant_count', models.PositiveIntegerField(default=0)),
+                ('last_activity_at', models.DateTimeField()),
+                ('last_sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='mailboxentry',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AlterModelOptions(
+            name='mailboxentry',
+            options={'ordering': ['-last_activity_at']},
+        ),
+        migrations.RemoveIndex(
+            model_name='mailboxentry',
+            name='mailbox_user_listing_idx',
+        ),
+        migrations.AddIndex(
+            model_name='mailboxentry',
+            index=models.Index(fields=['user', 'is_archived', '-last_activity_at'], name='mailbox_user_activity_idx'),
+        ),
+        migrations.RunPython(backfill_thread_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:40
+
+import os
+
+from django.db import migrations
+
+INDEX_BATCH_SIZE = 500
+
+
+def create_search_table(apps, schema_editor):
+    # Full-text search uses SQLite's FTS5; other backends fall back to LIKE
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS school_message_fts "
+        "USING fts5(subject, body, sender_name, attachment_names, tokenize='unicode61 remove_diacritics 2')"
+    )
+    index_existing_messages(apps, schema_editor)
+
+
+def index_existing_messages(apps, schema_editor):
+    # Same documents as school.search.index_messages, built from historical
+    # models (no get_full_name(); attachments still hold the file itself)
+    Message = apps.get_model('school', 'Message')
+    messages = Message.objects.select_related('sender').prefetch_related('attachments').order_by('pk')
+    last_id = 0
+    while True:
+        batch = list(messages.filter(pk__gt=last_id)[:INDEX_BATCH_SIZE])
+        if not batch:
+            return
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO school_message_fts (rowid, subject, body, sender_name, attachment_names) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                [
+                    (
+                        message.pk,
+                        message.subject,
+                        message.body,
+                        f"{message.sender.first_name} {message.sender.last_name}".strip() or message.sender.username,
+                        ' '.join(os.path.basename(attachment.file.name) for attachment in message.attachments.all()),
+                    )
+                    for message in batch
+                ]
+            )
+        last_id = batch[-1].pk
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS school_message_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0015_thread_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
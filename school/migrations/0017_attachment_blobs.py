@@ -0,0 +1,80 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:57
+
+import hashlib
+import os
+
+import django.db.models.deletion
+from django.core.files.storage import default_storage
+from django.db import migrations, models, transaction
+
+
+def blob_path(digest):
+    return f"attachment_blobs/{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+def move_files_into_blobs(apps, schema_editor):
+    MessageAttachment = apps.get_model('school', 'MessageAttachment')
+    AttachmentBlob = apps.get_model('school', 'AttachmentBlob')
+    blobs = {}
+    for attachment in MessageAttachment.objects.exclude(file='').iterator():
+        legacy = attachment.file.name
+        attachment.name = os.path.basename(legacy)
+        if not default_storage.exists(legacy):
+            # Nothing to hash; the row keeps its name but has no content
+            attachment.save(update_fields=['name'])
+            continue
+        digest = hashlib.sha256()
+        with default_storage.open(legacy, 'rb') as content:
+            for chunk in content.chunks():
+                digest.update(chunk)
+        key = digest.hexdigest()
+        blob = blobs.get(key)
+        if blob is None:
+            with default_storage.open(legacy, 'rb') as content:
+                name = default_storage.save(blob_path(key), content)
+            blob = blobs[key] = AttachmentBlob.objects.create(
+                sha256=key, file=name, size=default_storage.size(name), ref_count=0
+            )
+        blob.ref_count += 1
+        attachment.blob = blob
+        attachment.save(update_fields=['name', 'blob'])
+        # The duplicate copies go once the new layout is committed
+        transaction.on_commit(lambda legacy=legacy: default_storage.delete(legacy), using=schema_editor.connection.alias)
+    for blob in blobs.values():
+        blob.save(update_fields=['ref_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0016_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(upload_to='attachment_blobs/')),
+                ('size', models.PositiveBigIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='messageattachment',
+            name='name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='messageattachment',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='attachments', to='school.attachmentblob'),
+        ),
+        migrations.RunPython(move_files_into_blobs, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='messageattachment',
+            name='file',
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0018_attachment_uploads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='broadcast', serialize=False, to='school.message')),
+                ('audience', models.CharField(choices=[('class_section', 'Class / section'), ('department', 'Department'), ('teachers', 'All teachers'), ('parents', 'All parents')], max_length=20)),
+                ('student_class', models.CharField(blank=True, max_length=50)),
+                ('section', models.CharField(blank=True, max_length=10)),
+                ('delivered_through', models.PositiveBigIntegerField(default=0)),
+                ('delivered_count', models.PositiveIntegerField(default=0)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('department', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='broadcasts', to='school.department')),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0020_message_sent_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='thread_root',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='thread_messages', to='school.message'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0021_message_thread_root_set_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExamAnnouncement',
+            fields=[
+                ('exam', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='announcement', serialize=False, to='school.exam')),
+                ('delivered_through', models.PositiveBigIntegerField(default=0)),
+                ('delivered_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
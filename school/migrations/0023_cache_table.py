@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-18 21:05
+
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_cache_table(apps, schema_editor):
+    # The default cache is the database (see CACHES); `migrate` is the one
+    # setup step every deployment runs, so create its table here. Nothing is
+    # created when CACHES points elsewhere.
+    call_command('createcachetable', database=schema_editor.connection.alias, verbosity=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('school', '0022_exam_announcement'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_table, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,5 @@
 # school/models.py
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.conf import settings
 import uuid
@@ -7,6 +7,22 @@ from home_auth.admin import CustomUser
 from django.urls import reverse
 from django.utils import timezone
 
+class NotificationPayload(models.Model):
+    """Text shared by every recipient of one fan-out."""
+    title = models.CharField(max_length=100, blank=True)
+    message = models.TextField()
+    related_url = models.URLField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.title or self.message[:50]
+
+
+class NotificationManager(models.Manager):
+    def get_queryset(self):
+        return super().get_queryset().select_related('payload')
+
+
 class Notification(models.Model):
     NOTIFICATION_TYPES = (
         ('exam', 'Exam Notification'),
@@ -15,25 +31,78 @@ class Notification(models.Model):
     )
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='notifications')
-    title = models.CharField(max_length=100, blank=True)
-    message = models.TextField()
+    # Per-recipient text; fan-outs leave these empty and share a payload instead
+    own_title = models.CharField(max_length=100, blank=True, db_column='title')
+    own_message = models.TextField(blank=True, db_column='message')
+    payload = models.ForeignKey(
+        NotificationPayload,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='notifications'
+    )
     notification_type = models.CharField(max_length=20, choices=NOTIFICATION_TYPES, default='general')
     is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
-    related_url = models.URLField(blank=True, null=True)
+    own_related_url = models.URLField(blank=True, null=True, db_column='related_url')
+    # Number of events folded into this row by coalescing
+    occurrences = models.PositiveIntegerField(default=1)
+    dedupe_key = models.CharField(max_length=100, blank=True, null=True, editable=False)
+
+    objects = NotificationManager()
     
     class Meta:
         ordering = ['-created_at']
         verbose_name = 'Notification'
         verbose_name_plural = 'Notifications'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'dedupe_key'], name='unique_notification_per_user_key'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'is_read', '-created_at'], name='notif_user_read_created_idx'),
+            models.Index(fields=['user', '-created_at', '-id'], name='notif_user_created_idx'),
+            models.Index(fields=['user', 'notification_type', '-created_at', '-id'], name='notif_user_type_created_idx'),
+            models.Index(fields=['created_at'], name='notif_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.get_notification_type_display()} for {self.user.email}"
+
+    @property
+    def title(self):
+        return self.own_title or (self.payload.title if self.payload_id else '')
+
+    @title.setter
+    def title(self, value):
+        self.own_title = value
+
+    @property
+    def message(self):
+        return self.own_message or (self.payload.message if self.payload_id else '')
+
+    @message.setter
+    def message(self, value):
+        self.own_message = value
+
+    @property
+    def related_url(self):
+        return self.own_related_url or (self.payload.related_url if self.payload_id else None)
+
+    @related_url.setter
+    def related_url(self, value):
+        self.own_related_url = value
     
     def save(self, *args, **kwargs):
         if not self.title:
             self.title = self.get_notification_type_display()
         super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        from .notifications import adjust_unread_count, is_unread
+        unread = is_unread(self)
+        result = super().delete(*args, **kwargs)
+        adjust_unread_count(self.user_id, -1 if unread else 0)
+        return result
     
     @property
     def time_since(self):
@@ -56,6 +125,40 @@ class Notification(models.Model):
             return f"{minutes} minute{'s' if minutes > 1 else ''} ago"
         return "Just now"
 
+class NotificationArchive(models.Model):
+    """Compact copy of a pruned notification, partitioned by the month it was created."""
+    month = models.DateField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='archived_notifications')
+    title = models.CharField(max_length=100, blank=True)
+    message = models.TextField()
+    notification_type = models.CharField(max_length=20, choices=Notification.NOTIFICATION_TYPES, default='general')
+    is_read = models.BooleanField(default=False)
+    created_at = models.DateTimeField()
+    related_url = models.URLField(blank=True, null=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['month', 'user'], name='notif_archive_month_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_notification_type_display()} for {self.user} ({self.month:%Y-%m})"
+
+
+class NotificationState(models.Model):
+    """Per-user notification bookkeeping, kept in step with Notification writes."""
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='notification_state')
+    unread_count = models.PositiveIntegerField(default=0)
+    version = models.PositiveBigIntegerField(default=0)
+    # Notifications created up to this moment count as read ("mark all as read")
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user} ({self.unread_count} unread)"
+
 class StudentTeacherRelationship(models.Model):
     student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='teachers')
     teacher = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='students')
@@ -88,9 +191,29 @@ class Exam(models.Model):
     
     class Meta:
         ordering = ['date', 'start_time']
+        indexes = [
+            models.Index(fields=['student_class', 'section', 'date'], name='exam_class_section_date_idx'),
+        ]
     
     def __str__(self):
         return f"{self.name} - {self.subject} ({self.date}) for {self.student_class} {self.section}"
+
+
+class ExamAnnouncement(models.Model):
+    """
+    A pending "new exam" notification to the exam's class, recorded in the
+    same transaction as the exam. `manage.py send_exam_notifications` fans it
+    out in batches that resume after ``delivered_through``, the highest
+    student user id notified so far.
+    """
+    exam = models.OneToOneField(Exam, on_delete=models.CASCADE, primary_key=True, related_name='announcement')
+    delivered_through = models.PositiveBigIntegerField(default=0)
+    delivered_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Announcement of {self.exam}"
     
 
 class Message(models.Model):
@@ -107,6 +230,8 @@ class Message(models.Model):
     body = models.TextField()
     sent_at = models.DateTimeField(default=timezone.now)
     is_read = models.BooleanField(default=False)
+    # Being composed; holds resumable uploads until it is sent
+    is_draft = models.BooleanField(default=False)
     parent = models.ForeignKey(
         'self',
         null=True,
@@ -114,31 +239,216 @@ class Message(models.Model):
         on_delete=models.SET_NULL,
         related_name='replies'
     )
+    # Set on first save: the conversation's first message (itself for a root)
+    # and a materialized path of zero-padded ids, so sorting a thread by path
+    # lists every reply depth-first under the message it answers. Deleting a
+    # root promotes its earliest reply (see mailbox.promote_thread_root).
+    thread_root = models.ForeignKey(
+        'self',
+        null=True,
+        blank=True,
+        editable=False,
+        on_delete=models.SET_NULL,
+        related_name='thread_messages'
+    )
+    path = models.CharField(max_length=255, blank=True, editable=False)
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    MAX_THREAD_DEPTH = 20
+    PATH_STEP = 11
 
     class Meta:
         ordering = ['-sent_at']
         permissions = [
             ("broadcast_message", "Can send messages to multiple recipients"),
         ]
+        indexes = [
+            models.Index(fields=['parent', '-sent_at'], name='message_parent_sent_idx'),
+            models.Index(fields=['thread_root', 'path'], name='message_thread_path_idx'),
+            # Drafts are excluded everywhere messages are listed
+            models.Index(fields=['-sent_at'], name='message_sent_idx', condition=models.Q(is_draft=False)),
+        ]
 
     def __str__(self):
-        return f"{self.subject} (From: {self.sender}, To: {', '.join([r.get_full_name() for r in self.recipients.all()])})"
+        # Listings attach a preview of the first few names (see mailbox.attach_recipient_preview)
+        names = getattr(self, 'recipient_preview', None)
+        if names is None:
+            names = [r.get_full_name() for r in self.recipients.all()]
+        return f"{self.subject} (From: {self.sender}, To: {', '.join(names)})"
     
     def get_absolute_url(self):
         return reverse('message_detail', args=[str(self.id)])
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # Drafts join a thread when they are sent
+            if not self.path and not self.is_draft:
+                from .mailbox import record_thread_activity
+                self._place_in_thread()
+                record_thread_activity(self)
+
+    def _place_in_thread(self):
+        parent = self.parent
+        if parent is None:
+            self.thread_root_id, prefix, self.depth = self.pk, '', 0
+        elif parent.depth >= self.MAX_THREAD_DEPTH:
+            # Past the path budget, nest alongside the parent instead of under it
+            self.thread_root_id, prefix, self.depth = parent.thread_root_id, parent.path[:-self.PATH_STEP], parent.depth
+        else:
+            self.thread_root_id, prefix, self.depth = parent.thread_root_id, parent.path, parent.depth + 1
+        self.path = f"{prefix}{self.pk:010d}/"
+        Message.objects.filter(pk=self.pk).update(thread_root_id=self.thread_root_id, path=self.path, depth=self.depth)
+
+class ThreadSummary(models.Model):
+    """Running totals for one conversation, kept in step as replies are saved."""
+    root = models.OneToOneField(Message, on_delete=models.CASCADE, primary_key=True, related_name='thread_summary')
+    reply_count = models.PositiveIntegerField(default=0)
+    participant_count = models.PositiveIntegerField(default=0)
+    last_activity_at = models.DateTimeField()
+    last_sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    def __str__(self):
+        return f"{self.root.subject} ({self.reply_count} replies)"
+
+
+class AttachmentBlob(models.Model):
+    """
+    One stored file, named by the SHA-256 of its content and shared by every
+    attachment with the same bytes. Unreferenced blobs are garbage-collected.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='attachment_blobs/')
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.ref_count} refs)"
+
+
 class MessageAttachment(models.Model):
     message = models.ForeignKey(
         Message,
         related_name='attachments',
         on_delete=models.CASCADE
     )
-    file = models.FileField(upload_to='message_attachments/%Y/%m/%d/')
+    # Empty only for legacy rows whose file was already missing when migrated
+    blob = models.ForeignKey(
+        AttachmentBlob,
+        null=True,
+        on_delete=models.PROTECT,
+        related_name='attachments'
+    )
+    name = models.CharField(max_length=255, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    @property
+    def file(self):
+        return self.blob.file if self.blob_id else None
+
+    @property
+    def size(self):
+        return self.blob.size if self.blob_id else 0
+
     def filename(self):
-        return self.file.name.split('/')[-1]
-    
+        return self.name
+
+
+class Broadcast(models.Model):
+    """
+    The audience of a broadcast message, stored once instead of a recipient
+    row per user. Mailboxes are filled in background batches that resume
+    after ``delivered_through``, the highest user id delivered so far.
+    """
+    AUDIENCES = (
+        ('class_section', 'Class / section'),
+        ('department', 'Department'),
+        ('teachers', 'All teachers'),
+        ('parents', 'All parents'),
+    )
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, primary_key=True, related_name='broadcast')
+    audience = models.CharField(max_length=20, choices=AUDIENCES)
+    student_class = models.CharField(max_length=50, blank=True)
+    # Blank means every section of the class
+    section = models.CharField(max_length=10, blank=True)
+    department = models.ForeignKey('Department', on_delete=models.CASCADE, null=True, blank=True, related_name='broadcasts')
+    delivered_through = models.PositiveBigIntegerField(default=0)
+    delivered_count = models.PositiveIntegerField(default=0)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def label(self):
+        if self.audience == 'class_section':
+            return f"{self.student_class} {self.section}" if self.section else f"{self.student_class} (all sections)"
+        if self.audience == 'department':
+            return self.department.name if self.department_id else 'Department'
+        return self.get_audience_display()
+
+    def __str__(self):
+        return f"{self.message.subject} to {self.label()}"
+
+
+class AttachmentUpload(models.Model):
+    """
+    A resumable upload into a draft message. Chunks are written to a part
+    file at their offset until ``received`` reaches ``size``, then the file
+    moves into the blob store as a MessageAttachment.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='attachment_uploads')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    # Optional digest of the whole file, checked once it is assembled
+    sha256 = models.CharField(max_length=64, blank=True)
+    received = models.PositiveBigIntegerField(default=0)
+    attachment = models.OneToOneField(
+        MessageAttachment,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name='upload'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+
+class MailboxEntry(models.Model):
+    """
+    One user's view of a conversation: their read/archived state plus copies of
+    the columns the message list shows, so a folder is a single indexed range.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='mailbox_entries')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='mailbox_entries')
+    is_received = models.BooleanField(default=False)
+    is_sent = models.BooleanField(default=False)
+    is_read = models.BooleanField(default=False)
+    is_archived = models.BooleanField(default=False)
+    # Denormalized from the message for the list view
+    sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    subject = models.CharField(max_length=200)
+    recipient_names = models.CharField(max_length=255, blank=True)
+    has_attachments = models.BooleanField(default=False)
+    sent_at = models.DateTimeField()
+    # Copied from the thread summary so folders sort by the latest reply
+    last_activity_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-last_activity_at']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'message'], name='unique_mailbox_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'is_archived', '-last_activity_at'], name='mailbox_user_activity_idx'),
+            models.Index(fields=['user', 'is_received', 'is_read'], name='mailbox_user_unread_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} ({self.user})"
+
 
 class Department(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -242,5 +552,11 @@ class Timetable(models.Model):
     classroom = models.CharField(max_length=50, blank=True, null=True)
     color = models.CharField(max_length=20, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['teacher', 'day', 'start_time'], name='timetable_teacher_day_idx'),
+            models.Index(fields=['student_class', 'section', 'day'], name='timetable_class_day_idx'),
+        ]
+
     def __str__(self):
         return f"{self.subject} - {self.student_class} {self.section} ({self.day})"
\ No newline at end of file
@@ -0,0 +1,572 @@
+# school/notifications
+import datetime
+import uuid
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Greatest
+from django.urls import reverse
+from django.utils import timezone
+
+from .events import publish
+from .models import Exam, ExamAnnouncement, Notification, NotificationArchive, NotificationPayload, NotificationState
+from student.models import Student
+
+FANOUT_BATCH_SIZE = 500
+NOTIFICATION_PAGE_SIZE = 20
+NOTIFICATION_FACETS = ('exam', 'assignment', 'announcement', 'message')
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# A notification is unread while it is not individually marked read and is
+# newer than the user's "mark all as read" watermark. UNREAD_JOINED resolves
+# the watermark through a join, for queries that span several users.
+UNREAD_JOINED = Q(is_read=False) & (
+    Q(user__notification_state__last_read_at__isnull=True)
+    | Q(created_at__gt=F('user__notification_state__last_read_at'))
+)
+
+
+def unread_q(watermark):
+    if watermark is None:
+        return Q(is_read=False)
+    return Q(is_read=False, created_at__gt=watermark)
+
+
+def _create_state(user_id):
+    # Rows already reflect any write that triggered this, so count them as-is
+    unread = Notification.objects.filter(user_id=user_id, is_read=False).count()
+    state, _ = NotificationState.objects.get_or_create(
+        user_id=user_id,
+        defaults={'unread_count': unread}
+    )
+    return state
+
+
+def _changed(user_ids):
+    user_ids = list(user_ids)
+    transaction.on_commit(lambda: publish(user_ids))
+
+
+def get_state(user):
+    return NotificationState.objects.filter(user=user).first() or _create_state(user.pk)
+
+
+def get_unread_count(user):
+    """Return the stored unread counter for ``user`` without counting rows."""
+    return get_state(user).unread_count
+
+
+def get_read_watermark(user_id):
+    return NotificationState.objects.filter(user_id=user_id).values_list('last_read_at', flat=True).first()
+
+
+def is_unread(notification):
+    if notification.is_read:
+        return False
+    watermark = get_read_watermark(notification.user_id)
+    return watermark is None or notification.created_at > watermark
+
+
+def unread_notifications_for(user, state=None):
+    """``user``'s unread notifications, newest first, as an indexed range query."""
+    state = state or get_state(user)
+    return Notification.objects.filter(unread_q(state.last_read_at), user=user).order_by('-created_at')
+
+
+def get_notification_version(user):
+    """Return the stamp that changes whenever ``user``'s notifications change."""
+    version = NotificationState.objects.filter(user=user).values_list('version', flat=True).first()
+    if version is None:
+        version = _create_state(user.pk).version
+    return version
+
+
+def notification_etag(request, *args, **kwargs):
+    if not request.user.is_authenticated:
+        return None
+    return f"{request.user.pk}-{get_notification_version(request.user)}"
+
+
+def adjust_unread_count(user_id, delta):
+    """Record a change to ``user_id``'s notifications, shifting the counter by ``delta``."""
+    updated = NotificationState.objects.filter(user_id=user_id).update(
+        unread_count=Greatest(F('unread_count') + delta, 0),
+        version=F('version') + 1,
+        updated_at=timezone.now()
+    )
+    if not updated:
+        _create_state(user_id)
+    _changed([user_id])
+
+
+def bulk_adjust_unread_count(user_ids, delta):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    NotificationState.objects.filter(user_id__in=user_ids).update(
+        unread_count=Greatest(F('unread_count') + delta, 0),
+        version=F('version') + 1,
+        updated_at=timezone.now()
+    )
+    known = set(NotificationState.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+    missing = [user_id for user_id in user_ids if user_id not in known]
+    if missing:
+        unread = dict(
+            Notification.objects.filter(user_id__in=missing, is_read=False)
+            .values('user_id')
+            .annotate(unread=Count('id'))
+            .values_list('user_id', 'unread')
+        )
+        NotificationState.objects.bulk_create(
+            [NotificationState(user_id=user_id, unread_count=unread.get(user_id, 0)) for user_id in missing],
+            ignore_conflicts=True
+        )
+    _changed(user_ids)
+
+
+def unread_payload(user, limit=5):
+    """Latest unread notifications and the unread counter, ready for JSON."""
+    state = get_state(user)
+    unread_count = state.unread_count
+    notifications = unread_notifications_for(user, state)[:limit] if unread_count else []
+    return {
+        'notifications': [
+            {
+                'id': str(notif.id),
+                'title': notif.title,
+                'message': notif.message,
+                'time_since': notif.time_since,
+                'is_read': notif.is_read,
+                'url': notif.related_url or '#',
+            } for notif in notifications
+        ],
+        'unread_count': unread_count
+    }
+
+
+def notification_facets(user, state=None):
+    """All notification-center counts for ``user`` in one aggregate query."""
+    state = state or get_state(user)
+    counts = {
+        'total': Count('id'),
+        'unread': Count('id', filter=unread_q(state.last_read_at)),
+    }
+    for notification_type in NOTIFICATION_FACETS:
+        counts[notification_type] = Count('id', filter=Q(notification_type=notification_type))
+    facets = Notification.objects.filter(user=user).aggregate(**counts)
+    facets['read'] = facets['total'] - facets['unread']
+    return facets
+
+
+def encode_cursor(notification):
+    delta = notification.created_at - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return f"{micros}-{notification.id.hex}"
+
+
+def decode_cursor(cursor):
+    try:
+        micros, pk = cursor.split('-', 1)
+        return EPOCH + datetime.timedelta(microseconds=int(micros)), uuid.UUID(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+def notification_page(user, status=None, notification_type=None, cursor=None, per_page=NOTIFICATION_PAGE_SIZE, state=None):
+    """
+    One page of ``user``'s notifications, newest first, using keyset
+    pagination on ``(created_at, id)``. Returns ``(notifications, next_cursor)``.
+    """
+    state = state or get_state(user)
+    watermark = state.last_read_at
+    queryset = Notification.objects.filter(user=user)
+    if status == 'unread':
+        queryset = queryset.filter(unread_q(watermark))
+    elif status == 'read':
+        queryset = queryset.exclude(unread_q(watermark))
+    if notification_type:
+        queryset = queryset.filter(notification_type=notification_type)
+
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        created_at, pk = position
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    notifications = list(queryset.order_by('-created_at', '-id')[:per_page + 1])
+    next_cursor = None
+    if len(notifications) > per_page:
+        notifications = notifications[:per_page]
+        next_cursor = encode_cursor(notifications[-1])
+    if watermark is not None:
+        # Rows behind the watermark are read without having been rewritten
+        for notification in notifications:
+            if notification.created_at <= watermark:
+                notification.is_read = True
+    return notifications, next_cursor
+
+
+def mark_as_read(user, notification_id=None):
+    """
+    Mark one unread notification of ``user`` as read. Without an id, move the
+    read watermark to now instead of rewriting every unread row.
+    """
+    with transaction.atomic():
+        if notification_id:
+            updated = Notification.objects.filter(
+                unread_q(get_read_watermark(user.pk)),
+                user=user,
+                id=notification_id
+            ).update(is_read=True)
+            if updated:
+                adjust_unread_count(user.pk, -updated)
+            return updated
+
+        now = timezone.now()
+        updated = NotificationState.objects.filter(user=user).update(
+            last_read_at=now,
+            unread_count=0,
+            version=F('version') + 1,
+            updated_at=now
+        )
+        if not updated:
+            NotificationState.objects.create(user=user, last_read_at=now)
+        _changed([user.pk])
+        return updated
+
+
+def delete_notifications(user, notification_id=None):
+    """Delete one (or every) notification of ``user`` and keep the counter in step."""
+    queryset = Notification.objects.filter(user=user)
+
+    with transaction.atomic():
+        if notification_id:
+            queryset = queryset.filter(id=notification_id)
+            unread = queryset.filter(unread_q(get_read_watermark(user.pk))).count()
+            deleted, _ = queryset.delete()
+            if deleted:
+                adjust_unread_count(user.pk, -unread)
+        else:
+            queryset.delete()
+            updated = NotificationState.objects.filter(user=user).update(
+                unread_count=0,
+                version=F('version') + 1,
+                updated_at=timezone.now()
+            )
+            if not updated:
+                _create_state(user.pk)
+            _changed([user.pk])
+
+
+def reconcile_unread_counts(batch_size=500):
+    """
+    Recount unread notifications and repair drifted counters, ``batch_size``
+    users per transaction. Returns ``(checked, fixed)``.
+    """
+    User = get_user_model()
+    checked = fixed = 0
+    last_pk = 0
+
+    while True:
+        user_ids = list(
+            User.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not user_ids:
+            break
+        last_pk = user_ids[-1]
+
+        with transaction.atomic():
+            actual = dict(
+                Notification.objects.filter(UNREAD_JOINED, user_id__in=user_ids)
+                .values('user_id')
+                .annotate(unread=Count('id'))
+                .values_list('user_id', 'unread')
+            )
+            states = {
+                state.user_id: state
+                for state in NotificationState.objects.select_for_update().filter(user_id__in=user_ids)
+            }
+
+            to_create, to_update = [], []
+            for user_id in user_ids:
+                unread = actual.get(user_id, 0)
+                state = states.get(user_id)
+                if state is None:
+                    to_create.append(NotificationState(user_id=user_id, unread_count=unread))
+                elif state.unread_count != unread:
+                    state.unread_count = unread
+                    state.version += 1
+                    to_update.append(state)
+
+            NotificationState.objects.bulk_create(to_create, ignore_conflicts=True)
+            NotificationState.objects.bulk_update(to_update, ['unread_count', 'version'])
+
+        checked += len(user_ids)
+        fixed += len(to_create) + len(to_update)
+
+    return checked, fixed
+
+
+def prune_notifications(read_days=None, all_days=None, archive=True, batch_size=500, now=None):
+    """
+    Remove notifications past their retention period, ``batch_size`` rows per
+    transaction so the database is never locked for long. Read notifications
+    older than ``read_days`` and all notifications older than ``all_days`` are
+    pruned; with ``archive`` they are copied to NotificationArchive first.
+    Returns the number of notifications pruned.
+    """
+    now = now or timezone.now()
+    rules = []
+    if all_days is not None:
+        rules.append(Q(created_at__lt=now - datetime.timedelta(days=all_days)))
+    if read_days is not None:
+        rules.append(
+            (Q(is_read=True) | Q(created_at__lte=F('user__notification_state__last_read_at')))
+            & Q(created_at__lt=now - datetime.timedelta(days=read_days))
+        )
+
+    pruned = 0
+    for rule in rules:
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    Notification.objects.filter(rule)
+                    .order_by('created_at')
+                    .values('id', 'user_id', 'notification_type', 'is_read', 'created_at',
+                            'own_title', 'own_message', 'own_related_url',
+                            'payload__title', 'payload__message', 'payload__related_url',
+                            watermark=F('user__notification_state__last_read_at'))[:batch_size]
+                )
+                if not batch:
+                    break
+                for row in batch:
+                    row['is_read'] = row['is_read'] or bool(row['watermark'] and row['created_at'] <= row['watermark'])
+                if archive:
+                    NotificationArchive.objects.bulk_create([
+                        NotificationArchive(
+                            month=row['created_at'].date().replace(day=1),
+                            user_id=row['user_id'],
+                            title=row['own_title'] or row['payload__title'] or '',
+                            message=row['own_message'] or row['payload__message'] or '',
+                            notification_type=row['notification_type'],
+                            is_read=row['is_read'],
+                            created_at=row['created_at'],
+                            related_url=row['own_related_url'] or row['payload__related_url'],
+                        )
+                        for row in batch
+                    ])
+                Notification.objects.filter(id__in=[row['id'] for row in batch]).delete()
+                _adjust_after_prune(batch)
+            pruned += len(batch)
+
+    drop_orphaned_payloads(batch_size)
+    return pruned
+
+
+def drop_orphaned_payloads(batch_size=500):
+    """Delete shared payloads that no notification references any more."""
+    while True:
+        ids = list(
+            NotificationPayload.objects.filter(notifications__isnull=True).values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        NotificationPayload.objects.filter(id__in=ids).delete()
+
+
+def _adjust_after_prune(rows):
+    unread = Counter(row['user_id'] for row in rows if not row['is_read'])
+    by_delta = defaultdict(list)
+    for user_id in {row['user_id'] for row in rows}:
+        by_delta[-unread[user_id]].append(user_id)
+    for delta, user_ids in by_delta.items():
+        bulk_adjust_unread_count(user_ids, delta)
+
+
+def drop_archived_months(keep_months, batch_size=500, today=None):
+    """Delete archived notifications from months older than the last ``keep_months``."""
+    today = today or timezone.now().date()
+    year, month = divmod(today.year * 12 + today.month - 1 - keep_months, 12)
+    cutoff = datetime.date(year, month + 1, 1)
+
+    dropped = 0
+    while True:
+        with transaction.atomic():
+            ids = list(
+                NotificationArchive.objects.filter(month__lt=cutoff).values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            NotificationArchive.objects.filter(id__in=ids).delete()
+        dropped += len(ids)
+    return dropped
+
+
+def fan_out(user_ids, dedupe_key, title, message, notification_type='general', related_url=None, payload=None):
+    """
+    Create one unread notification per user in ``user_ids`` with chunked
+    ``bulk_create``. The text is stored once in a shared NotificationPayload
+    (``payload`` when given, e.g. by an earlier batch of the same fan-out)
+    and each row only references it. Users that already hold a notification
+    with ``dedupe_key`` are skipped, so repeated calls are harmless.
+    Returns the number of notifications created.
+    """
+    user_ids = set(user_ids)
+    created = 0
+
+    for chunk in _chunks(sorted(user_ids), FANOUT_BATCH_SIZE):
+        with transaction.atomic():
+            existing = set(
+                Notification.objects.filter(user_id__in=chunk, dedupe_key=dedupe_key)
+                .values_list('user_id', flat=True)
+            )
+            recipients = [user_id for user_id in chunk if user_id not in existing]
+            if not recipients:
+                continue
+            if payload is None:
+                payload = NotificationPayload.objects.create(
+                    title=title,
+                    message=message,
+                    related_url=related_url
+                )
+            Notification.objects.bulk_create(
+                [
+                    Notification(
+                        user_id=user_id,
+                        payload=payload,
+                        notification_type=notification_type,
+                        dedupe_key=dedupe_key,
+                    )
+                    for user_id in recipients
+                ],
+                ignore_conflicts=True
+            )
+            # A concurrent fan-out may have taken some users first; their rows
+            # reference its own payload, so only count the rows that hold ours
+            inserted = list(
+                Notification.objects.filter(user_id__in=recipients, dedupe_key=dedupe_key, payload=payload)
+                .values_list('user_id', flat=True)
+            )
+            bulk_adjust_unread_count(inserted, 1)
+        created += len(inserted)
+
+    return created
+
+
+def notify_coalesced(user_ids, title, message, summary, notification_type='general', related_url=None):
+    """
+    Notify ``user_ids`` about a bursty event. A user who still has an unread
+    notification with the same type and ``related_url`` from within
+    ``NOTIFICATION_COALESCE_WINDOW`` gets that row bumped instead of a new
+    one: its counter goes up, it moves to the top and its message becomes
+    ``summary`` with ``{count}`` filled in. Returns the number of new rows.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return 0
+    now = timezone.now()
+    window = datetime.timedelta(seconds=getattr(settings, 'NOTIFICATION_COALESCE_WINDOW', 3600))
+
+    with transaction.atomic():
+        existing = {}
+        for notification in (
+            Notification.objects.filter(
+                UNREAD_JOINED,
+                user_id__in=user_ids,
+                notification_type=notification_type,
+                own_related_url=related_url,
+                created_at__gte=now - window
+            ).order_by('created_at').values('id', 'user_id', 'occurrences')
+        ):
+            existing[notification['user_id']] = notification
+
+        for notification in existing.values():
+            count = notification['occurrences'] + 1
+            Notification.objects.filter(id=notification['id']).update(
+                occurrences=count,
+                created_at=now,
+                own_title=title,
+                own_message=summary.replace('{count}', str(count))
+            )
+        bulk_adjust_unread_count(existing.keys(), 0)
+
+        recipients = [user_id for user_id in user_ids if user_id not in existing]
+        Notification.objects.bulk_create([
+            Notification(
+                user_id=user_id,
+                title=title,
+                message=message,
+                notification_type=notification_type,
+                related_url=related_url
+            )
+            for user_id in recipients
+        ])
+        bulk_adjust_unread_count(recipients, 1)
+
+    return len(recipients)
+
+
+def notify_exam_students(exam_id, batch_size=FANOUT_BATCH_SIZE):
+    """
+    Notify every student of the exam's class/section exactly once, one batch
+    of students per transaction. Progress is recorded on the exam's
+    announcement after each batch, so an interrupted run picks up where it
+    stopped. Returns the number of notifications created.
+    """
+    exam = Exam.objects.filter(pk=exam_id).first()
+    if exam is None:
+        return 0
+    announcement, _ = ExamAnnouncement.objects.get_or_create(exam=exam)
+    if announcement.completed_at:
+        return 0
+
+    dedupe_key = f"exam:{exam.pk}"
+    students = Student.objects.filter(
+        student_class=exam.student_class,
+        section=exam.section,
+        user__isnull=False
+    )
+    # Earlier batches already stored the text; keep sharing it
+    payload = NotificationPayload.objects.filter(notifications__dedupe_key=dedupe_key).first()
+    created = 0
+    while True:
+        user_ids = list(
+            students.filter(user_id__gt=announcement.delivered_through)
+            .order_by('user_id')
+            .values_list('user_id', flat=True)[:batch_size]
+        )
+        if not user_ids:
+            break
+        with transaction.atomic():
+            batch = fan_out(
+                user_ids,
+                dedupe_key=dedupe_key,
+                title=f"New Exam: {exam.name}",
+                message=f"A new {exam.name} exam for {exam.subject} is scheduled on {exam.date}",
+                notification_type='exam',
+                related_url=reverse('exam_list'),
+                payload=payload
+            )
+            ExamAnnouncement.objects.filter(pk=announcement.pk).update(
+                delivered_through=user_ids[-1],
+                delivered_count=F('delivered_count') + batch
+            )
+        if payload is None:
+            payload = NotificationPayload.objects.filter(notifications__dedupe_key=dedupe_key).first()
+        announcement.delivered_through = user_ids[-1]
+        created += batch
+    ExamAnnouncement.objects.filter(pk=announcement.pk).update(completed_at=timezone.now())
+    return created
+
+
+def send_exam_notifications(batch_size=FANOUT_BATCH_SIZE):
+    """Work through every unfinished exam announcement; returns ``(exams, notifications)``."""
+    pending = list(ExamAnnouncement.objects.filter(completed_at__isnull=True).values_list('pk', flat=True))
+    return len(pending), sum(notify_exam_students(pk, batch_size=batch_size) for pk in pending)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -0,0 +1,498 @@
+# school/scheduling
+import random
+import time as clock
+from bisect import bisect_left, insort
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import time
+
+from django.contrib.auth import get_user_model
+from django.db.models import Count, Q
+
+from .conflicts import ConflictIndex, Slot
+from .models import Subject, Timetable
+from .timetables import DAYS
+from student.models import Student
+
+# One clash (class, teacher or room double-booked, or a teacher's blocked
+# slot) outweighs any number of a subject's repeats within a day
+HARD_WEIGHT = 1000
+# Steps during which a lesson may not move back to the slot it just left
+TABU_TENURE = 10
+# Share of steps that move a lesson to a random slot to escape local minima
+NOISE = 0.05
+DEFAULT_TIME_LIMIT = 60
+
+
+@dataclass(frozen=True)
+class Requirement:
+    """``periods`` lessons a week of one subject for one class-section, each taught by one of ``teacher_ids``."""
+    student_class: str
+    section: str
+    subject_id: int
+    periods: int
+    teacher_ids: tuple
+    size: int = 0
+
+
+@dataclass
+class Problem:
+    """
+    A week to fill, independent of the database. Slots are numbered through
+    the week, ``len(periods)`` a day; ``unavailable`` (per teacher id) and
+    ``busy_rooms`` (per room name) hold the slots that may not be used.
+    """
+    days: list
+    periods: list
+    rooms: dict
+    requirements: list
+    unavailable: dict = field(default_factory=dict)
+    busy_rooms: dict = field(default_factory=dict)
+
+    @property
+    def slot_count(self):
+        return len(self.days) * len(self.periods)
+
+    def slot_times(self, slot):
+        """``(day, start_time, end_time)`` of a slot number."""
+        day, period = divmod(slot, len(self.periods))
+        return (self.days[day], *self.periods[period])
+
+
+@dataclass(frozen=True)
+class Lesson:
+    requirement: Requirement
+    teacher_id: int
+    slot: int
+    room: str
+
+
+@dataclass
+class Solution:
+    """The placed lessons; ``violations`` counts those still clashing when the search stopped."""
+    lessons: list
+    violations: int
+    steps: int
+    seconds: float
+
+
+class _Bag:
+    """A set with O(1) random choice, for picking the next clashing lesson."""
+
+    def __init__(self):
+        self.items, self.positions = [], {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        last = self.items.pop()
+        if last != item:
+            self.items[position] = last
+            self.positions[last] = position
+
+    def choice(self, rng):
+        return self.items[rng.randrange(len(self.items))]
+
+
+def _assign_teachers(problem):
+    """One teacher per requirement, each going to whichever of its teachers has the most free slots left."""
+    load = defaultdict(int)
+    chosen = [None] * len(problem.requirements)
+    order = sorted(
+        range(len(problem.requirements)),
+        key=lambda index: (len(problem.requirements[index].teacher_ids), -problem.requirements[index].periods)
+    )
+    for index in order:
+        requirement = problem.requirements[index]
+        teacher_id = max(
+            requirement.teacher_ids,
+            key=lambda teacher_id: (
+                problem.slot_count - len(problem.unavailable.get(teacher_id, ())) - load[teacher_id],
+                -teacher_id
+            )
+        )
+        chosen[index] = teacher_id
+        load[teacher_id] += requirement.periods
+    return chosen
+
+
+class _Search:
+    """
+    Min-conflicts local search over lesson placements. Occupancy is kept as
+    sets of lessons per (class, slot), (teacher, slot) and (room, slot), and
+    each slot keeps its free rooms sorted by capacity, so costing a move is
+    O(1) and a lesson takes the smallest free room its class fits in.
+    """
+
+    def __init__(self, problem, rng):
+        self.problem, self.rng = problem, rng
+        self.per_day, self.week = len(problem.periods), problem.slot_count
+        rooms = sorted(problem.rooms.items(), key=lambda item: (item[1], item[0]))
+        self.room_names = [name for name, _ in rooms]
+        self.room_capacity = [capacity for _, capacity in rooms]
+        self.teacher_of = _assign_teachers(problem)
+
+        classes, teachers = {}, {}
+        self.requirement, self.klass, self.teacher, self.size = [], [], [], []
+        for index, requirement in enumerate(problem.requirements):
+            if requirement.size > self.room_capacity[-1]:
+                raise ValueError(f"No room holds {requirement.student_class} {requirement.section}")
+            klass = classes.setdefault((requirement.student_class, requirement.section), len(classes))
+            teacher = teachers.setdefault(self.teacher_of[index], len(teachers))
+            for _ in range(requirement.periods):
+                self.requirement.append(index)
+                self.klass.append(klass)
+                self.teacher.append(teacher)
+                self.size.append(requirement.size)
+
+        lessons = len(self.requirement)
+        self.slot, self.room = [None] * lessons, [None] * lessons
+        self.class_at = [[set() for _ in range(self.week)] for _ in classes]
+        self.teacher_at = [[set() for _ in range(self.week)] for _ in teachers]
+        self.room_at = [[set() for _ in self.room_names] for _ in range(self.week)]
+        self.blocked = [set(problem.unavailable.get(teacher_id, ())) for teacher_id in teachers]
+        self.free = [[(capacity, room) for room, capacity in enumerate(self.room_capacity)]
+                     for _ in range(self.week)]
+        numbers = {name: room for room, name in enumerate(self.room_names)}
+        for name, slots in problem.busy_rooms.items():
+            if name in numbers:
+                for slot in slots:
+                    self._occupy_room(-1, slot, numbers[name])
+        self.same_day = defaultdict(int)
+        self.clashing = _Bag()
+
+    def _occupy_room(self, lesson, slot, room):
+        occupants = self.room_at[slot][room]
+        if not occupants:
+            free = self.free[slot]
+            del free[bisect_left(free, (self.room_capacity[room], room))]
+        occupants.add(lesson)
+
+    def _vacate_room(self, lesson, slot, room):
+        occupants = self.room_at[slot][room]
+        occupants.discard(lesson)
+        if not occupants:
+            insort(self.free[slot], (self.room_capacity[room], room))
+
+    def _room_for(self, lesson, slot):
+        """The smallest free room that fits, else the fitting room with the fewest occupants."""
+        free = self.free[slot]
+        position = bisect_left(free, (self.size[lesson], -1))
+        if position < len(free):
+            return free[position][1]
+        fitting = range(bisect_left(self.room_capacity, self.size[lesson]), len(self.room_names))
+        return min(fitting, key=lambda room: (len(self.room_at[slot][room]), self.rng.random()))
+
+    def cost(self, lesson, slot):
+        klass, teacher = self.klass[lesson], self.teacher[lesson]
+        current = self.slot[lesson] == slot
+        clashes = (
+            len(self.class_at[klass][slot]) + len(self.teacher_at[teacher][slot]) - 2 * current
+            + (slot in self.blocked[teacher])
+        )
+        if current:
+            clashes += len(self.room_at[slot][self.room[lesson]]) > 1
+        else:
+            free = self.free[slot]
+            clashes += not free or free[-1][0] < self.size[lesson]
+        day = slot // self.per_day
+        same_day = self.slot[lesson] is not None and self.slot[lesson] // self.per_day == day
+        repeats = self.same_day[(self.requirement[lesson], day)] - same_day
+        return clashes * HARD_WEIGHT + repeats
+
+    def is_clashing(self, lesson):
+        slot = self.slot[lesson]
+        return (
+            len(self.class_at[self.klass[lesson]][slot]) > 1
+            or len(self.teacher_at[self.teacher[lesson]][slot]) > 1
+            or len(self.room_at[slot][self.room[lesson]]) > 1
+            or slot in self.blocked[self.teacher[lesson]]
+        )
+
+    def _occupants(self, lesson):
+        slot = self.slot[lesson]
+        return (self.class_at[self.klass[lesson]][slot] | self.teacher_at[self.teacher[lesson]][slot]
+                | self.room_at[slot][self.room[lesson]])
+
+    def move(self, lesson, slot):
+        affected = set()
+        old = self.slot[lesson]
+        if old is not None:
+            affected |= self._occupants(lesson)
+            self.class_at[self.klass[lesson]][old].discard(lesson)
+            self.teacher_at[self.teacher[lesson]][old].discard(lesson)
+            self._vacate_room(lesson, old, self.room[lesson])
+            self.same_day[(self.requirement[lesson], old // self.per_day)] -= 1
+        room = self._room_for(lesson, slot)
+        self.slot[lesson], self.room[lesson] = slot, room
+        self.class_at[self.klass[lesson]][slot].add(lesson)
+        self.teacher_at[self.teacher[lesson]][slot].add(lesson)
+        self._occupy_room(lesson, slot, room)
+        self.same_day[(self.requirement[lesson], slot // self.per_day)] += 1
+        affected |= self._occupants(lesson)
+        affected.discard(-1)
+        for other in affected:
+            if self.is_clashing(other):
+                self.clashing.add(other)
+            else:
+                self.clashing.discard(other)
+
+    def best_slot(self, lesson, tabu=None, step=0):
+        best, candidates = None, []
+        for slot in range(self.week):
+            if slot == self.slot[lesson]:
+                continue
+            cost = self.cost(lesson, slot)
+            # A tabu slot is still taken if it removes every clash
+            if tabu and tabu.get((lesson, slot), 0) > step and cost >= HARD_WEIGHT:
+                continue
+            if best is None or cost < best:
+                best, candidates = cost, [slot]
+            elif cost == best:
+                candidates.append(slot)
+        return self.rng.choice(candidates) if candidates else self.rng.randrange(self.week)
+
+    def start(self):
+        """Place every lesson greedily, hardest first: busiest teachers and largest classes."""
+        teacher_load = defaultdict(int)
+        for teacher in self.teacher:
+            teacher_load[teacher] += 1
+        order = sorted(range(len(self.slot)), key=lambda lesson: (
+            -teacher_load[self.teacher[lesson]] - len(self.blocked[self.teacher[lesson]]), -self.size[lesson], lesson
+        ))
+        for lesson in order:
+            self.move(lesson, self.best_slot(lesson))
+
+    def run(self, max_steps, deadline):
+        tabu, steps = {}, 0
+        best = (len(self.clashing), list(self.slot), list(self.room))
+        while self.clashing and steps < max_steps and clock.monotonic() < deadline:
+            steps += 1
+            lesson = self.clashing.choice(self.rng)
+            if self.rng.random() < NOISE:
+                slot = self.rng.randrange(self.week)
+            else:
+                slot = self.best_slot(lesson, tabu, steps)
+            tabu[(lesson, self.slot[lesson])] = steps + TABU_TENURE
+            self.move(lesson, slot)
+            if len(self.clashing) < best[0]:
+                best = (len(self.clashing), list(self.slot), list(self.room))
+        return best, steps
+
+
+def solve(problem, seed=None, time_limit=DEFAULT_TIME_LIMIT, max_steps=None):
+    """
+    Fill ``problem``'s week: a greedy placement repaired by min-conflicts
+    local search with a short tabu list, until nothing clashes, ``max_steps``
+    moves were made or ``time_limit`` seconds passed. Returns the best
+    placement found; check ``violations`` before saving it.
+    """
+    started = clock.monotonic()
+    search = _Search(problem, random.Random(seed))
+    search.start()
+    (violations, slots, rooms), steps = search.run(
+        max_steps if max_steps is not None else float('inf'), started + time_limit
+    )
+    lessons = [
+        Lesson(
+            requirement=problem.requirements[search.requirement[lesson]],
+            teacher_id=search.teacher_of[search.requirement[lesson]],
+            slot=slots[lesson],
+            room=search.room_names[rooms[lesson]]
+        )
+        for lesson in range(len(slots))
+    ]
+    return Solution(lessons, violations, steps, clock.monotonic() - started)
+
+
+def solution_slots(problem, solution):
+    """The solution as Slots, e.g. to check with conflicts.validate_slots; ``ref`` is the lesson's position."""
+    slots = []
+    for position, lesson in enumerate(solution.lessons):
+        day, start_time, end_time = problem.slot_times(lesson.slot)
+        slots.append(Slot(
+            day=day,
+            start_time=start_time,
+            end_time=end_time,
+            student_class=lesson.requirement.student_class,
+            section=lesson.requirement.section,
+            teacher_id=lesson.teacher_id,
+            classroom=lesson.room,
+            ref=position
+        ))
+    return slots
+
+
+def solution_entries(problem, solution):
+    """Unsaved Timetable rows for the solution, ready for timetables.replace_entries."""
+    entries = []
+    for lesson in solution.lessons:
+        day, start_time, end_time = problem.slot_times(lesson.slot)
+        entries.append(Timetable(
+            student_class=lesson.requirement.student_class,
+            section=lesson.requirement.section,
+            subject_id=lesson.requirement.subject_id,
+            teacher_id=lesson.teacher_id,
+            day=day,
+            start_time=start_time,
+            end_time=end_time,
+            classroom=lesson.room
+        ))
+    return entries
+
+
+def _periods(plan):
+    periods = []
+    for period in plan.get('periods') or ():
+        try:
+            start_time, end_time = (time.fromisoformat(str(value)) for value in period)
+        except (TypeError, ValueError):
+            raise ValueError(f"periods must be [start, end] pairs such as [\"08:00\", \"08:45\"], not {period!r}")
+        if end_time <= start_time:
+            raise ValueError(f"period {period!r} ends before it starts")
+        periods.append((start_time, end_time))
+    if not periods:
+        raise ValueError("periods is required")
+    periods.sort()
+    for (_, end_time), (start_time, _) in zip(periods, periods[1:]):
+        if start_time < end_time:
+            raise ValueError("periods must not overlap")
+    return periods
+
+
+def _blocked_slots(problem, names):
+    """Parse ``"Monday"`` (the whole day) or ``"Monday 3"`` (its third period) into slot numbers."""
+    slots = set()
+    for name in names:
+        day, _, period = str(name).partition(' ')
+        if day not in problem.days:
+            raise ValueError(f"unknown day in {name!r}")
+        first = problem.days.index(day) * len(problem.periods)
+        if not period:
+            slots.update(range(first, first + len(problem.periods)))
+        elif period.isdigit() and 1 <= int(period) <= len(problem.periods):
+            slots.add(first + int(period) - 1)
+        else:
+            raise ValueError(f"unknown period in {name!r}")
+    return slots
+
+
+def build_problem(plan):
+    """
+    A Problem from a plan mapping, as read by the generate_timetable command:
+    ``periods``, optional ``days``, ``rooms`` (name to capacity), ``classes``
+    (each a ``student_class``, ``section``, optional ``size`` and ``subjects``
+    mapping subject codes to periods a week) and optional ``unavailable``
+    (teacher email to day or "day period" names). Subject teachers, class
+    sizes and the saved bookings of every other class come from the database.
+    Raises ValueError describing the first problem found.
+    """
+    days = list(plan.get('days') or DAYS)
+    if not set(days) <= set(DAYS):
+        raise ValueError(f"days must be among {', '.join(DAYS)}")
+    rooms = {str(name).strip(): int(capacity) for name, capacity in (plan.get('rooms') or {}).items()}
+    if not rooms:
+        raise ValueError("rooms is required")
+    problem = Problem(days=days, periods=_periods(plan), rooms=rooms, requirements=[])
+
+    classes = plan.get('classes') or []
+    codes = {code for klass in classes for code in klass.get('subjects', {})}
+    subjects = Subject.objects.prefetch_related('teachers').in_bulk(codes, field_name='code')
+    sizes = {
+        (row['student_class'], row['section']): row['total']
+        for row in Student.objects.values('student_class', 'section').annotate(total=Count('pk'))
+    }
+    for klass in classes:
+        student_class, section = klass.get('student_class'), klass.get('section')
+        if not student_class or not section:
+            raise ValueError("every class needs a student_class and section")
+        size = int(klass.get('size') or sizes.get((student_class, section), 0))
+        for code, periods in klass.get('subjects', {}).items():
+            subject = subjects.get(code)
+            if subject is None:
+                raise ValueError(f"unknown subject {code!r}")
+            teacher_ids = tuple(sorted(teacher.pk for teacher in subject.teachers.all()))
+            if not teacher_ids:
+                raise ValueError(f"{subject} has no teachers")
+            problem.requirements.append(Requirement(
+                student_class, section, subject.pk, int(periods), teacher_ids, size
+            ))
+    if not problem.requirements:
+        raise ValueError("classes lists no subjects")
+
+    unavailable = plan.get('unavailable') or {}
+    teachers = dict(get_user_model().objects.filter(email__in=unavailable).values_list('email', 'pk'))
+    for email, names in unavailable.items():
+        if email not in teachers:
+            raise ValueError(f"unknown teacher {email!r}")
+        problem.unavailable[teachers[email]] = _blocked_slots(problem, names)
+
+    # Teachers and rooms stay booked wherever classes outside the plan use them
+    planned = Q()
+    for requirement in problem.requirements:
+        planned |= Q(student_class=requirement.student_class, section=requirement.section)
+    saved = ConflictIndex(
+        Slot.from_entry(entry)
+        for entry in Timetable.objects.filter(day__in=days).exclude(planned).select_related('subject')
+    )
+    teacher_ids = {teacher_id for requirement in problem.requirements for teacher_id in requirement.teacher_ids}
+    for slot in range(problem.slot_count):
+        day, start_time, end_time = problem.slot_times(slot)
+        for teacher_id in teacher_ids:
+            if saved.overlapping('teacher', (day, teacher_id), start_time, end_time):
+                problem.unavailable.setdefault(teacher_id, set()).add(slot)
+        for room in rooms:
+            if saved.overlapping('classroom', (day, room.casefold()), start_time, end_time):
+                problem.busy_rooms.setdefault(room, set()).add(slot)
+    return problem
+
+
+# Weekly periods of each subject in a synthetic school: 36 of its 48 slots
+SYNTHETIC_QUOTAS = (6, 5, 5, 4, 4, 3, 3, 2, 2, 2)
+
+
+def synthetic_problem(sections, seed=0, periods_per_day=8, teacher_load=40, rooms_per_section=0.85):
+    """
+    A made-up school of ``sections`` class-sections for benchmarking: ten
+    subjects, enough teachers per subject for about ``teacher_load`` lessons
+    each, ``rooms_per_section`` rooms per section and two blocked slots per
+    teacher.
+    """
+    rng = random.Random(seed)
+    sizes = [rng.randint(20, 45) for _ in range(sections)]
+    # Room capacities follow the class sizes, so there are about
+    # ``rooms_per_section`` rooms per section at every size, not only overall
+    largest_first = sorted(sizes, reverse=True)
+    rooms = max(1, round(sections * rooms_per_section))
+    problem = Problem(
+        days=list(DAYS),
+        periods=[(time(8 + period), time(8 + period, 45)) for period in range(periods_per_day)],
+        rooms={
+            f"Room {room + 1}": -(-largest_first[int(room / rooms_per_section)] // 5) * 5
+            for room in range(rooms)
+        },
+        requirements=[]
+    )
+    teacher_id = 0
+    pools = []
+    for quota in SYNTHETIC_QUOTAS:
+        count = -(-sections * quota // teacher_load) + 1
+        pools.append(tuple(range(teacher_id + 1, teacher_id + count + 1)))
+        teacher_id += count
+    for teacher in range(1, teacher_id + 1):
+        problem.unavailable[teacher] = set(rng.sample(range(problem.slot_count), 2))
+    for section, size in enumerate(sizes):
+        for subject, (quota, pool) in enumerate(zip(SYNTHETIC_QUOTAS, pools), start=1):
+            problem.requirements.append(Requirement(
+                f"Class {section // 4 + 1}", "ABCD"[section % 4], subject, quota, pool, size
+            ))
+    return problem
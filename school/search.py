@@ -0,0 +1,145 @@
+# school/search
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+
+from .models import MailboxEntry, Message
+
+SEARCH_TABLE = 'school_message_fts'
+SEARCH_PAGE_SIZE = 20
+REBUILD_BATCH_SIZE = 500
+# Column weights for bm25(), in table order: subject, body, sender, attachments
+SEARCH_WEIGHTS = (10.0, 1.0, 5.0, 2.0)
+# Private-use markers around matched terms, swapped for <mark> once escaped
+_HIT_START, _HIT_END = '\ue000', '\ue001'
+
+
+def fts_enabled():
+    return connection.vendor == 'sqlite'
+
+
+def match_expression(query):
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix."""
+    terms = [f'"{term}"' for term in re.findall(r'\w+', query)]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _documents(message_ids):
+    messages = Message.objects.filter(pk__in=message_ids).select_related('sender').prefetch_related('attachments')
+    return [
+        (
+            message.pk,
+            message.subject,
+            message.body,
+            message.sender.get_full_name() or message.sender.username,
+            ' '.join(attachment.filename() for attachment in message.attachments.all()),
+        )
+        for message in messages
+    ]
+
+
+def unindex_messages(message_ids):
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(pk,) for pk in message_ids])
+
+
+def index_messages(message_ids):
+    """(Re)index the given messages; ids that no longer exist are dropped."""
+    if not fts_enabled():
+        return
+    message_ids = list(message_ids)
+    unindex_messages(message_ids)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, subject, body, sender_name, attachment_names) "
+            "VALUES (%s, %s, %s, %s, %s)",
+            _documents(message_ids)
+        )
+
+
+def rebuild_search_index(batch_size=REBUILD_BATCH_SIZE):
+    """Reindex every message from scratch; returns the number indexed."""
+    if not fts_enabled():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+    indexed, last_id = 0, 0
+    while True:
+        ids = list(
+            Message.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return indexed
+        index_messages(ids)
+        indexed += len(ids)
+        last_id = ids[-1]
+
+
+def matching_messages(queryset, query):
+    """Narrow ``queryset`` to messages matching ``query``, unranked; used by the admin."""
+    expression = match_expression(query)
+    if not expression:
+        return queryset.none()
+    if not fts_enabled():
+        return queryset.filter(Q(subject__icontains=query) | Q(body__icontains=query))
+    return queryset.filter(
+        pk__in=RawSQL(f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s", [expression])
+    )
+
+
+def _highlight(snippet):
+    return escape(snippet).replace(_HIT_START, '<mark>').replace(_HIT_END, '</mark>')
+
+
+def search_messages(user, query, page=1, per_page=SEARCH_PAGE_SIZE):
+    """
+    Best-ranked messages matching ``query`` within ``user``'s conversations.
+    Returns ``(messages, has_next)``; each message carries an HTML-safe
+    ``snippet`` with the matched terms marked.
+    """
+    expression = match_expression(query)
+    if not expression:
+        return [], False
+    offset = (page - 1) * per_page
+    threads = MailboxEntry.objects.filter(user=user).values('message_id')
+
+    if not fts_enabled():
+        messages = list(
+            Message.objects.filter(Q(subject__icontains=query) | Q(body__icontains=query), thread_root__in=threads)
+            .select_related('sender')
+            .order_by('-sent_at')[offset:offset + per_page + 1]
+        )
+        for message in messages:
+            message.snippet = escape(message.body[:200])
+        return messages[:per_page], len(messages) > per_page
+
+    weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT {SEARCH_TABLE}.rowid, snippet({SEARCH_TABLE}, -1, %s, %s, '...', 16)
+            FROM {SEARCH_TABLE}
+            JOIN {Message._meta.db_table} AS m ON m.id = {SEARCH_TABLE}.rowid
+            WHERE {SEARCH_TABLE} MATCH %s
+              AND m.thread_root_id IN (SELECT message_id FROM {MailboxEntry._meta.db_table} WHERE user_id = %s)
+            ORDER BY bm25({SEARCH_TABLE}, {weights})
+            LIMIT %s OFFSET %s
+            """,
+            [_HIT_START, _HIT_END, expression, user.pk, per_page + 1, offset]
+        )
+        rows = cursor.fetchall()
+
+    found = Message.objects.select_related('sender').in_bulk([pk for pk, _ in rows[:per_page]])
+    messages = []
+    for pk, snippet in rows[:per_page]:
+        if pk in found:
+            found[pk].snippet = _highlight(snippet)
+            messages.append(found[pk])
+    return messages, len(rows) > per_page
@@ -1,24 +1,123 @@
 # school/signals
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
-from .models import Exam, Notification
-from student.models import Student
-from django.urls import reverse
+from .attachments import release_blob
+from .availability import forget_days, record_entry
+from .mailbox import detach_thread, promote_thread_root, refresh_participant_count, refresh_thread_summary
+from .models import Exam, ExamAnnouncement, Message, MessageAttachment, Notification, Subject, Timetable
+from .notifications import UNREAD_JOINED, adjust_unread_count, is_unread
+from .search import index_messages, unindex_messages
+from .timetables import DAYS, entry_owners, invalidate_grids
 
 @receiver(post_save, sender=Exam)
-def create_exam_notification(sender, instance, created, **kwargs):
-    if created:
-        students = Student.objects.filter(
-            student_class=instance.student_class,
-            section=instance.section
-        ).select_related('user')
-        
-        for student in students:
-            if student.user:
-                Notification.objects.create(
-                    user=student.user,
-                    title=f"New Exam: {instance.name}",
-                    message=f"A new {instance.name} exam for {instance.subject} is scheduled on {instance.date}",
-                    notification_type='exam',
-                    related_url=reverse('exam_list')
-                )
\ No newline at end of file
+def create_exam_notification(sender, instance, created, raw=False, **kwargs):
+    # Queued with the exam; `manage.py send_exam_notifications` fans it out
+    if created and not raw:
+        ExamAnnouncement.objects.create(exam=instance)
+
+@receiver(pre_save, sender=Notification)
+def remember_notification_read_state(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding:
+        instance._was_unread = False
+    else:
+        instance._was_unread = Notification.objects.filter(UNREAD_JOINED, pk=instance.pk).exists()
+
+@receiver(post_save, sender=Notification)
+def update_unread_notification_count(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    now_unread = not instance.is_read if created else is_unread(instance)
+    delta = int(now_unread) - int(getattr(instance, '_was_unread', False))
+    adjust_unread_count(instance.user_id, delta)
+
+@receiver(m2m_changed, sender=Message.recipients.through)
+def update_thread_participants(sender, instance, action, reverse=False, pk_set=None, **kwargs):
+    if reverse and action == 'pre_clear':
+        # Remember the user's threads before the rows disappear
+        instance._cleared_thread_ids = set(instance.received_messages.values_list('thread_root_id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        root_ids = {instance.thread_root_id}
+    elif action == 'post_clear':
+        root_ids = getattr(instance, '_cleared_thread_ids', set())
+    else:
+        root_ids = set(Message.objects.filter(pk__in=pk_set).values_list('thread_root_id', flat=True))
+    for root_id in root_ids - {None}:
+        refresh_participant_count(root_id)
+
+@receiver(pre_delete, sender=Message)
+def remember_thread_replies(sender, instance, **kwargs):
+    # Deleting a root must not take the rest of the conversation with it
+    instance._detached_thread = detach_thread(instance) if instance.thread_root_id == instance.pk else None
+
+@receiver(post_delete, sender=Message)
+def update_thread_after_delete(sender, instance, **kwargs):
+    if instance.thread_root_id not in (None, instance.pk):
+        refresh_thread_summary(instance.thread_root_id)
+    elif getattr(instance, '_detached_thread', None):
+        promote_thread_root(instance._detached_thread)
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_messages([instance.pk])
+
+@receiver(post_delete, sender=Message)
+def unindex_message(sender, instance, **kwargs):
+    unindex_messages([instance.pk])
+
+@receiver(post_save, sender=MessageAttachment)
+@receiver(post_delete, sender=MessageAttachment)
+def index_attachment_names(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_messages([instance.message_id])
+
+@receiver(post_delete, sender=MessageAttachment)
+def release_attachment_blob(sender, instance, **kwargs):
+    if instance.blob_id:
+        release_blob(instance.blob_id)
+
+
+def _invalidate_grids_on_commit(owners):
+    # After commit, so a concurrent request cannot cache the old rows again
+    transaction.on_commit(lambda: invalidate_grids(owners))
+
+@receiver(pre_save, sender=Timetable)
+def remember_timetable_owners(sender, instance, raw=False, **kwargs):
+    # An entry moved to another class, teacher or day leaves its old grids and map stale too
+    previous = None
+    if not (raw or instance._state.adding):
+        previous = Timetable.objects.filter(pk=instance.pk).values('student_class', 'section', 'teacher_id', 'day').first()
+    instance._previous_day = previous.pop('day') if previous else None
+    instance._previous_owners = entry_owners(**previous) if previous else set()
+
+@receiver(post_save, sender=Timetable)
+@receiver(post_delete, sender=Timetable)
+def invalidate_timetable_grids(sender, instance, **kwargs):
+    owners = entry_owners(instance.student_class, instance.section, instance.teacher_id)
+    _invalidate_grids_on_commit(owners | getattr(instance, '_previous_owners', set()))
+
+@receiver(post_save, sender=Timetable)
+def record_timetable_entry(sender, instance, raw=False, **kwargs):
+    if raw:
+        # Fixtures do not say which day a row was on before
+        transaction.on_commit(lambda: forget_days(DAYS))
+        return
+    pk, previous_day = instance.pk, getattr(instance, '_previous_day', None)
+    entry = (instance.day, instance.teacher_id, instance.classroom, instance.start_time, instance.end_time)
+    transaction.on_commit(lambda: record_entry(pk, previous_day, entry))
+
+@receiver(post_delete, sender=Timetable)
+def forget_timetable_entry(sender, instance, **kwargs):
+    pk, day = instance.pk, instance.day
+    transaction.on_commit(lambda: record_entry(pk, day))
+
+@receiver(post_save, sender=Subject)
+def invalidate_subject_grids(sender, instance, created=False, raw=False, **kwargs):
+    if created or raw:
+        return
+    entries = Timetable.objects.filter(subject=instance).values_list('student_class', 'section', 'teacher_id').distinct()
+    _invalidate_grids_on_commit(set().union(*(entry_owners(*entry) for entry in entries)))
@@ -1,8 +1,10 @@
 # school/templatetags/message_tags
 from django import template
 
+from school.mailbox import get_unread_message_count
+
 register = template.Library()
 
 @register.filter
 def unread_messages(user):
-    return user.received_messages.filter(is_read=False).count()
\ No newline at end of file
+    return get_unread_message_count(user)
\ No newline at end of file
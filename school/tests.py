@@ -1,3 +1,1203 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.shortcuts import resolve_url
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from home_auth.models import CustomUser, PasswordResetRequest
+from student.models import Parent, Student
+from .attachments import attach_files, collect_blobs
+from .availability import busy_teacher_ids, free_rooms, minute_mask
+from .checks import check_shared_cache
+from .conflicts import ConflictIndex, Slot, validate_slots
+from .events import get_broker, publish
+from .forms import TimetableForm
+from .mailbox import (
+    admin_messages, deliver, deliver_broadcast, get_unread_message_count, mailbox_entries, mark_thread_read,
+    thread_messages
+)
+from .models import (
+    AttachmentBlob, Broadcast, Exam, ExamAnnouncement, Holiday, MailboxEntry, Message, Notification,
+    NotificationArchive, NotificationPayload, NotificationState, Subject, ThreadSummary, Timetable
+)
+from .notifications import (
+    drop_archived_months, fan_out, get_state, get_unread_count, mark_as_read, notification_facets, notification_page,
+    notify_exam_students, prune_notifications, reconcile_unread_counts, send_exam_notifications, unread_payload
+)
+from .scheduling import build_problem, solution_slots, solve, synthetic_problem
+from .search import matching_messages, search_messages
+from .timetables import HolidayCalendar, build_grid, class_grid, occurrences, teacher_grid, upcoming_sessions
+from .views import _notification_events
+
+
+class HotQueryPlanTests(TestCase):
+    """
+    Run EXPLAIN QUERY PLAN on the hot querysets and fail if SQLite falls back
+    to scanning the table instead of searching one of its indexes.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='plan', email='plan@example.com')
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoTableScan(self, queryset):
+        if connection.vendor != 'sqlite':
+            self.skipTest("query plan checks target SQLite")
+        table = queryset.model._meta.db_table
+        plan = self.query_plan(queryset)
+        scans = [step for step in plan if step.startswith(f"SCAN {table}")]
+        self.assertFalse(scans, f"{table} is scanned: {plan}")
+
+    def test_unread_notifications(self):
+        self.assertNoTableScan(
+            Notification.objects.filter(user=self.user, is_read=False).order_by('-created_at')[:5]
+        )
+
+    def test_exams_for_class_section(self):
+        self.assertNoTableScan(
+            Exam.objects.filter(student_class='Class 1', section='A', date__gte='2025-01-01')
+        )
+
+    def test_teacher_timetable(self):
+        self.assertNoTableScan(
+            Timetable.objects.filter(teacher=self.user).order_by('day', 'start_time')
+        )
+
+    def test_class_section_timetable(self):
+        self.assertNoTableScan(
+            Timetable.objects.filter(student_class='Class 1', section='A').order_by('day', 'start_time')
+        )
+
+    def test_students_for_class_section(self):
+        self.assertNoTableScan(
+            Student.objects.filter(student_class='Class 1', section='A')
+        )
+
+    def test_message_replies(self):
+        self.assertNoTableScan(
+            Message.objects.filter(parent_id=1).order_by('-sent_at')
+        )
+
+    def test_mailbox_folders(self):
+        for folder in ('all', 'inbox', 'sent', 'archived'):
+            with self.subTest(folder=folder):
+                self.assertNoTableScan(mailbox_entries(self.user, folder)[:10])
+
+    def test_unread_message_count(self):
+        self.assertNoTableScan(
+            MailboxEntry.objects.filter(user=self.user, is_received=True, is_read=False)
+        )
+
+    def test_thread_messages(self):
+        self.assertNoTableScan(
+            Message.objects.filter(thread_root_id=1).order_by('path')
+        )
+
+    def test_admin_message_browser(self):
+        # An unfiltered page walks the sent_at index in order and stops at the limit
+        if connection.vendor != 'sqlite':
+            self.skipTest("query plan checks target SQLite")
+        plan = self.query_plan(admin_messages()[:25])
+        self.assertIn('SCAN school_message USING INDEX message_sent_idx', plan)
+        self.assertFalse([step for step in plan if 'TEMP B-TREE' in step], plan)
+
+    def test_password_reset_token(self):
+        self.assertNoTableScan(
+            PasswordResetRequest.objects.filter(token='x' * 32)
+        )
+
+
+class UnreadCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='reader', email='reader@example.com')
+
+    def test_counter_follows_writes_and_reconciles(self):
+        first = Notification.objects.create(user=self.user, title='One', message='1')
+        second = Notification.objects.create(user=self.user, title='Two', message='2')
+        self.assertEqual(get_unread_count(self.user), 2)
+        mark_as_read(self.user, first.id)
+        second.delete()
+        self.assertEqual(get_unread_count(self.user), 0)
+
+        Notification.objects.create(user=self.user, title='Three', message='3')
+        NotificationState.objects.filter(user=self.user).update(unread_count=7)
+        self.assertEqual(reconcile_unread_counts(), (1, 1))
+        self.assertEqual(get_unread_count(self.user), 1)
+
+    def test_fan_out_counts_only_rows_it_inserted(self):
+        other = CustomUser.objects.create(username='other', email='other@example.com')
+        create_payload = NotificationPayload.objects.create
+
+        def racing_create(**kwargs):
+            # Another fan-out with the same key gets to ``other`` first
+            Notification.objects.create(user=other, message='raced', dedupe_key='exam:1')
+            return create_payload(**kwargs)
+
+        with mock.patch.object(NotificationPayload.objects, 'create', side_effect=racing_create):
+            created = fan_out([self.user.pk, other.pk], 'exam:1', 'Exam', 'Soon')
+        self.assertEqual(created, 1)
+        self.assertEqual((get_unread_count(self.user), get_unread_count(other)), (1, 1))
+        self.assertEqual(fan_out([self.user.pk, other.pk], 'exam:1', 'Exam', 'Soon'), 0)
+        self.assertEqual(get_unread_count(self.user), 1)
+
+
+class NotificationStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='streamer', email='streamer@example.com')
+
+    def test_wsgi_requests_fall_back_to_polling(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/notifications/stream/').status_code, 204)
+
+    async def test_stream_sends_a_fresh_payload_when_published(self):
+        events = _notification_events(self.user)
+        first = await events.__anext__()
+        self.assertTrue(first.startswith('event: notifications\n'))
+        self.assertEqual(json.loads(first.split('data: ', 1)[1])['unread_count'], 0)
+
+        await sync_to_async(Notification.objects.create)(user=self.user, title='Ping', message='p')
+        publish([self.user.pk])
+        second = await asyncio.wait_for(events.__anext__(), timeout=5)
+        self.assertEqual(json.loads(second.split('data: ', 1)[1])['unread_count'], 1)
+
+        await events.aclose()
+        self.assertNotIn(self.user.pk, get_broker()._subscribers)
+
+
+class UnreadCountETagTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='poller', email='poller@example.com')
+
+    def test_unchanged_counter_answers_not_modified(self):
+        self.client.force_login(self.user)
+        first = self.client.get('/notifications/unread-count/')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json(), {'count': 0})
+        etag = first['ETag']
+
+        self.assertEqual(self.client.get('/notifications/unread-count/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Notification.objects.create(user=self.user, title='Ping', message='p')
+        changed = self.client.get('/notifications/unread-count/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.json(), {'count': 1})
+        self.assertNotEqual(changed['ETag'], etag)
+
+
+class NotificationPageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='reader', email='reader@example.com')
+        start = timezone.now() - datetime.timedelta(hours=1)
+        for minute, notification_type in enumerate(['exam', 'general', 'exam', 'assignment', 'exam']):
+            notification = Notification.objects.create(
+                user=cls.user,
+                title=f'N{minute}',
+                message='m',
+                notification_type=notification_type
+            )
+            Notification.objects.filter(pk=notification.pk).update(created_at=start + datetime.timedelta(minutes=minute))
+        # Two rows sharing a timestamp must still be split by id, not skipped
+        Notification.objects.filter(own_title='N1').update(created_at=start + datetime.timedelta(minutes=2))
+        mark_as_read(cls.user, Notification.objects.get(own_title='N0').pk)
+
+    def test_keyset_pages_visit_every_row_once_newest_first(self):
+        seen, cursor = [], None
+        while True:
+            page, cursor = notification_page(self.user, cursor=cursor, per_page=2)
+            seen.extend(page)
+            if cursor is None:
+                break
+        expected = list(Notification.objects.filter(user=self.user).order_by('-created_at', '-id'))
+        self.assertEqual(seen, expected)
+
+    def test_filters_combine_with_the_cursor(self):
+        page, cursor = notification_page(self.user, status='unread', notification_type='exam', per_page=1)
+        self.assertEqual([n.title for n in page], ['N4'])
+        page, cursor = notification_page(self.user, status='unread', notification_type='exam', cursor=cursor, per_page=1)
+        self.assertEqual([n.title for n in page], ['N2'])
+        self.assertIsNone(cursor)
+        self.assertEqual(notification_page(self.user, cursor='garbage')[0][0].title, 'N4')
+
+    def test_facets_come_from_one_query(self):
+        state = get_state(self.user)
+        with self.assertNumQueries(1):
+            facets = notification_facets(self.user, state)
+        self.assertEqual(facets['total'], 5)
+        self.assertEqual(facets['unread'], 4)
+        self.assertEqual(facets['read'], 1)
+        self.assertEqual(facets['exam'], 3)
+        self.assertEqual(facets['assignment'], 1)
+
+
+class NotificationPruneTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='hoarder', email='hoarder@example.com')
+        cls.now = timezone.now()
+
+    def notify(self, title, days_ago, read=False):
+        notification = Notification.objects.create(user=self.user, title=title, message='m')
+        if read:
+            mark_as_read(self.user, notification.pk)
+        Notification.objects.filter(pk=notification.pk).update(created_at=self.now - datetime.timedelta(days=days_ago))
+
+    def test_prune_archives_expired_rows_and_keeps_the_counter(self):
+        self.notify('old read', 40, read=True)
+        self.notify('old unread', 40)
+        self.notify('ancient unread', 100)
+        self.notify('new read', 1, read=True)
+        self.assertEqual(get_unread_count(self.user), 2)
+
+        pruned = prune_notifications(read_days=30, all_days=90, batch_size=1, now=self.now)
+
+        self.assertEqual(pruned, 2)
+        self.assertCountEqual(
+            Notification.objects.filter(user=self.user).values_list('own_title', flat=True),
+            ['old unread', 'new read']
+        )
+        archived = {row.title: row for row in NotificationArchive.objects.filter(user=self.user)}
+        self.assertEqual(set(archived), {'old read', 'ancient unread'})
+        self.assertTrue(archived['old read'].is_read)
+        self.assertFalse(archived['ancient unread'].is_read)
+        self.assertEqual(archived['old read'].month, archived['old read'].created_at.date().replace(day=1))
+        self.assertEqual(get_unread_count(self.user), 1)
+
+    def test_rows_behind_the_watermark_count_as_read(self):
+        self.notify('seen', 40)
+        mark_as_read(self.user)
+        self.assertEqual(prune_notifications(read_days=30, archive=False, now=self.now), 1)
+        self.assertFalse(NotificationArchive.objects.exists())
+        self.assertEqual(get_unread_count(self.user), 0)
+
+    def test_drop_archived_months_keeps_the_recent_ones(self):
+        for month in (datetime.date(2024, 1, 1), datetime.date(2024, 3, 1), datetime.date(2024, 4, 1)):
+            NotificationArchive.objects.create(
+                month=month,
+                user=self.user,
+                message='m',
+                created_at=datetime.datetime(month.year, month.month, 2, tzinfo=datetime.timezone.utc)
+            )
+        self.assertEqual(drop_archived_months(2, today=datetime.date(2024, 5, 20)), 1)
+        self.assertEqual(
+            sorted(NotificationArchive.objects.values_list('month', flat=True)),
+            [datetime.date(2024, 3, 1), datetime.date(2024, 4, 1)]
+        )
+
+
+class NotificationPayloadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            CustomUser.objects.create(username=f'pupil{n}', email=f'pupil{n}@example.com') for n in range(3)
+        ]
+
+    def test_fan_out_stores_the_text_once(self):
+        fan_out([user.pk for user in self.users], 'notice:1', 'Notice', 'School closes early', related_url='/notices/1/')
+        self.assertEqual(NotificationPayload.objects.count(), 1)
+        notifications = list(Notification.objects.select_related('payload'))
+        self.assertEqual(len(notifications), 3)
+        for notification in notifications:
+            self.assertEqual((notification.own_title, notification.own_message), ('', ''))
+            self.assertEqual(notification.title, 'Notice')
+            self.assertEqual(notification.message, 'School closes early')
+            self.assertEqual(notification.related_url, '/notices/1/')
+        self.assertEqual(unread_payload(self.users[0])['notifications'][0]['title'], 'Notice')
+
+    def test_own_text_still_wins_over_the_payload(self):
+        notification = Notification.objects.create(user=self.users[0], title='Direct', message='Just for you')
+        self.assertIsNone(notification.payload_id)
+        self.assertEqual(Notification.objects.get(pk=notification.pk).title, 'Direct')
+
+    def test_pruning_archives_payload_text_and_drops_unused_payloads(self):
+        fan_out([self.users[0].pk], 'notice:2', 'Notice', 'Old news')
+        Notification.objects.update(created_at=timezone.now() - datetime.timedelta(days=100))
+        prune_notifications(all_days=90)
+        self.assertEqual(NotificationArchive.objects.get().message, 'Old news')
+        self.assertFalse(NotificationPayload.objects.exists())
+
+
+class MarkAllReadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(username='skimmer', email='skimmer@example.com')
+
+    def test_watermark_reads_everything_without_rewriting_rows(self):
+        older = [Notification.objects.create(user=self.user, title=f'N{n}', message='m') for n in range(3)]
+        mark_as_read(self.user)
+
+        self.assertEqual(get_unread_count(self.user), 0)
+        self.assertEqual(Notification.objects.filter(user=self.user, is_read=False).count(), 3)
+        self.assertEqual(mark_as_read(self.user, older[0].pk), 0)
+        page, _ = notification_page(self.user)
+        self.assertTrue(all(notification.is_read for notification in page))
+        self.assertEqual(notification_page(self.user, status='unread')[0], [])
+
+        newer = Notification.objects.create(user=self.user, title='New', message='m')
+        self.assertEqual(get_unread_count(self.user), 1)
+        self.assertEqual([n.pk for n in notification_page(self.user, status='unread')[0]], [newer.pk])
+        self.assertEqual(notification_facets(self.user)['unread'], 1)
+
+        older[1].delete()
+        self.assertEqual(get_unread_count(self.user), 1)
+        self.assertEqual(mark_as_read(self.user, newer.pk), 1)
+        self.assertEqual(reconcile_unread_counts(), (1, 0))
+
+    def test_mark_all_view_moves_the_watermark(self):
+        Notification.objects.create(user=self.user, title='N', message='m')
+        self.client.force_login(self.user)
+        response = self.client.post('/notifications/mark-as-read/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(NotificationState.objects.get(user=self.user).last_read_at)
+        self.assertEqual(get_unread_count(self.user), 0)
+
+
+def make_student(username, student_class='Class 1', section='A'):
+    user = CustomUser.objects.create(username=username, email=f'{username}@example.com', is_student=True)
+    parent = Parent.objects.create(
+        father_name='F', father_occupation='O', father_email=f'{username}.f@example.com', father_mobile='1',
+        mother_name='M', mother_mobile='2', mother_email=f'{username}.m@example.com',
+        present_address='A', permanent_address='A'
+    )
+    Student.objects.create(
+        first_name=username, last_name='S', student_id=username, gender='Male',
+        date_of_birth=datetime.date(2010, 1, 1), student_class=student_class, section=section,
+        joining_date=datetime.date(2020, 1, 1), admission_number=username, parent=parent, user=user
+    )
+    return user
+
+
+def send_message(sender, recipient, parent=None, subject='Trip', body='...'):
+    message = Message.objects.create(sender=sender, subject=subject, body=body, parent=parent)
+    message.recipients.set([recipient])
+    deliver(message)
+    return message
+
+
+class MailboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        cls.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+
+    def folder(self, user, folder):
+        return [entry.message_id for entry in mailbox_entries(user, folder)]
+
+    def test_thread_summary_follows_replies(self):
+        root = send_message(self.alice, self.bob)
+        reply = send_message(self.bob, self.alice, parent=root)
+        summary = ThreadSummary.objects.get(root=root)
+        self.assertEqual((summary.reply_count, summary.participant_count), (1, 2))
+        self.assertEqual((summary.last_sender_id, summary.last_activity_at), (self.bob.pk, reply.sent_at))
+
+        reply.delete()
+        summary.refresh_from_db()
+        self.assertEqual((summary.reply_count, summary.last_sender_id), (0, self.alice.pk))
+        self.assertEqual(MailboxEntry.objects.get(user=self.bob, message=root).last_activity_at, root.sent_at)
+
+    def test_folders_sort_by_latest_activity(self):
+        older = send_message(self.alice, self.bob, subject='Older')
+        newer = send_message(self.alice, self.bob, subject='Newer')
+        self.assertEqual(self.folder(self.alice, 'sent'), [newer.pk, older.pk])
+        self.assertEqual(self.folder(self.alice, 'inbox'), [])
+        self.assertEqual(self.folder(self.bob, 'inbox'), [newer.pk, older.pk])
+        self.assertEqual(get_unread_message_count(self.bob), 2)
+
+        send_message(self.bob, self.alice, parent=older)
+        self.assertEqual(self.folder(self.bob, 'all'), [older.pk, newer.pk])
+        self.assertEqual(self.folder(self.alice, 'inbox'), [older.pk])
+        self.assertEqual(self.folder(self.bob, 'sent'), [])
+        # Replying reads the thread for its sender
+        self.assertEqual(get_unread_message_count(self.bob), 1)
+
+        mark_thread_read(self.bob, newer)
+        self.assertEqual(get_unread_message_count(self.bob), 0)
+
+    def test_archiving_is_per_user_until_a_reply_arrives(self):
+        root = send_message(self.alice, self.bob)
+        self.client.force_login(self.bob)
+        self.client.post(reverse('archive_message', args=[root.pk]))
+        self.assertEqual(self.folder(self.bob, 'all'), [])
+        self.assertEqual(self.folder(self.bob, 'archived'), [root.pk])
+        self.assertEqual(self.folder(self.alice, 'all'), [root.pk])
+
+        mark_thread_read(self.bob, root)
+        send_message(self.alice, self.bob, parent=root)
+        self.assertEqual(self.folder(self.bob, 'inbox'), [root.pk])
+        self.assertEqual(get_unread_message_count(self.bob), 1)
+
+        self.client.post(reverse('archive_message', args=[root.pk]))
+        self.client.post(reverse('archive_message', args=[root.pk]), {'archived': '0'})
+        self.assertEqual(self.folder(self.bob, 'archived'), [])
+
+
+class MediaRootMixin:
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root, ATTACHMENT_UPLOAD_DIR=os.path.join(media_root, 'parts'))
+        media.enable()
+        self.addCleanup(media.disable)
+
+
+class AttachmentBlobTests(MediaRootMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        cls.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+
+    def attach(self, content, name='notes.txt'):
+        message = send_message(self.alice, self.bob)
+        attach_files(message, [SimpleUploadedFile(name, content)])
+        return message.attachments.get()
+
+    def test_identical_uploads_share_one_blob(self):
+        first = self.attach(b'same bytes', 'a.txt')
+        second = self.attach(b'same bytes', 'b.txt')
+        other = self.attach(b'other bytes')
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertNotEqual(first.blob_id, other.blob_id)
+        self.assertEqual(AttachmentBlob.objects.get(pk=first.blob_id).ref_count, 2)
+        self.assertEqual((first.name, second.name), ('a.txt', 'b.txt'))
+
+    def test_blob_is_deleted_with_its_last_reference(self):
+        first = self.attach(b'same bytes')
+        second = self.attach(b'same bytes')
+        blob = first.blob
+        with self.captureOnCommitCallbacks(execute=True):
+            first.message.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(blob.file.storage.exists(blob.file.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(AttachmentBlob.objects.exists())
+        self.assertFalse(blob.file.storage.exists(blob.file.name))
+
+    def test_collect_blobs_repairs_counts_and_drops_orphans(self):
+        kept = self.attach(b'kept').blob
+        orphan = self.attach(b'orphan').blob
+        AttachmentBlob.objects.filter(pk=kept.pk).update(ref_count=5)
+        AttachmentBlob.objects.filter(pk=orphan.pk).update(ref_count=1)
+        # Drop the attachment row without its delete signal, as a crash mid-delete would
+        orphan.attachments.all()._raw_delete(orphan.attachments.db)
+
+        self.assertEqual(collect_blobs(), (2, 1))
+        self.assertEqual(AttachmentBlob.objects.get().ref_count, 1)
+        self.assertFalse(orphan.file.storage.exists(orphan.file.name))
+        self.assertEqual(collect_blobs(), (0, 0))
+
+
+class AttachmentDownloadTests(MediaRootMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        cls.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        cls.carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+
+    def setUp(self):
+        super().setUp()
+        message = send_message(self.alice, self.bob)
+        attach_files(message, [SimpleUploadedFile('digits.txt', b'0123456789')])
+        self.attachment = message.attachments.get()
+        self.url = reverse('download_attachment', args=[self.attachment.pk])
+
+    def get(self, user, **headers):
+        self.client.force_login(user)
+        response = self.client.get(self.url, headers=headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_only_participants_may_download(self):
+        self.assertEqual(self.get(self.bob)[1], b'0123456789')
+        self.assertEqual(self.get(self.alice)[0].status_code, 200)
+        self.assertEqual(self.get(self.carol)[0].status_code, 403)
+
+    def test_sender_may_download_draft_attachments(self):
+        draft = Message.objects.create(sender=self.alice, subject='', body='', is_draft=True)
+        attach_files(draft, [SimpleUploadedFile('draft.txt', b'draft')])
+        self.url = reverse('download_attachment', args=[draft.attachments.get().pk])
+        self.assertEqual(self.get(self.alice)[1], b'draft')
+        self.assertEqual(self.get(self.bob)[0].status_code, 403)
+
+    def test_ranges_and_conditional_requests(self):
+        response, body = self.get(self.bob, Range='bytes=2-5')
+        self.assertEqual((response.status_code, body), (206, b'2345'))
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        etag = response['ETag']
+
+        response, body = self.get(self.bob, Range='bytes=-3')
+        self.assertEqual((response.status_code, body), (206, b'789'))
+        response, body = self.get(self.bob, Range='bytes=4-', **{'If-Range': etag})
+        self.assertEqual((response.status_code, body), (206, b'456789'))
+        response, body = self.get(self.bob, Range='bytes=4-', **{'If-Range': '"stale"'})
+        self.assertEqual((response.status_code, body), (200, b'0123456789'))
+
+        response, _ = self.get(self.bob, Range='bytes=20-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */10'))
+        self.assertEqual(self.get(self.bob, **{'If-None-Match': etag})[0].status_code, 304)
+
+
+class ChunkedUploadTests(MediaRootMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        cls.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+
+    def put_chunk(self, url, offset, data, checksum=None):
+        return self.client.post(
+            url,
+            data,
+            content_type='application/octet-stream',
+            headers={'Upload-Offset': str(offset), 'Upload-Checksum': checksum or hashlib.sha256(data).hexdigest()}
+        )
+
+    def test_chunks_must_continue_where_the_upload_left_off(self):
+        content = b'0123456789'
+        self.client.force_login(self.alice)
+        started = self.client.post(reverse('start_attachment_upload'), {
+            'filename': 'digits.txt',
+            'size': len(content),
+            'sha256': hashlib.sha256(content).hexdigest()
+        })
+        self.assertEqual(started.status_code, 201)
+        url = reverse('attachment_upload', args=[started.json()['upload_id']])
+
+        self.assertEqual(self.put_chunk(url, 0, content[:4]).json()['offset'], 4)
+        # A retried chunk and one past the gap are both refused with where to resume
+        for offset, data in ((0, content[:4]), (6, content[6:])):
+            response = self.put_chunk(url, offset, data)
+            self.assertEqual((response.status_code, response.json()['offset']), (409, 4))
+        response = self.put_chunk(url, 4, content[4:8], checksum='0' * 64)
+        self.assertEqual((response.status_code, response.json()['offset']), (400, 4))
+        self.assertEqual(self.client.get(url).json()['offset'], 4)
+
+        self.put_chunk(url, 4, content[4:8])
+        done = self.put_chunk(url, 8, content[8:]).json()
+        self.assertTrue(done['complete'])
+        attachment = Message.objects.get(pk=started.json()['draft_id']).attachments.get()
+        self.assertEqual((attachment.pk, attachment.name), (done['attachment_id'], 'digits.txt'))
+        with attachment.file.open('rb') as stored:
+            self.assertEqual(stored.read(), content)
+        self.assertEqual(self.put_chunk(url, 10, b'x').status_code, 409)
+
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class UserAutocompleteTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.teacher = CustomUser.objects.create(
+            username='tmiller', email='tmiller@example.com', first_name='Tess', is_teacher=True
+        )
+        cls.other_teacher = CustomUser.objects.create(
+            username='tmoss', email='tmoss@example.com', first_name='Tom', is_teacher=True, is_admin=True
+        )
+        cls.student = CustomUser.objects.create(username='tina', email='tina@example.com', first_name='Tina', is_student=True)
+
+    def search(self, term, **params):
+        # Rendering the widget registers it in the cache under its signed field id
+        field = TimetableForm()['teacher']
+        str(field)
+        return self.client.get(
+            reverse('user_autocomplete'),
+            {'field_id': field.field.widget.field_id, 'term': term, **params}
+        )
+
+    def test_login_is_required(self):
+        response = self.search('t')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith(resolve_url(settings.LOGIN_URL)))
+
+    def test_results_stay_within_the_widget_queryset(self):
+        self.client.force_login(self.student)
+        found = [int(result['id']) for result in self.search('t').json()['results']]
+        self.assertEqual(found, [self.teacher.pk, self.other_teacher.pk])
+        found = [int(result['id']) for result in self.search('tmo').json()['results']]
+        self.assertEqual(found, [self.other_teacher.pk])
+        found = [int(result['id']) for result in self.search('t', role='admin').json()['results']]
+        self.assertEqual(found, [self.other_teacher.pk])
+
+    def test_unknown_widgets_are_refused(self):
+        self.client.force_login(self.student)
+        response = self.client.get(reverse('user_autocomplete'), {'field_id': 'forged', 'term': 't'})
+        self.assertEqual(response.status_code, 404)
+
+
+class AdminMessageListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CustomUser.objects.create(username='head', email='head@example.com', is_admin=True)
+        cls.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        cls.message = send_message(cls.alice, cls.admin)
+
+    def test_bad_filters_are_reported_not_raised(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin_message_list'), {'sender': 'abc', 'date_from': 'yesterday'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.context['form'].errors), {'sender', 'date_from'})
+        self.assertEqual(list(response.context['messages']), [self.message])
+
+    def test_sender_filter_keeps_the_chosen_user(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin_message_list'), {'sender': self.alice.pk})
+        self.assertEqual(list(response.context['messages']), [self.message])
+        self.assertContains(response, 'alice@example.com')
+
+
+class MessageSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        cls.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        cls.carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+
+    def found(self, user, query):
+        return [message.pk for message in search_messages(user, query)[0]]
+
+    def test_search_is_limited_to_the_users_conversations(self):
+        trip = send_message(self.alice, self.bob, subject='Museum trip', body='Bring a <packed> lunch')
+        reply = send_message(self.bob, self.alice, parent=trip, subject='Re: Museum trip', body='Will the museum be open?')
+        other = send_message(self.alice, self.carol, subject='Museum tickets', body='Tickets attached')
+
+        self.assertCountEqual(self.found(self.bob, 'museum'), [trip.pk, reply.pk])
+        self.assertCountEqual(self.found(self.alice, 'museum'), [trip.pk, reply.pk, other.pk])
+        self.assertEqual(self.found(self.carol, 'museum'), [other.pk])
+        self.assertEqual(self.found(self.carol, 'lunch'), [])
+
+    def test_prefix_matching_ranking_and_snippets(self):
+        subject_hit = send_message(self.alice, self.bob, subject='Lunch menu', body='See below')
+        body_hit = send_message(self.alice, self.bob, subject='Notes', body='Bring a <packed> lunch today')
+        self.assertEqual(self.found(self.bob, 'lun'), [subject_hit.pk, body_hit.pk])
+        self.assertEqual(self.found(self.bob, '!!!'), [])
+
+        messages, has_next = search_messages(self.bob, 'packed lunch')
+        self.assertFalse(has_next)
+        self.assertEqual(len(messages), 1)
+        self.assertIn('&lt;<mark>packed</mark>&gt; <mark>lunch</mark>', messages[0].snippet)
+
+        body_hit.delete()
+        self.assertEqual(self.found(self.bob, 'packed'), [])
+
+
+class BroadcastDeliveryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.head = CustomUser.objects.create(username='head', email='head@example.com', is_admin=True, is_teacher=True)
+        cls.teachers = [
+            CustomUser.objects.create(username=f'teacher{n}', email=f'teacher{n}@example.com', is_teacher=True)
+            for n in range(5)
+        ]
+        CustomUser.objects.create(username='away', email='away@example.com', is_teacher=True, is_active=False)
+
+    def broadcast(self, **audience):
+        message = Message.objects.create(sender=self.head, subject='Staff meeting', body='...')
+        deliver(message)
+        Broadcast.objects.create(message=message, **audience)
+        return message
+
+    def test_interrupted_delivery_resumes_where_it_stopped(self):
+        message = self.broadcast(audience='teachers')
+        bulk_create = MailboxEntry.objects.bulk_create
+        batches = []
+
+        def failing_second_batch(entries, **kwargs):
+            batches.append(len(entries))
+            if len(batches) == 2:
+                raise RuntimeError("worker killed")
+            return bulk_create(entries, **kwargs)
+
+        with mock.patch.object(MailboxEntry.objects, 'bulk_create', side_effect=failing_second_batch):
+            with self.assertRaises(RuntimeError):
+                deliver_broadcast(message.pk, batch_size=2)
+        broadcast = Broadcast.objects.get(pk=message.pk)
+        self.assertEqual((broadcast.delivered_count, broadcast.delivered_through), (2, self.teachers[1].pk))
+        self.assertIsNone(broadcast.completed_at)
+
+        self.assertEqual(deliver_broadcast(message.pk, batch_size=2), 3)
+        self.assertCountEqual(
+            MailboxEntry.objects.filter(message=message, is_received=True).values_list('user_id', flat=True),
+            [teacher.pk for teacher in self.teachers]
+        )
+        broadcast.refresh_from_db()
+        self.assertEqual(broadcast.delivered_count, 5)
+        self.assertIsNotNone(broadcast.completed_at)
+        self.assertEqual(deliver_broadcast(message.pk), 0)
+        self.assertTrue(MailboxEntry.objects.get(message=message, user=self.head).is_sent)
+
+    def test_compose_only_queues_the_broadcast(self):
+        self.client.force_login(self.head)
+        response = self.client.post(reverse('compose_message'), {
+            'subject': 'Staff meeting', 'body': '...', 'audience': 'teachers'
+        })
+        self.assertRedirects(response, reverse('inbox'), fetch_redirect_response=False)
+        broadcast = Broadcast.objects.get()
+        self.assertIsNone(broadcast.completed_at)
+        self.assertEqual(MailboxEntry.objects.filter(message=broadcast.message, is_received=True).count(), 0)
+
+        call_command('deliver_broadcasts', stdout=io.StringIO())
+        self.assertEqual(MailboxEntry.objects.filter(message=broadcast.message, is_received=True).count(), 5)
+        self.assertIsNotNone(Broadcast.objects.get().completed_at)
+
+    def test_class_audience_is_resolved_at_delivery(self):
+        message = self.broadcast(audience='class_section', student_class='Class 1')
+        pupils = [make_student('ann', section='A'), make_student('ben', section='B')]
+        make_student('cal', student_class='Class 2')
+        self.assertEqual(deliver_broadcast(message.pk), 2)
+        self.assertCountEqual(
+            MailboxEntry.objects.filter(message=message, is_received=True).values_list('user_id', flat=True),
+            [pupil.pk for pupil in pupils]
+        )
+
+
+class MigrationTestCase(TransactionTestCase):
+    """Migrate school back to ``migrate_from``, let the test add rows, then forward to the latest state."""
+    migrate_from = None
+
+    def setUp(self):
+        super().setUp()
+        self.executor = MigrationExecutor(connection)
+        self.latest = self.executor.loader.graph.leaf_nodes()
+        self.executor.migrate([('school', self.migrate_from)])
+        self.old_apps = self.executor.loader.project_state([('school', self.migrate_from)]).apps
+        self.addCleanup(self.migrate_forward)
+
+    def migrate_forward(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.latest)
+
+
+class MailboxBackfillMigrationTests(MigrationTestCase):
+    migrate_from = '0012_notification_occurrences'
+
+    def test_existing_messages_are_filed_in_mailboxes(self):
+        User = self.old_apps.get_model('home_auth', 'CustomUser')
+        OldMessage = self.old_apps.get_model('school', 'Message')
+        alice = User.objects.create(username='alice', email='alice@example.com', first_name='Alice', last_name='Ames')
+        bob = User.objects.create(username='bob', email='bob@example.com')
+        root = OldMessage.objects.create(sender=alice, subject='Trip', body='...', sent_at=timezone.now())
+        root.recipients.set([bob])
+        reply = OldMessage.objects.create(sender=bob, subject='Re: Trip', body='Yes', parent=root, sent_at=timezone.now())
+        reply.recipients.set([alice])
+
+        self.migrate_forward()
+
+        entries = {entry.user_id: entry for entry in MailboxEntry.objects.filter(message_id=root.pk)}
+        self.assertEqual(set(entries), {alice.pk, bob.pk})
+        self.assertEqual(entries[alice.pk].recipient_names, 'bob')
+        self.assertTrue(entries[alice.pk].is_sent and entries[alice.pk].is_received)
+        self.assertEqual(Message.objects.get(pk=reply.pk).thread_root_id, root.pk)
+        self.assertEqual(ThreadSummary.objects.get(root_id=root.pk).reply_count, 1)
+
+
+class SearchIndexMigrationTests(MigrationTestCase):
+    migrate_from = '0015_thread_summary'
+
+    def test_existing_messages_are_indexed(self):
+        User = self.old_apps.get_model('home_auth', 'CustomUser')
+        OldMessage = self.old_apps.get_model('school', 'Message')
+        alice = User.objects.create(username='alice', email='alice@example.com', first_name='Alice')
+        message = OldMessage.objects.create(sender=alice, subject='Trip', body='Bring a packed lunch', sent_at=timezone.now())
+
+        self.migrate_forward()
+
+        for query in ('lunch', 'trip', 'alice'):
+            self.assertEqual(list(matching_messages(Message.objects.all(), query).values_list('pk', flat=True)), [message.pk])
+
+
+class CacheTableMigrationTests(MigrationTestCase):
+    migrate_from = '0022_exam_announcement'
+
+    def test_migrate_creates_the_cache_table(self):
+        table = settings.CACHES['default']['LOCATION']
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE {table}")
+        self.migrate_forward()
+        self.assertIn(table, connection.introspection.table_names())
+        self.assertTrue(cache.add('probe', 1))
+
+
+class ThreadRootDeletionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        cls.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        cls.admin = CustomUser.objects.create(username='head', email='head@example.com', is_admin=True)
+
+    def test_deleting_a_root_promotes_its_earliest_reply(self):
+        root = send_message(self.alice, self.bob)
+        first = send_message(self.bob, self.alice, parent=root)
+        second = send_message(self.alice, self.bob, parent=first)
+        MailboxEntry.objects.filter(user=self.bob).update(is_archived=True)
+
+        self.client.force_login(self.admin)
+        response = self.client.post(reverse('delete_message', args=[root.pk]))
+        self.assertEqual(response.status_code, 302)
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.thread_root_id, second.thread_root_id), (first.pk, first.pk))
+        self.assertEqual(list(thread_messages(first)), [first, second])
+        summary = ThreadSummary.objects.get(root=first)
+        self.assertEqual((summary.reply_count, summary.participant_count), (1, 2))
+        self.assertEqual(summary.last_activity_at, second.sent_at)
+        entries = {entry.user_id: entry for entry in MailboxEntry.objects.filter(message=first)}
+        self.assertEqual(set(entries), {self.alice.pk, self.bob.pk})
+        self.assertTrue(entries[self.bob.pk].is_archived)
+        self.assertFalse(entries[self.alice.pk].is_archived)
+
+        later = send_message(self.bob, self.alice, parent=second)
+        self.assertEqual(later.thread_root_id, first.pk)
+        self.assertEqual(ThreadSummary.objects.get(root=first).reply_count, 2)
+
+    def test_deleting_a_lone_root_leaves_nothing_behind(self):
+        root = send_message(self.alice, self.bob)
+        root.delete()
+        self.assertFalse(ThreadSummary.objects.exists())
+        self.assertFalse(MailboxEntry.objects.exists())
+
+    def test_reply_shows_up_in_the_rendered_thread(self):
+        root = send_message(self.alice, self.bob)
+        self.client.force_login(self.bob)
+        response = self.client.post(
+            reverse('message_detail', args=[root.pk]),
+            {'body': 'Count me in', 'recipients': [self.alice.pk]}
+        )
+        self.assertEqual(
+            [message.body for message in response.context['thread_messages']],
+            ['...', 'Count me in']
+        )
+
+
+class ReplyCoalescingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create(username='alice', email='alice@example.com', first_name='Alice')
+        cls.bob = CustomUser.objects.create(username='bob', email='bob@example.com', first_name='Bob')
+
+    def test_replies_anywhere_in_a_thread_share_one_notification(self):
+        root = Message.objects.create(sender=self.alice, subject='Trip', body='Who is coming?')
+        root.recipients.set([self.bob])
+        self.client.force_login(self.bob)
+
+        self.client.post(reverse('message_detail', args=[root.pk]), {'body': 'Me', 'recipients': [self.alice.pk]})
+        reply = Message.objects.get(parent=root)
+        self.client.post(reverse('message_detail', args=[reply.pk]), {'body': 'And my sister', 'recipients': [self.alice.pk]})
+
+        notification = Notification.objects.get(user=self.alice)
+        self.assertEqual(notification.occurrences, 2)
+        self.assertEqual(notification.related_url, reverse('message_detail', args=[root.pk]))
+        self.assertEqual(notification.title, 'New message: Trip')
+        self.assertEqual(notification.message, '2 new messages in Trip')
+        self.assertEqual(get_unread_count(self.alice), 1)
+        self.assertFalse(Notification.objects.filter(user=self.bob).exists())
+
+
+class ExamFanOutTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.students = [make_student('ana'), make_student('ben'), make_student('col')]
+        make_student('cy', section='B')
+        cls.teacher = CustomUser.objects.create(username='exams', email='exams@example.com', is_teacher=True)
+
+    def create_exam(self):
+        return Exam.objects.create(
+            name='Midterm', subject='Maths', date=datetime.date(2026, 11, 2), start_time=datetime.time(9),
+            end_time=datetime.time(11), student_class='Class 1', section='A', teacher=self.teacher, room='Hall'
+        )
+
+    def test_saving_an_exam_only_queues_the_announcement(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            exam = self.create_exam()
+        self.assertFalse(Notification.objects.exists())
+        self.assertIsNone(ExamAnnouncement.objects.get(exam=exam).completed_at)
+
+        call_command('send_exam_notifications', stdout=io.StringIO())
+        notified = Notification.objects.filter(dedupe_key=f'exam:{exam.pk}')
+        self.assertEqual(sorted(notified.values_list('user_id', flat=True)), sorted(user.pk for user in self.students))
+        self.assertEqual(notified.values('payload').distinct().count(), 1)
+        self.assertEqual(get_unread_count(self.students[0]), 1)
+        self.assertIsNotNone(ExamAnnouncement.objects.get(exam=exam).completed_at)
+        self.assertEqual(send_exam_notifications(), (0, 0))
+
+    def test_interrupted_fan_out_resumes_where_it_stopped(self):
+        exam = self.create_exam()
+        fan_out_batch = fan_out
+        batches = []
+
+        def failing_second_batch(user_ids, *args, **kwargs):
+            batches.append(list(user_ids))
+            if len(batches) == 2:
+                raise RuntimeError("worker killed")
+            return fan_out_batch(user_ids, *args, **kwargs)
+
+        with mock.patch('school.notifications.fan_out', side_effect=failing_second_batch):
+            with self.assertRaises(RuntimeError):
+                notify_exam_students(exam.pk, batch_size=2)
+        announcement = ExamAnnouncement.objects.get(exam=exam)
+        self.assertEqual((announcement.delivered_count, announcement.delivered_through), (2, self.students[1].pk))
+
+        self.assertEqual(notify_exam_students(exam.pk, batch_size=2), 1)
+        self.assertEqual(Notification.objects.filter(dedupe_key=f'exam:{exam.pk}').count(), 3)
+        self.assertEqual(NotificationPayload.objects.count(), 1)
+        self.assertEqual(notify_exam_students(exam.pk), 0)
+
+
+class TimetableGridTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.teacher = CustomUser.objects.create(username='grid', email='grid@example.com', is_teacher=True)
+        cls.subject = Subject.objects.create(name='Algebra', code='ALG')
+
+    def add_entry(self, start, end, day='Monday'):
+        return Timetable.objects.create(
+            student_class='Class 1', section='A', subject=self.subject, teacher=self.teacher,
+            day=day, start_time=start, end_time=end
+        )
+
+    def test_entries_off_the_hour_span_their_rows(self):
+        self.add_entry(datetime.time(8, 30), datetime.time(10, 0))
+        grid = build_grid(Timetable.objects.select_related('subject', 'teacher'))
+        starts = [row['start'] for row in grid['rows']]
+        self.assertEqual(starts, [datetime.time(8), datetime.time(8, 30), datetime.time(9)])
+        monday = [row['cells'][0] for row in grid['rows']]
+        self.assertEqual(monday[0]['entries'], [])
+        self.assertEqual(monday[1]['rowspan'], 2)
+        self.assertIsNone(monday[2])
+
+    def test_sessions_follow_the_calendar_and_skip_holidays(self):
+        self.add_entry(datetime.time(9), datetime.time(10), day='Monday')
+        self.add_entry(datetime.time(9), datetime.time(10), day='Friday')
+        Holiday.objects.create(name='Founders day', date=datetime.date(2020, 10, 23), recurring=True)
+        Holiday.objects.create(name='Closure', date=datetime.date(2026, 10, 26))
+        grid = build_grid(Timetable.objects.select_related('subject', 'teacher'))
+        # Friday 2026-10-16 09:30, with that class in progress
+        now = timezone.make_aware(datetime.datetime(2026, 10, 16, 9, 30))
+        dates = [session['date'] for session in upcoming_sessions(grid, now, limit=3)]
+        self.assertEqual(dates, [datetime.date(2026, 10, 16), datetime.date(2026, 10, 19), datetime.date(2026, 10, 30)])
+        self.assertEqual(list(occurrences(build_grid([]), now)), [])
+
+    def test_weekdays_do_not_depend_on_the_locale(self):
+        self.add_entry(datetime.time(9), datetime.time(10), day='Monday')
+        grid = build_grid(Timetable.objects.select_related('subject', 'teacher'))
+        # Saturday 2026-10-17, as a German locale would name the days
+        now = timezone.make_aware(datetime.datetime(2026, 10, 17, 12))
+        german = ['Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag', 'Samstag', 'Sonntag']
+        with mock.patch('calendar.day_name', german):
+            dates = [session['date'] for session in upcoming_sessions(grid, now, limit=2, holidays=HolidayCalendar())]
+        self.assertEqual(dates, [datetime.date(2026, 10, 19), datetime.date(2026, 10, 26)])
+
+    def test_writes_invalidate_the_cached_grid(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            entry = self.add_entry(datetime.time(9), datetime.time(10))
+        self.assertEqual(len(teacher_grid(self.teacher.pk)['by_day']['Monday']), 1)
+        class_grid('Class 1', 'A')
+        # The cache may itself be a table, but the timetable must not be read
+        with CaptureQueriesContext(connection) as queries:
+            class_grid('Class 1', 'A')
+        self.assertFalse([query for query in queries if Timetable._meta.db_table in query['sql']])
+        with self.captureOnCommitCallbacks(execute=True):
+            entry.day = 'Tuesday'
+            entry.save()
+        grid = teacher_grid(self.teacher.pk)
+        self.assertEqual((len(grid['by_day']['Monday']), len(grid['by_day']['Tuesday'])), (0, 1))
+
+
+class SharedCacheCheckTests(TestCase):
+    LOCAL = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+    def test_process_local_cache_is_refused_outside_debug(self):
+        self.assertEqual(check_shared_cache(None), [])
+        with override_settings(CACHES=self.LOCAL, DEBUG=False):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['school.E001'])
+        with override_settings(CACHES=self.LOCAL, DEBUG=True):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['school.W001'])
+
+
+class TimetableConflictTests(TestCase):
+    def slot(self, start, end, student_class='Class 1', teacher_id=None, classroom=''):
+        return Slot('Monday', datetime.time(*start), datetime.time(*end), student_class, 'A',
+                    teacher_id=teacher_id, classroom=classroom)
+
+    def test_index_finds_overlaps_behind_a_long_period(self):
+        long = self.slot((8, 0), (12, 0))
+        index = ConflictIndex([long, self.slot((9, 0), (9, 30)), self.slot((12, 0), (13, 0))])
+        found = index.overlapping('class', ('Monday', 'Class 1', 'A'), datetime.time(10), datetime.time(12))
+        self.assertEqual(found, [long])
+
+    def test_index_agrees_with_a_scan_when_periods_overlap_heavily(self):
+        rng = random.Random(7)
+        slots = []
+        for _ in range(300):
+            start = rng.randrange(8 * 60, 16 * 60)
+            length = rng.choice([15, 45, 240, 480])
+            end = min(start + length, 23 * 60 + 59)
+            slots.append(self.slot(divmod(start, 60), divmod(end, 60)))
+        index = ConflictIndex(slots)
+        for _ in range(100):
+            start = rng.randrange(8 * 60, 17 * 60)
+            window = (datetime.time(*divmod(start, 60)), datetime.time(*divmod(start + 30, 60)))
+            expected = [slot for slot in slots if slot.start_time < window[1] and slot.end_time > window[0]]
+            found = index.overlapping('class', ('Monday', 'Class 1', 'A'), *window)
+            self.assertCountEqual(found, expected)
+            self.assertEqual(found, sorted(found, key=lambda slot: slot.start_time))
+
+    def test_batch_rejects_double_booked_teacher_and_room(self):
+        teacher = CustomUser.objects.create(username='busy', email='busy@example.com', is_teacher=True)
+        Timetable.objects.create(
+            student_class='Class 2', section='A', subject=Subject.objects.create(name='Art', code='ART'),
+            teacher=teacher, day='Monday', start_time=datetime.time(9), end_time=datetime.time(10),
+            classroom='Lab 1'
+        )
+        conflicts = validate_slots([
+            self.slot((9, 30), (10, 30), teacher_id=teacher.pk),
+            self.slot((10, 0), (11, 0), classroom='lab 1'),
+            self.slot((8, 0), (9, 0), teacher_id=teacher.pk, classroom='Lab 1'),
+        ])
+        self.assertEqual([conflict.kind for conflict in conflicts], ['teacher', 'class'])
+
+
+class TimetableGeneratorTests(TestCase):
+    def test_synthetic_school_is_solved_without_clashes(self):
+        problem = synthetic_problem(12, seed=3)
+        solution = solve(problem, seed=3, time_limit=10)
+        self.assertEqual(solution.violations, 0)
+        self.assertEqual(validate_slots(solution_slots(problem, solution)), [])
+        for lesson in solution.lessons:
+            self.assertGreaterEqual(problem.rooms[lesson.room], lesson.requirement.size)
+            self.assertNotIn(lesson.slot, problem.unavailable[lesson.teacher_id])
+
+    def test_other_classes_bookings_are_worked_around(self):
+        teacher = CustomUser.objects.create(username='plan', email='plan@example.com', is_teacher=True)
+        subject = Subject.objects.create(name='Biology', code='BIO')
+        subject.teachers.add(teacher)
+        Timetable.objects.create(
+            student_class='Class 9', section='B', subject=subject, teacher=teacher, day='Monday',
+            start_time=datetime.time(8, 15), end_time=datetime.time(8, 30), classroom='lab'
+        )
+        problem = build_problem({
+            'days': ['Monday'],
+            'periods': [['08:00', '08:45'], ['09:00', '09:45']],
+            'rooms': {'Lab': 30},
+            'classes': [{'student_class': 'Class 9', 'section': 'A', 'size': 25, 'subjects': {'BIO': 1}}],
+        })
+        self.assertEqual((problem.unavailable[teacher.pk], problem.busy_rooms['Lab']), ({0}, {0}))
+        self.assertEqual([lesson.slot for lesson in solve(problem, seed=0).lessons], [1])
+
+
+class AvailabilityTests(TestCase):
+    def test_bookings_and_edits_update_free_teachers_and_rooms(self):
+        teacher = CustomUser.objects.create(username='sub', email='sub@example.com', is_teacher=True)
+        subject = Subject.objects.create(name='Music', code='MUS')
+        T = datetime.time
+        self.assertEqual(minute_mask(T(0, 1), T(0, 3)), 0b110)
+        with self.captureOnCommitCallbacks(execute=True):
+            entry = Timetable.objects.create(
+                student_class='Class 4', section='A', subject=subject, teacher=teacher, day='Tuesday',
+                start_time=T(10), end_time=T(10, 45), classroom='Hall'
+            )
+            Timetable.objects.create(
+                student_class='Class 4', section='B', subject=subject, teacher=teacher, day='Tuesday',
+                start_time=T(11), end_time=T(11, 45), classroom='Lab'
+            )
+        self.assertEqual(busy_teacher_ids('Tuesday', T(10, 30), T(11)), {teacher.pk})
+        self.assertEqual(busy_teacher_ids('Tuesday', T(10, 45), T(11)), set())
+        self.assertEqual(busy_teacher_ids('Tuesday', T(10), T(10, 45), ignore=entry.pk), set())
+        self.assertEqual(free_rooms('Tuesday', T(10), T(10, 30)), ['Lab'])
+        with self.captureOnCommitCallbacks(execute=True):
+            entry.day = 'Wednesday'
+            entry.save()
+        self.assertEqual(free_rooms('Tuesday', T(10), T(10, 30)), ['Hall', 'Lab'])
+        self.assertEqual(busy_teacher_ids('Wednesday', T(10), T(11)), {teacher.pk})
+
+    def test_edits_are_applied_to_the_cached_map_without_reading_the_day_again(self):
+        teacher = CustomUser.objects.create(username='sub', email='sub@example.com', is_teacher=True)
+        subject = Subject.objects.create(name='Music', code='MUS')
+        T = datetime.time
+        with self.captureOnCommitCallbacks(execute=True):
+            entries = [
+                Timetable.objects.create(
+                    student_class='Class 4', section=section, subject=subject, teacher=teacher, day='Tuesday',
+                    start_time=T(hour), end_time=T(hour, 45), classroom=f"Room {hour}"
+                )
+                for hour, section in ((9, 'A'), (10, 'B'), (11, 'C'))
+            ]
+        self.assertEqual(free_rooms('Tuesday', T(9), T(12)), [])
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            entries[0].start_time, entries[0].end_time, entries[0].classroom = T(14), T(14, 45), 'Hall'
+            entries[0].save()
+            entries[1].delete()
+        with CaptureQueriesContext(connection) as queries:
+            for callback in callbacks:
+                callback()
+            self.assertEqual(busy_teacher_ids('Tuesday', T(9), T(10, 30)), set())
+            self.assertEqual(busy_teacher_ids('Tuesday', T(14, 30), T(15)), {teacher.pk})
+            self.assertEqual(free_rooms('Tuesday', T(9), T(10)), ['Hall', 'Room 11'])
+            self.assertEqual(free_rooms('Tuesday', T(11), T(12)), ['Hall'])
+        self.assertFalse([query['sql'] for query in queries if 'school_timetable' in query['sql']])
+
+    def test_ignoring_an_entry_keeps_its_owners_other_bookings(self):
+        teacher = CustomUser.objects.create(username='sub', email='sub@example.com', is_teacher=True)
+        subject = Subject.objects.create(name='Music', code='MUS')
+        T = datetime.time
+        with self.captureOnCommitCallbacks(execute=True):
+            entry = Timetable.objects.create(
+                student_class='Class 4', section='A', subject=subject, teacher=teacher, day='Tuesday',
+                start_time=T(10), end_time=T(11), classroom='Hall'
+            )
+            Timetable.objects.create(
+                student_class='Class 4', section='B', subject=subject, teacher=teacher, day='Tuesday',
+                start_time=T(10, 30), end_time=T(11, 30), classroom='Hall'
+            )
+        self.assertEqual(busy_teacher_ids('Tuesday', T(10), T(10, 30), ignore=entry.pk), set())
+        self.assertEqual(busy_teacher_ids('Tuesday', T(10, 15), T(10, 45), ignore=entry.pk), {teacher.pk})
+        self.assertEqual(free_rooms('Tuesday', T(10, 15), T(10, 45), ignore=entry.pk), [])
+        self.assertEqual(free_rooms('Tuesday', T(10), T(10, 30), ignore=entry.pk), ['Hall'])
+
+    def test_edits_in_another_worker_reach_this_ones_maps(self):
+        teacher = CustomUser.objects.create(username='sub', email='sub@example.com', is_teacher=True)
+        subject = Subject.objects.create(name='Music', code='MUS')
+        T = datetime.time
+        self.assertEqual(busy_teacher_ids('Tuesday', T(10), T(11)), set())
+
+        # Another process: its own cache client on the same shared backend
+        other_worker = caches.create_connection('default')
+        with mock.patch('school.timetables.cache', other_worker), mock.patch('school.availability.cache', other_worker):
+            with self.captureOnCommitCallbacks(execute=True):
+                Timetable.objects.create(
+                    student_class='Class 4', section='A', subject=subject, teacher=teacher, day='Tuesday',
+                    start_time=T(10), end_time=T(10, 45), classroom='Hall'
+                )
+        self.assertEqual(busy_teacher_ids('Tuesday', T(10), T(11)), {teacher.pk})
@@ -0,0 +1,254 @@
+# school/timetables
+import time as clock
+from datetime import datetime, time, timedelta
+from itertools import islice
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Holiday, Timetable
+
+DAYS = [day for day, _ in Timetable.CLASS_DAYS]
+# Bump when the grid layout changes so cached grids of the old shape are ignored
+GRID_FORMAT = 1
+GRID_CACHE_PREFIX = 'timetable-grid'
+SCHOOL_OWNER = 'school'
+
+
+def class_owner(student_class, section):
+    return f"class:{quote(student_class)}:{quote(section)}"
+
+
+def teacher_owner(teacher_id):
+    return f"teacher:{teacher_id}"
+
+
+def entry_owners(student_class, section, teacher_id):
+    """Every cached grid an entry with these values appears in."""
+    return {class_owner(student_class, section), teacher_owner(teacher_id), SCHOOL_OWNER}
+
+
+def _version_key(owner):
+    return f"{GRID_CACHE_PREFIX}:version:{owner}"
+
+
+def cache_version(owner):
+    # A missing counter restarts from the clock, never from a number an older
+    # cached grid may still be stored under
+    version = cache.get(_version_key(owner))
+    if version is None:
+        cache.add(_version_key(owner), clock.time_ns(), None)
+        version = cache.get(_version_key(owner), 0)
+    return version
+
+
+def invalidate_grids(owners):
+    for owner in owners:
+        try:
+            cache.incr(_version_key(owner))
+        except ValueError:
+            pass
+
+
+def replace_entries(entries, replacing=None):
+    """
+    Save ``entries`` (unsaved Timetable rows) in one transaction, first
+    deleting the ``replacing`` queryset. Returns the number of rows deleted.
+    """
+    from .availability import forget_days
+
+    with transaction.atomic():
+        replaced = replacing.delete()[0] if replacing is not None else 0
+        Timetable.objects.bulk_create(entries)
+        # bulk_create sends no post_save, so drop the affected grids and maps here
+        owners = set().union(*(entry_owners(e.student_class, e.section, e.teacher_id) for e in entries))
+        days = {e.day for e in entries}
+        transaction.on_commit(lambda: (invalidate_grids(owners), forget_days(days)))
+    return replaced
+
+
+def _entry_data(entry):
+    return {
+        'id': entry.pk,
+        'day': entry.day,
+        'start_time': entry.start_time,
+        'end_time': entry.end_time,
+        'subject': str(entry.subject),
+        'subject_id': entry.subject_id,
+        'teacher_id': entry.teacher_id,
+        'teacher_name': entry.teacher.get_full_name() or entry.teacher.username,
+        'student_class': entry.student_class,
+        'section': entry.section,
+        'classroom': entry.classroom or '',
+        'color': entry.color or '',
+    }
+
+
+def _boundaries(entries):
+    """Row edges: every start and end time, plus each full hour in between."""
+    edges = {entry['start_time'] for entry in entries} | {entry['end_time'] for entry in entries}
+    first, last = min(edges), max(edges)
+    last_hour = last.hour if last.minute == 0 else last.hour + 1
+    edges |= {time(hour) for hour in range(first.hour, min(last_hour, 23) + 1)}
+    return sorted(edge for edge in edges if first.replace(minute=0) <= edge <= last)
+
+
+def _day_cells(entries, edges):
+    """
+    One column of the grid. Entries that overlap share a cell, so the column
+    never needs two cells in the same row; None marks rows covered by a cell
+    above.
+    """
+    row_of = {edge: index for index, edge in enumerate(edges)}
+    cells = [{'rowspan': 1, 'entries': []} for _ in edges[:-1]]
+    group, group_end = [], None
+    for entry in sorted(entries, key=lambda entry: (entry['start_time'], entry['end_time'])):
+        if group and entry['start_time'] < group_end:
+            group.append(entry)
+            group_end = max(group_end, entry['end_time'])
+            continue
+        if group:
+            _place(cells, row_of, group, group_end)
+        group, group_end = [entry], entry['end_time']
+    if group:
+        _place(cells, row_of, group, group_end)
+    return cells
+
+
+def _place(cells, row_of, group, group_end):
+    first, last = row_of[group[0]['start_time']], row_of[group_end]
+    cells[first] = {'rowspan': last - first, 'entries': group}
+    for row in range(first + 1, last):
+        cells[row] = None
+
+
+def build_grid(entries):
+    """
+    Lay ``entries`` (Timetable rows) out as a table: a row between each pair of
+    adjacent edges and a column per day, each entry spanning the rows its
+    times cover. Also lists each day's entries in order for the dashboards.
+    """
+    entries = [_entry_data(entry) for entry in entries if entry.start_time < entry.end_time]
+    by_day = {day: sorted((entry for entry in entries if entry['day'] == day), key=lambda entry: entry['start_time'])
+              for day in DAYS}
+    grid = {
+        'format': GRID_FORMAT,
+        'days': DAYS,
+        'rows': [],
+        'by_day': by_day,
+        'classes': sorted({(entry['student_class'], entry['section']) for entry in entries}),
+    }
+    if not entries:
+        return grid
+    edges = _boundaries(entries)
+    columns = [_day_cells(by_day[day], edges) for day in DAYS]
+    grid['rows'] = [
+        {'start': start, 'end': end, 'cells': [column[index] for column in columns]}
+        for index, (start, end) in enumerate(zip(edges, edges[1:]))
+    ]
+    return grid
+
+
+def _grid(owner, entries):
+    key = f"{GRID_CACHE_PREFIX}:{GRID_FORMAT}:{owner}:{cache_version(owner)}"
+    grid = cache.get(key)
+    if grid is None:
+        grid = build_grid(entries.select_related('subject', 'teacher'))
+        cache.set(key, grid, getattr(settings, 'TIMETABLE_GRID_CACHE_TIMEOUT', 24 * 60 * 60))
+    return grid
+
+
+def class_grid(student_class, section):
+    return _grid(
+        class_owner(student_class, section),
+        Timetable.objects.filter(student_class=student_class, section=section)
+    )
+
+
+def teacher_grid(teacher_id):
+    return _grid(teacher_owner(teacher_id), Timetable.objects.filter(teacher_id=teacher_id))
+
+
+def school_grid():
+    return _grid(SCHOOL_OWNER, Timetable.objects.all())
+
+
+def week_entries(grid):
+    """The grid's entries as one list, Monday first."""
+    return [entry for day in grid['days'] for entry in grid['by_day'][day]]
+
+
+class HolidayCalendar:
+    """Days off: one-off holidays by date, recurring ones by month and day in every year."""
+
+    def __init__(self, holidays=()):
+        self.dates, self.annual = set(), set()
+        for date, recurring in holidays:
+            if recurring:
+                self.annual.add((date.month, date.day))
+            else:
+                self.dates.add(date)
+
+    def __contains__(self, day):
+        return day in self.dates or (day.month, day.day) in self.annual
+
+    @classmethod
+    def load(cls):
+        return cls(Holiday.objects.values_list('date', 'recurring'))
+
+
+# How far ahead occurrences() looks, so a week with no sessions left ends the stream
+OCCURRENCE_HORIZON_DAYS = 366
+
+
+def _weekly(grid):
+    """The grid's entries indexed by weekday number, Monday 0, as date.weekday() counts."""
+    # DAYS runs Monday to Saturday, fixed whatever the locale; no Sunday classes
+    return [grid['by_day'].get(day, []) for day in DAYS] + [[]] * (7 - len(DAYS))
+
+
+def _session(entry, day):
+    return {
+        **entry,
+        'date': day,
+        'starts_at': timezone.make_aware(datetime.combine(day, entry['start_time'])),
+        'ends_at': timezone.make_aware(datetime.combine(day, entry['end_time'])),
+    }
+
+
+def sessions_on(grid, day, holidays=None):
+    """The grid's sessions on the date ``day``; none on a holiday."""
+    holidays = HolidayCalendar.load() if holidays is None else holidays
+    if day in holidays:
+        return []
+    return [_session(entry, day) for entry in _weekly(grid)[day.weekday()]]
+
+
+def occurrences(grid, start, holidays=None, horizon=OCCURRENCE_HORIZON_DAYS):
+    """
+    Expand the grid's weekly entries into dated sessions from ``start`` (an
+    aware datetime) on, lazily and in time order, skipping holidays and
+    sessions already over at ``start``. Each session is its grid entry plus
+    ``date``, ``starts_at`` and ``ends_at``.
+    """
+    holidays = HolidayCalendar.load() if holidays is None else holidays
+    weekly = _weekly(grid)
+    if not any(weekly):
+        return
+    today = timezone.localtime(start).date()
+    for offset in range(horizon):
+        day = today + timedelta(days=offset)
+        if day in holidays:
+            continue
+        for entry in weekly[day.weekday()]:
+            session = _session(entry, day)
+            if session['ends_at'] > start:
+                yield session
+
+
+def upcoming_sessions(grid, now, limit=5, holidays=None):
+    """The next ``limit`` sessions from ``now`` on, the one in progress included."""
+    return list(islice(occurrences(grid, now, holidays), limit))
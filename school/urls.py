@@ -4,8 +4,8 @@ from .views import (
     index, dashboard, student_dashboard, student_teachers,
     teacher_dashboard, teacher_schedule, create_assignment, auth_status,
     grade_submissions, take_attendance, teacher_profile, teacher_profile_view, teacher_profile_edit, teacher_list, add_teacher, edit_teacher, admin_dashboard, admin_message_list,
-    mark_notification_as_read, get_unread_notifications, delete_notification, all_notifications, unread_notification_count, inbox, message_detail, compose_message, delete_message,
-    TimetableView, TimetableCreateView, TimetableUpdateView, TimetableCalendarView, TimetableDeleteView, ExamListView, ExamCreateView, ExamUpdateView, ExamDeleteView, DepartmentListView, DepartmentCreateView, DepartmentUpdateView, DepartmentDeleteView, HolidayListView, HolidayCreateView, HolidayUpdateView, HolidayDeleteView, SubjectListView, SubjectUpdateView, SubjectCreateView, SubjectDeleteView
+    mark_notification_as_read, get_unread_notifications, notification_stream, delete_notification, all_notifications, unread_notification_count, inbox, message_search, download_attachment, start_attachment_upload, attachment_upload, message_detail, archive_message, compose_message, delete_message, UserAutocompleteView,
+    validate_timetable_week, timetable_availability, timetable_feed, TimetableView, TimetableCreateView, TimetableUpdateView, TimetableCalendarView, TimetableDeleteView, ExamListView, ExamCreateView, ExamUpdateView, ExamDeleteView, DepartmentListView, DepartmentCreateView, DepartmentUpdateView, DepartmentDeleteView, HolidayListView, HolidayCreateView, HolidayUpdateView, HolidayDeleteView, SubjectListView, SubjectUpdateView, SubjectCreateView, SubjectDeleteView
 )
 
 urlpatterns = [
@@ -36,6 +36,9 @@ urlpatterns = [
     path('time-table/<int:pk>/edit/', TimetableUpdateView.as_view(), name='edit_timetable'),
     path('time-table/<int:pk>/delete/', TimetableDeleteView.as_view(), name='delete_timetable'),
     path('time-table/calendar/', TimetableCalendarView.as_view(), name='timetable_calendar'),
+    path('time-table/validate/', validate_timetable_week, name='validate_timetable_week'),
+    path('time-table/availability/', timetable_availability, name='timetable_availability'),
+    path('time-table/calendar.ics', timetable_feed, name='timetable_feed'),
     
     path('exams/', ExamListView.as_view(), name='exam_list'),
     path('exams/add/', ExamCreateView.as_view(), name='add_exam'),
@@ -49,20 +52,29 @@ urlpatterns = [
     path('notifications/', all_notifications, name='all_notifications'),
     path('notifications/unread-count/', unread_notification_count, name='unread_notification_count'),
     path('notifications/unread/', get_unread_notifications, name='get_unread_notifications'),
+    path('notifications/stream/', notification_stream, name='notification_stream'),
     path('notifications/mark-as-read/', mark_notification_as_read, name='mark_notification_as_read'),
     path('notifications/mark-as-read/<uuid:notification_id>/', mark_notification_as_read, name='mark_single_notification_as_read'),
     path('notifications/delete/<uuid:notification_id>/', delete_notification, name='delete_notification'),
 
     path('messages/', include([
         path('inbox/', inbox, name='inbox'),
+        path('inbox/search/', message_search, name='message_search'),
+        path('attachments/<int:attachment_id>/', download_attachment, name='download_attachment'),
+        path('uploads/', start_attachment_upload, name='start_attachment_upload'),
+        path('uploads/<uuid:upload_id>/', attachment_upload, name='attachment_upload'),
         path('inbox/<int:message_id>/', message_detail, name='message_detail'),
         path('inbox/compose/', compose_message, name='compose_message'),
         path('inbox/compose/<int:reply_to>/', compose_message, name='reply_message'),
+        path('inbox/<int:message_id>/archive/', archive_message, name='archive_message'),
         path('inbox/<int:message_id>/delete/', delete_message, name='delete_message'),
     ])),
 
-    path('admin/messages/', admin_message_list, name='admin_message_list'),
-    path('admin/messages/<int:message_id>/delete/', delete_message, name='delete_message'),
+    path('autocomplete/users/', UserAutocompleteView.as_view(), name='user_autocomplete'),
+
+    # Under messages/ because the Django admin claims every admin/ URL
+    path('messages/admin/', admin_message_list, name='admin_message_list'),
+    path('messages/admin/<int:message_id>/delete/', delete_message, name='delete_message'),
 
     # Department URLs
     path('departments/', DepartmentListView.as_view(), name='department_list'),
@@ -12,18 +12,46 @@ from student.models import Student
 from django.views.generic import CreateView, UpdateView, DeleteView
 from django.urls import reverse_lazy
 from .forms import TimetableForm, ExamForm, DepartmentForm
-from datetime import time
 from django.views import View
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 import datetime
 from django.utils import timezone
 from django.db.models import Q
 from django.core.exceptions import PermissionDenied
-from .models import Message, MessageAttachment, Holiday, Subject
-from .forms import MessageForm, HolidayForm, SubjectForm
+from .models import Message, MessageAttachment, AttachmentUpload, Holiday, Subject
+from .forms import AdminMessageFilterForm, MessageForm, HolidayForm, SubjectForm
 from django.contrib import messages
 from django.core.paginator import Paginator
 from django.urls import reverse
+from .notifications import (
+    get_unread_count, mark_as_read, delete_notifications, unread_payload, notification_etag,
+    notification_page, notification_facets, unread_notifications_for, get_state, notify_coalesced
+)
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from .events import get_broker
+from .attachments import (
+    UploadOffsetMismatch, attach_files, attachment_response, can_download, start_upload, write_chunk
+)
+from .mailbox import (
+    ADMIN_PAGE_SIZE, MAILBOX_FOLDERS, MAILBOX_PAGE_SIZE, admin_messages, attach_recipient_preview, deliver,
+    get_unread_message_count, mailbox_entries, mark_thread_read, set_archived, thread_page,
+    thread_root
+)
+from .search import search_messages
+from .availability import free_rooms, free_teachers
+from .conflicts import parse_slot, validate_slots
+from .timetables import (
+    HolidayCalendar, build_grid, class_grid, occurrences, school_grid, sessions_on, teacher_grid, upcoming_sessions,
+    week_entries
+)
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django_select2.views import AutoResponseView
+from django.http import StreamingHttpResponse
+from asgiref.sync import sync_to_async
+import asyncio
+import json
 
 
 def index(request):
@@ -35,69 +63,94 @@ def index(request):
 
 @login_required
 def all_notifications(request):
-    notifications = request.user.notifications.all().order_by('-created_at')
+    status = request.GET.get('status')
+    notification_type = request.GET.get('type')
+    state = get_state(request.user)
+    notifications, next_cursor = notification_page(
+        request.user,
+        status=status,
+        notification_type=notification_type,
+        cursor=request.GET.get('before'),
+        state=state
+    )
     
-    # Counts for filters
-    unread_count = request.user.notifications.filter(is_read=False).count()
-    read_count = request.user.notifications.filter(is_read=True).count()
-    exam_count = request.user.notifications.filter(notification_type='exam').count()
-    assignment_count = request.user.notifications.filter(notification_type='assignment').count()
-    announcement_count = request.user.notifications.filter(notification_type='announcement').count()
-    message_count = request.user.notifications.filter(notification_type='message').count()
+    # Counts for filters, from a single aggregate query
+    facets = notification_facets(request.user, state)
     
     context = {
         'notifications': notifications,
-        'unread_count': unread_count,
-        'read_count': read_count,
-        'exam_count': exam_count,
-        'assignment_count': assignment_count,
-        'announcement_count': announcement_count,
-        'message_count': message_count,
+        'next_cursor': next_cursor,
+        'current_status': status or 'all',
+        'current_type': notification_type or '',
+        'total_count': facets['total'],
+        'unread_count': facets['unread'],
+        'read_count': facets['read'],
+        'exam_count': facets['exam'],
+        'assignment_count': facets['assignment'],
+        'announcement_count': facets['announcement'],
+        'message_count': facets['message'],
     }
     return render(request, 'notifications/all.html', context)
 
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=notification_etag)
 def get_unread_notifications(request):
     if request.headers.get('x-requested-with') == 'XMLHttpRequest':
-        notifications = request.user.notifications.filter(is_read=False).order_by('-created_at')[:5]
-        data = {
-            'notifications': [
-                {
-                    'id': str(notif.id),
-                    'title': notif.title,
-                    'message': notif.message,
-                    'time_since': notif.time_since,
-                    'is_read': notif.is_read,
-                    'url': notif.related_url or '#',
-                } for notif in notifications
-            ],
-            'unread_count': request.user.notifications.filter(is_read=False).count()
-        }
-        return JsonResponse(data)
+        return JsonResponse(unread_payload(request.user))
     return JsonResponse({}, status=400)
 
+@login_required
+async def notification_stream(request):
+    # Streaming needs an ASGI server; under WSGI the client falls back to polling
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    user = await request.auser()
+    response = StreamingHttpResponse(_notification_events(user), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+async def _notification_events(user):
+    broker = get_broker()
+    subscription = broker.subscribe(user.pk)
+    _, wakeups = subscription
+    keepalive = getattr(settings, 'NOTIFICATION_STREAM_KEEPALIVE', 25)
+    try:
+        while True:
+            payload = await sync_to_async(unread_payload)(user)
+            yield f"event: notifications\ndata: {json.dumps(payload)}\n\n"
+            while True:
+                try:
+                    await asyncio.wait_for(wakeups.get(), timeout=keepalive)
+                    break
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+    finally:
+        broker.unsubscribe(user.pk, subscription)
+
 @login_required
 def mark_notification_as_read(request, notification_id=None):
     if request.method == 'POST':
-        if notification_id:
-            # Mark single notification as read
-            request.user.notifications.filter(id=notification_id).update(is_read=True)
-        else:
-            # Mark all notifications as read
-            request.user.notifications.filter(is_read=False).update(is_read=True)
+        # Mark a single notification as read, or all of them when no id is given
+        notification_id = notification_id or request.POST.get('notification_id')
+        mark_as_read(request.user, notification_id)
         return JsonResponse({'status': 'success'})
     return JsonResponse({'status': 'error'}, status=400)
 
 @login_required
 def delete_notification(request, notification_id):
     if request.method == 'POST':
-        request.user.notifications.filter(id=notification_id).delete()
+        delete_notifications(request.user, notification_id)
         return JsonResponse({'status': 'success'})
     return JsonResponse({'status': 'error'}, status=400)
 
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=notification_etag)
 def unread_notification_count(request):
     if request.user.is_authenticated:
-        count = request.user.notifications.filter(is_read=False).count()
+        count = get_unread_count(request.user)
         return JsonResponse({'count': count})
     return JsonResponse({'count': 0})
 
@@ -136,7 +189,8 @@ def student_dashboard(request):
     
     try:
         student = Student.objects.get(user=request.user)
-        today = timezone.now().date()
+        now = timezone.localtime()
+        today = now.date()
         
         # Get all exams for student's class and section
         exams = Exam.objects.filter(
@@ -148,16 +202,18 @@ def student_dashboard(request):
         upcoming_exams = exams.filter(date__gte=today)
         past_exams = exams.filter(date__lt=today)
         
+        grid = class_grid(student.student_class, student.section)
+        # Dated sessions in time order, with holidays left out
+        holidays = HolidayCalendar.load()
+        
         context = {
             'user': request.user,
             'student': student,
+            'timetable_entries': upcoming_sessions(grid, now, holidays=holidays),
             'exams': exams,  # Pass all exams
             'upcoming_exams': upcoming_exams,
             'past_exams': past_exams,
-            'unread_notification_count': Notification.objects.filter(
-                user=request.user, 
-                is_read=False
-            ).count()
+            'unread_notification_count': get_unread_count(request.user)
         }
         return render(request, "students/student-dashboard.html", context)
         
@@ -178,10 +234,7 @@ def student_teachers(request):
     
     context = {
         'teachers': relationships,
-        'unread_notification_count': Notification.objects.filter(
-            user=request.user, 
-            is_read=False
-        ).count(),
+        'unread_notification_count': get_unread_count(request.user),
         'user': request.user
     }
     return render(request, "students/student-teachers.html", context)
@@ -192,32 +245,31 @@ def teacher_dashboard(request):
         return HttpResponseForbidden()
 
     # Fetch unread notifications
-    unread_notifications = Notification.objects.filter(
-        user=request.user,
-        is_read=False
-    ).order_by('-created_at')
+    unread_notifications = unread_notifications_for(request.user)
+
+    grid = teacher_grid(request.user.pk)
+    now = timezone.localtime()
 
     # Count distinct classes and students
-    classes_teaching = Timetable.objects.filter(
-        teacher=request.user
-    ).values('student_class', 'section').distinct().count()
+    classes_teaching = len(grid['classes'])
 
     students_taught = StudentTeacherRelationship.objects.filter(
         teacher=request.user
     ).values('student').distinct().count()
 
-    upcoming_classes = Timetable.objects.filter(
-        teacher=request.user
-    ).order_by('day', 'start_time')[:5] 
+    # Dated sessions in time order, with holidays left out
+    holidays = HolidayCalendar.load()
+    upcoming_classes = upcoming_sessions(grid, now, holidays=holidays)
 
     context = {
         'user': request.user,
         'unread_notifications': unread_notifications,
-        'unread_notification_count': unread_notifications.count(),
+        'unread_notification_count': get_unread_count(request.user),
         'classes_teaching': classes_teaching,
         'students_taught': students_taught,
         'tests_to_grade': [],
         'upcoming_classes': upcoming_classes,
+        'todays_classes': sessions_on(grid, now.date(), holidays),
     }
     return render(request, "teachers/teacher_dashboard.html", context)
 
@@ -230,12 +282,12 @@ def teacher_list(request):
     teachers = CustomUser.objects.filter(is_teacher=True).only(
     'first_name', 'last_name', 'email', 'date_joined', 'profile_picture'
         )
-    unread_notifications = Notification.objects.filter(user=request.user, is_read=False)
+    unread_notifications = unread_notifications_for(request.user)
     
     context = {
         'teachers': teachers,
         'user': request.user,
-        'unread_notification_count': unread_notifications.count(),
+        'unread_notification_count': get_unread_count(request.user),
         'unread_notification': unread_notifications
     }
     return render(request, "teachers/teacher_list.html", context)
@@ -304,9 +356,7 @@ def teacher_schedule(request):
         return HttpResponseForbidden()
     
     # Get timetable entries for this teacher
-    timetable_entries = Timetable.objects.filter(
-        teacher=request.user
-    ).order_by('day', 'start_time')
+    timetable_entries = week_entries(teacher_grid(request.user.pk))
     
     days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     
@@ -314,10 +364,7 @@ def teacher_schedule(request):
         'timetable_entries': timetable_entries,
         'days': days,
         'user': request.user,
-        'unread_notification_count': Notification.objects.filter(
-            user=request.user, 
-            is_read=False
-        ).count()
+        'unread_notification_count': get_unread_count(request.user)
     }
     return render(request, "teachers/teacher_schedule.html", context)
 
@@ -348,10 +395,7 @@ def teacher_profile_view(request):
     context = {
         'user': request.user,
         'teacher': request.user,
-        'unread_notification_count': Notification.objects.filter(
-            user=request.user, 
-            is_read=False
-        ).count()
+        'unread_notification_count': get_unread_count(request.user)
     }
     return render(request, "teachers/teacher_profile_view.html", context)
 
@@ -382,10 +426,7 @@ def teacher_profile(request):
         'subjects': subjects,
         'classes': classes,
         'total_students': total_students,
-        'unread_notification_count': Notification.objects.filter(
-            user=request.user, 
-            is_read=False
-        ).count()
+        'unread_notification_count': get_unread_count(request.user)
     }
     return render(request, "teachers/teacher_profile.html", context)
 
@@ -438,10 +479,7 @@ def teacher_profile_edit(request):
     context = {
         'user': request.user,
         'departments': departments,
-        'unread_notification_count': Notification.objects.filter(
-            user=request.user, 
-            is_read=False
-        ).count()
+        'unread_notification_count': get_unread_count(request.user)
     }
     return render(request, "teachers/teacher_profile_edit.html", context)
 
@@ -466,21 +504,9 @@ class ExamCreateView(LoginRequiredMixin, CreateView):
                 # Only admins can assign exams to other teachers
                 raise PermissionDenied("You don't have permission to create exams")
             
+            # Student notifications are fanned out by the Exam post_save signal
             response = super().form_valid(form)
             
-            # Create notifications for students in this class/section
-            students = Student.objects.filter(
-                student_class=form.instance.student_class,
-                section=form.instance.section
-            ).select_related('user')
-            
-            for student in students:
-                if student.user:  # Check if student has a user account
-                    Notification.objects.create(
-                        user=student.user,
-                        message=f"New exam scheduled: {form.instance.name} on {form.instance.date}"
-                    )
-            
             messages.success(self.request, 'Exam created successfully!')
             return response
             
@@ -542,29 +568,19 @@ def admin_dashboard(request):
     if not request.user.is_admin:
         return HttpResponseForbidden()
     
-    unread_notification = Notification.objects.filter(
-        user=request.user, 
-        is_read=False
-    ).order_by('-created_at')
+    unread_notification = unread_notifications_for(request.user)
     
     context = {
         'unread_notification': unread_notification,
-        'unread_notification_count': unread_notification.count(),
+        'unread_notification_count': get_unread_count(request.user),
         'user': request.user
     }
     return render(request, "admin/admin-dashboard.html", context)
 
-@login_required
-def mark_notification_as_read(request):
-    if request.method == 'POST':
-        Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
-        return JsonResponse({'status': 'success'})
-    return HttpResponseForbidden()
-
 @login_required
 def clear_all_notification(request):
     if request.method == "POST":
-        Notification.objects.filter(user=request.user).delete()
+        delete_notifications(request.user)
         return JsonResponse({'status': 'success', 'count': 0})
     return HttpResponseForbidden()
 
@@ -602,56 +618,76 @@ class TimetableView(LoginRequiredMixin, ListView):
             return queryset.order_by('day', 'start_time')
         return queryset.none()
     
+def _calendar_grid(user):
+    """The cached grid a user's calendar shows, or None for a student without a profile."""
+    if user.is_student:
+        student = Student.objects.filter(user=user).values('student_class', 'section').first()
+        return class_grid(student['student_class'], student['section']) if student else None
+    if user.is_teacher:
+        return teacher_grid(user.pk)
+    return school_grid()
+
 class TimetableCalendarView(LoginRequiredMixin, View):
     def get(self, request):
-        days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
-        time_slots = [time(h, 0).strftime('%H:%M') for h in range(8, 18)]  # 8AM to 6PM
-        
-        # Initialize a complete data structure
-        timetable_data = {
-            day: {time_slot: None for time_slot in time_slots}
-            for day in days
-        }
-        
-        # Get appropriate timetable entries
-        try:
-            if request.user.is_student:
-                student = Student.objects.get(user=request.user)
-                entries = Timetable.objects.filter(
-                    student_class=student.student_class,
-                    section=student.section
-                ).order_by('day', 'start_time')
-            elif request.user.is_teacher:
-                entries = Timetable.objects.filter(
-                    teacher=request.user
-                ).order_by('day', 'start_time')
-            else:  # admin
-                entries = Timetable.objects.all().order_by('day', 'start_time')
-            
-            # Populate the timetable_data structure
-            for entry in entries:
-                day = entry.day
-                time_key = entry.start_time.strftime('%H:%M')
-                if day in timetable_data and time_key in timetable_data[day]:
-                    timetable_data[day][time_key] = entry
-                    
-        except Student.DoesNotExist:
+        # Served from the cached grid; times need not fall on the hour
+        grid = _calendar_grid(request.user)
+        if grid is None:
             messages.error(request, "Student profile not found")
-            entries = []
+            grid = build_grid([])
         
         context = {
-            'days': days,
-            'time_slots': time_slots,
-            'timetable_data': timetable_data,  # Structured data for template
-            'entries': entries,  # Original queryset for debugging
+            'grid': grid,
             'user': request.user,
-            'unread_notification_count': Notification.objects.filter(
-                user=request.user, 
-                is_read=False
-            ).count()
+            'unread_notification_count': get_unread_count(request.user)
         }
         return render(request, 'timetable_calendar.html', context)
     
+# Longest span, in weeks, the calendar feed expands
+FEED_MAX_WEEKS = 26
+
+def _ics_text(value):
+    return str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _ics_fold(line):
+    # Content lines are folded at 75 characters, continuations starting with a space
+    return '\r\n '.join(line[start:start + 74] for start in range(0, len(line), 74)) or line
+
+@login_required
+def timetable_feed(request):
+    """
+    The user's calendar as an iCalendar file of dated sessions for the next
+    ``?weeks=`` weeks (4 by default), holidays left out.
+    """
+    grid = _calendar_grid(request.user) or build_grid([])
+    try:
+        weeks = min(max(int(request.GET.get('weeks', 4)), 1), FEED_MAX_WEEKS)
+    except ValueError:
+        weeks = 4
+    now = timezone.now()
+    until = timezone.localdate() + datetime.timedelta(weeks=weeks)
+    stamp = now.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//School Management//Timetable//EN', 'CALSCALE:GREGORIAN']
+    for session in occurrences(grid, now):
+        if session['date'] >= until:
+            break
+        lines += [
+            'BEGIN:VEVENT',
+            f"UID:timetable-{session['id']}-{session['date']:%Y%m%d}@{request.get_host()}",
+            f'DTSTAMP:{stamp}',
+            f"DTSTART:{session['starts_at'].astimezone(datetime.timezone.utc):%Y%m%dT%H%M%SZ}",
+            f"DTEND:{session['ends_at'].astimezone(datetime.timezone.utc):%Y%m%dT%H%M%SZ}",
+            f"SUMMARY:{_ics_text(session['subject'])}",
+            f"DESCRIPTION:{_ics_text(session['student_class'] + ' ' + session['section'] + ' - ' + session['teacher_name'])}",
+        ]
+        if session['classroom']:
+            lines.append(f"LOCATION:{_ics_text(session['classroom'])}")
+        lines.append('END:VEVENT')
+    lines.append('END:VCALENDAR')
+    response = HttpResponse('\r\n'.join(map(_ics_fold, lines)) + '\r\n', content_type='text/calendar; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="timetable.ics"'
+    return response
+
 class TimetableCreateView(LoginRequiredMixin, CreateView):
     model = Timetable
     form_class = TimetableForm
@@ -669,20 +705,7 @@ class TimetableCreateView(LoginRequiredMixin, CreateView):
             if self.request.user.is_teacher:
                 form.instance.teacher = self.request.user
             
-            # Ensure class and section are properly saved
-            student_class = form.cleaned_data['student_class']
-            section = form.cleaned_data['section']
-            
-            # Check for existing entries to prevent duplicates
-            if Timetable.objects.filter(
-                day=form.cleaned_data['day'],
-                start_time=form.cleaned_data['start_time'],
-                student_class=student_class,
-                section=section
-            ).exists():
-                messages.error(self.request, 'A timetable entry already exists for this time slot')
-                return self.form_invalid(form)
-            
+            # Overlapping class, teacher and room bookings are rejected in TimetableForm.clean
             # Save the instance
             self.object = form.save()
             
@@ -699,11 +722,93 @@ class TimetableUpdateView(LoginRequiredMixin, UpdateView):
     template_name = 'timetable_form.html'
     success_url = reverse_lazy('time_table')
     
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['request'] = self.request
+        return kwargs
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['title'] = 'Edit Timetable Entry'
         return context
 
+def _conflict_json(conflict):
+    other = conflict.other
+    return {
+        'entry': conflict.slot.ref,
+        'kind': conflict.kind,
+        'message': conflict.message(),
+        'with': {'id': other.pk} if other.pk is not None else {'entry': other.ref},
+    }
+
+@login_required
+def validate_timetable_week(request):
+    """
+    Check a whole proposed week in one call. The body is JSON:
+    ``{"student_class": ..., "section": ..., "entries": [{"day", "start_time",
+    "end_time", "teacher_id", "classroom", "subject"}, ...]}``. With a class
+    and section the week replaces that class's saved one; entries may also
+    name their own class and section.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST a proposed week'}, status=405)
+    if not (request.user.is_admin or request.user.is_teacher):
+        return HttpResponseForbidden()
+    try:
+        week = json.loads(request.body)
+        entries = week['entries']
+        if not isinstance(entries, list):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'expected a JSON object with an "entries" list'}, status=400)
+
+    defaults = {name: week[name] for name in ('student_class', 'section') if week.get(name)}
+    slots, errors = [], []
+    for position, entry in enumerate(entries):
+        try:
+            slots.append(parse_slot(entry, ref=position, **defaults))
+        except (ValueError, AttributeError) as error:
+            errors.append({'entry': position, 'error': str(error)})
+
+    replacing = None
+    if len(defaults) == 2:
+        replacing = Timetable.objects.filter(**defaults)
+    conflicts = validate_slots(slots, replacing=replacing)
+    return JsonResponse({
+        'valid': not errors and not conflicts,
+        'errors': errors,
+        'conflicts': [_conflict_json(conflict) for conflict in conflicts],
+    })
+
+@login_required
+def timetable_availability(request):
+    """
+    Teachers and rooms free for a whole window, e.g. to find a substitute:
+    ``?day=Tuesday&start=10:00&end=10:45``, optionally ``&department=<id>``
+    and ``&ignore=<entry id>`` to leave the entry being edited out.
+    """
+    if not (request.user.is_admin or request.user.is_teacher):
+        return HttpResponseForbidden()
+    day = request.GET.get('day')
+    try:
+        start_time = datetime.time.fromisoformat(request.GET.get('start', ''))
+        end_time = datetime.time.fromisoformat(request.GET.get('end', ''))
+        department = int(request.GET['department']) if request.GET.get('department') else None
+        ignore = int(request.GET['ignore']) if request.GET.get('ignore') else None
+    except ValueError:
+        return JsonResponse({'error': 'start and end must be times such as 10:00; department and ignore ids'}, status=400)
+    if day not in dict(Timetable.CLASS_DAYS) or end_time <= start_time:
+        return JsonResponse({'error': 'expected a class day and an end after the start'}, status=400)
+
+    teachers = free_teachers(day, start_time, end_time, department=department, ignore=ignore)
+    return JsonResponse({
+        'teachers': [
+            {'id': teacher.pk, 'name': teacher.get_full_name() or teacher.username, 'email': teacher.email}
+            for teacher in teachers.only('pk', 'first_name', 'last_name', 'username', 'email')
+        ],
+        'rooms': free_rooms(day, start_time, end_time, ignore=ignore),
+    })
+
 class TimetableDeleteView(LoginRequiredMixin, DeleteView):
     model = Timetable
     template_name = 'timetable_confirm_delete.html'
@@ -729,60 +834,83 @@ class ExamDeleteView(LoginRequiredMixin, DeleteView):
 
 @login_required
 def inbox(request):
-    # Get filter parameter from request
     message_filter = request.GET.get('filter', 'all')
-    
-    # Get messages based on filter and user role
-    if request.user.is_admin:
-        # Admin can see all messages
-        if message_filter == 'inbox':
-            messages = Message.objects.filter(recipients=request.user, parent__isnull=True)
-        elif message_filter == 'sent':
-            messages = Message.objects.filter(sender=request.user, parent__isnull=True)
-        else:  # 'all'
-            messages = Message.objects.filter(
-                Q(recipients=request.user) | Q(sender=request.user),
-                parent__isnull=True
-            ).distinct()
-    else:
-        # Regular users see normal filtered messages
-        if message_filter == 'inbox':
-            messages = request.user.received_messages.filter(parent__isnull=True)
-        elif message_filter == 'sent':
-            messages = request.user.sent_messages.filter(parent__isnull=True)
-        else:  # 'all'
-            messages = (request.user.received_messages.filter(parent__isnull=True) | 
-                       request.user.sent_messages.filter(parent__isnull=True)).distinct()
-    
-    # Order by most recent and paginate
-    messages = messages.order_by('-sent_at')
-    paginator = Paginator(messages, 10)
-    page_number = request.GET.get('page')
-    messages = paginator.get_page(page_number)
+    if message_filter not in MAILBOX_FOLDERS:
+        message_filter = 'all'
+
+    paginator = Paginator(mailbox_entries(request.user, message_filter), MAILBOX_PAGE_SIZE)
+    entries = paginator.get_page(request.GET.get('page'))
     
     return render(request, 'inbox/inbox.html', {
-        'messages': messages,
+        'messages': entries,
         'current_filter': message_filter,
-        'unread_count': request.user.received_messages.filter(is_read=False).count()
+        'unread_count': get_unread_message_count(request.user)
+    })
+
+@login_required
+def archive_message(request, message_id):
+    if request.method == 'POST':
+        set_archived(request.user, message_id, archived=request.POST.get('archived', '1') == '1')
+    return redirect('inbox')
+
+@login_required
+def download_attachment(request, attachment_id):
+    attachment = get_object_or_404(
+        MessageAttachment.objects.select_related('blob', 'message'),
+        id=attachment_id,
+        blob__isnull=False
+    )
+    if not can_download(request.user, attachment):
+        return HttpResponseForbidden()
+    return attachment_response(request, attachment, as_attachment='download' in request.GET)
+
+@login_required
+def message_search(request):
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    hits, has_next = search_messages(request.user, query, page)
+    return JsonResponse({
+        'query': query,
+        'page': page,
+        'has_next': has_next,
+        'results': [{
+            'id': hit.id,
+            'subject': hit.subject,
+            'sender': hit.sender.get_full_name(),
+            'sent_at': hit.sent_at.isoformat(),
+            'snippet': hit.snippet,
+            'url': reverse('message_detail', args=[hit.thread_root_id or hit.id]),
+        } for hit in hits]
     })
 
+
+class UserAutocompleteView(LoginRequiredMixin, AutoResponseView):
+    """
+    Results for the user picker widgets, one page at a time. The widget's own
+    queryset and search fields apply; ``?role=`` narrows them further.
+    """
+    ROLES = {'teacher': 'is_teacher', 'student': 'is_student', 'admin': 'is_admin'}
+
+    def get_queryset(self):
+        users = super().get_queryset()
+        role = self.request.GET.get('role')
+        if role in self.ROLES:
+            users = users.filter(**{self.ROLES[role]: True})
+        return users.order_by('first_name', 'last_name', 'pk')
+
 @login_required
 def message_detail(request, message_id):
     message = get_object_or_404(
-        Message.objects.select_related('sender'),
+        Message.objects.filter(is_draft=False).select_related('sender').distinct(),
         Q(id=message_id),
-        Q(recipients=request.user) | Q(sender=request.user)
+        Q(recipients=request.user) | Q(sender=request.user) |
+        Q(thread_root__mailbox_entries__user=request.user)
     )
     
-    # Mark as read if recipient
-    if request.user in message.recipients.all() and not message.is_read:
-        message.is_read = True
-        message.save()
-    
-    # Get complete thread
-    thread_messages = Message.objects.filter(
-        Q(id=message_id) | Q(parent=message_id)
-    ).order_by('sent_at').select_related('sender').prefetch_related('recipients')
+    mark_thread_read(request.user, message)
     
     if request.method == 'POST':
         form_data = request.POST.copy()
@@ -803,24 +931,26 @@ def message_detail(request, message_id):
             reply.recipients.set(recipients)
             
             # Handle attachments
-            files = request.FILES.getlist('attachments')
-            for f in files:
-                MessageAttachment.objects.create(message=reply, file=f)
+            attach_files(reply, request.FILES.getlist('attachments'))
+            deliver(reply)
             
             # Create toast notification
             messages.success(request, 'Reply sent successfully!')
             
+            # Bursts of replies fold into one notification per recipient and
+            # thread, whichever message of the thread they answer
+            root = thread_root(message)
+            notify_coalesced(
+                [recipient.pk for recipient in recipients if recipient != request.user],
+                title=f"New message: {root.subject}",
+                message=f"New message from {request.user.get_full_name()}",
+                summary=f"{{count}} new messages in {root.subject}",
+                notification_type='message',
+                related_url=reverse('message_detail', args=[root.id])
+            )
+            
             for recipient in recipients:
                 if recipient != request.user:
-                    # Create notification with proper URL
-                    notification = Notification.objects.create(
-                        user=recipient,
-                        title=f"New message: {message.subject}",
-                        message=f"New message from {request.user.get_full_name()}",
-                        notification_type='message',
-                        related_url=reverse('message_detail', args=[message.id])
-                    )
-                    
                     # For students, ensure they can access the message
                     if recipient.is_student:
                         # Make sure student has permission to view the message
@@ -836,6 +966,10 @@ def message_detail(request, message_id):
         }
         form = MessageForm(initial=initial)
     
+    # Latest window of the complete thread, earlier ones via ?page=; built
+    # after the POST so a reply just sent is part of it
+    thread_messages = thread_page(message, request.GET.get('page'))
+    
     return render(request, 'inbox/message_detail.html', {
         'message': message,
         'thread_messages': thread_messages,
@@ -848,27 +982,41 @@ def compose_message(request, reply_to=None):
     parent = None
     if reply_to:
         parent = get_object_or_404(Message, id=reply_to)
+    # Replies go to the people in the conversation, never to a whole audience
+    can_broadcast = parent is None and (
+        request.user.is_admin or request.user.has_perm('school.broadcast_message')
+    )
     
     if request.method == 'POST':
-        form = MessageForm(request.POST, request.FILES)
+        # Attachments uploaded in chunks were collected on a draft
+        draft_id = request.POST.get('draft', '')
+        draft = Message.objects.filter(
+            pk=draft_id, sender=request.user, is_draft=True
+        ).first() if draft_id.isdigit() else None
+        form = MessageForm(request.POST, request.FILES, instance=draft, can_broadcast=can_broadcast)
         if form.is_valid():
             message = form.save(commit=False)
             message.sender = request.user  # Set sender from request.user
+            message.is_draft = False
+            message.sent_at = timezone.now()
             message.save()
             
-            # Add recipients from the form
-            recipients = form.cleaned_data['recipients']
-            message.recipients.set(recipients)
+            # A broadcast stores its audience instead of one recipient row per user
+            broadcast = form.broadcast(message)
+            if broadcast:
+                broadcast.save()
+            else:
+                message.recipients.set(form.cleaned_data['recipients'])
             
             # Handle multiple file attachments
-            files = request.FILES.getlist('attachments')
-            for f in files:
-                MessageAttachment.objects.create(
-                    message=message,
-                    file=f
-                )
+            attach_files(message, request.FILES.getlist('attachments'))
+            deliver(message)
             
-            messages.success(request, 'Message sent successfully!')
+            if broadcast:
+                # Mailboxes are filled in batches by `manage.py deliver_broadcasts`
+                messages.success(request, 'Broadcast queued; it will reach its audience shortly.')
+            else:
+                messages.success(request, 'Message sent successfully!')
             return redirect('inbox')
     else:
         initial = {}
@@ -878,11 +1026,65 @@ def compose_message(request, reply_to=None):
                 'parent': parent.id,
                 'recipients': [parent.sender.id]
             }
-        form = MessageForm(initial=initial)
+        form = MessageForm(initial=initial, can_broadcast=can_broadcast)
     
     return render(request, 'inbox/compose.html', {
         'form': form,
-        'parent': parent
+        'parent': parent,
+        'draft_id': request.POST.get('draft', ''),
+        'upload_chunk_size': settings.ATTACHMENT_UPLOAD_CHUNK_SIZE
+    })
+
+
+@login_required
+def start_attachment_upload(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    draft = None
+    if request.POST.get('draft', '').isdigit():
+        draft = get_object_or_404(Message, pk=request.POST['draft'], sender=request.user, is_draft=True)
+    try:
+        upload = start_upload(
+            request.user,
+            filename=request.POST.get('filename', ''),
+            size=int(request.POST.get('size', 0)),
+            sha256=request.POST.get('sha256', '').lower(),
+            draft=draft
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+        'upload_id': str(upload.pk),
+        'draft_id': upload.message_id,
+        'offset': 0,
+        'chunk_size': settings.ATTACHMENT_UPLOAD_CHUNK_SIZE
+    }, status=201)
+
+@login_required
+def attachment_upload(request, upload_id):
+    # GET reports the resume offset; POST appends the chunk in the body at the
+    # Upload-Offset header, checked against its Upload-Checksum (SHA-256 hex)
+    upload = get_object_or_404(
+        AttachmentUpload.objects.select_related('message'), pk=upload_id, user=request.user
+    )
+    if request.method == 'POST':
+        try:
+            write_chunk(
+                upload,
+                offset=int(request.headers.get('Upload-Offset', -1)),
+                data=request.body,
+                checksum=request.headers.get('Upload-Checksum', '')
+            )
+        except UploadOffsetMismatch as e:
+            return JsonResponse({'error': str(e), 'offset': e.offset}, status=409)
+        except ValueError as e:
+            return JsonResponse({'error': str(e), 'offset': upload.received}, status=400)
+    return JsonResponse({
+        'upload_id': str(upload.pk),
+        'offset': upload.received,
+        'size': upload.size,
+        'complete': upload.attachment_id is not None,
+        'attachment_id': upload.attachment_id
     })
 
 
@@ -891,8 +1093,20 @@ def admin_message_list(request):
     if not request.user.is_admin:
         return HttpResponseForbidden()
     
-    messages = Message.objects.all().order_by('-sent_at')
-    return render(request, 'admin/message_list.html', {'messages': messages})
+    form = AdminMessageFilterForm(request.GET or None)
+    filters = form.cleaned_data if form.is_valid() else {}
+    paginator = Paginator(admin_messages(**filters), ADMIN_PAGE_SIZE)
+    page = paginator.get_page(request.GET.get('page'))
+    # Only the page's recipients are read, a few names per message
+    page.object_list = attach_recipient_preview(page.object_list)
+    
+    query = request.GET.copy()
+    query.pop('page', None)
+    return render(request, 'admin/message_list.html', {
+        'messages': page,
+        'form': form,
+        'query': query.urlencode()
+    })
 
 @login_required
 def delete_message(request, message_id):
@@ -928,10 +1142,7 @@ class DepartmentListView(LoginRequiredMixin, ListView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['unread_notification_count'] = Notification.objects.filter(
-            user = self.request.user,
-            is_read = False
-        ).count()
+        context['unread_notification_count'] = get_unread_count(self.request.user)
         return context
     
 class DepartmentCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
@@ -1061,10 +1272,7 @@ class SubjectListView(LoginRequiredMixin, ListView):
             except Student.DoesNotExist:
                 pass
                 
-        context['unread_notification_count'] = Notification.objects.filter(
-            user=user, 
-            is_read=False
-        ).count()
+        context['unread_notification_count'] = get_unread_count(user)
         return context
 
 
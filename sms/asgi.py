@@ -3,6 +3,10 @@ ASGI config for sms project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serving through this entry point (e.g. ``uvicorn sms.asgi:application``)
+enables the live notification stream at ``notifications/stream/``; under
+WSGI the browser falls back to polling.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -98,6 +98,18 @@ DATABASES = {
     }
 }
 
+# Shared by every worker process: select2 widget registrations, timetable
+# grids and availability maps are written by one request and read by the
+# next, wherever it lands. `migrate` creates the table (school migration
+# 0023). A hit is one primary-key lookup instead of rebuilding a grid; point
+# this at Redis or Memcached to take even that off the database.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'school_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -197,6 +209,64 @@ FILE_UPLOAD_PERMISSIONS = 0o644
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Exam announcements and broadcast messages are queued by the request and
+# delivered by `manage.py send_exam_notifications` and `manage.py
+# deliver_broadcasts`, in resumable batches (NOTIFICATION_FANOUT_BATCH_SIZE
+# students per exam batch); run both every minute from cron or a process
+# supervisor (they exit when nothing is pending).
+NOTIFICATION_FANOUT_BATCH_SIZE = 500
+
+# Live notification stream (served when running under ASGI, see sms/asgi.py).
+# The broker is pluggable; the default only delivers within one process.
+NOTIFICATION_BROKER = 'school.events.LocalBroker'
+NOTIFICATION_STREAM_KEEPALIVE = 25  # seconds
+
+# Repeated unread notifications with the same user, type and link within this
+# window are folded into one row (e.g. "5 new messages in <thread>")
+NOTIFICATION_COALESCE_WINDOW = 3600  # seconds
+
+# Notification retention, applied by `manage.py prune_notifications`.
+# Read notifications are pruned after READ_DAYS, all notifications after
+# ALL_DAYS (None disables a rule). Pruned rows are moved to the monthly
+# archive when NOTIFICATION_ARCHIVE is on; archive months older than
+# NOTIFICATION_ARCHIVE_MONTHS are dropped.
+NOTIFICATION_RETENTION_READ_DAYS = 90
+NOTIFICATION_RETENTION_ALL_DAYS = 365
+NOTIFICATION_ARCHIVE = True
+NOTIFICATION_ARCHIVE_MONTHS = 24
+NOTIFICATION_PRUNE_BATCH_SIZE = 500
+
+# Message attachments are served through an access-checked view. Behind nginx
+# set ATTACHMENT_SENDFILE_HEADER = 'X-Accel-Redirect' and map
+# ATTACHMENT_SENDFILE_PREFIX to MEDIA_ROOT in an `internal` location; behind
+# Apache/lighttpd use 'X-Sendfile' (the prefix is then ignored and the file's
+# absolute path is sent). With None, Django streams the file itself.
+ATTACHMENT_SENDFILE_HEADER = None
+ATTACHMENT_SENDFILE_PREFIX = '/protected-media/'
+
+# Resumable attachment uploads: clients send chunks of at most CHUNK_SIZE
+# bytes, which are assembled in UPLOAD_DIR (outside MEDIA_ROOT). Uploads left
+# unfinished for EXPIRY_HOURS are removed by `manage.py collect_attachment_blobs`.
+ATTACHMENT_UPLOAD_DIR = os.path.join(BASE_DIR, 'upload_parts')
+ATTACHMENT_UPLOAD_CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_UPLOAD_MAX_SIZE = 100 * 1024 * 1024
+ATTACHMENT_UPLOAD_EXPIRY_HOURS = 24
+
+# User pickers search over AJAX (school.forms.UserSelect2Mixin). A widget is
+# registered in this cache when its form renders and looked up again by the
+# autocomplete endpoint, possibly in another worker, so it must be shared
+# (see CACHES above).
+SELECT2_CACHE_BACKEND = 'default'
+
+# Timetable grids (school.timetables) are cached per class/section and per
+# teacher, and availability maps (school.availability) per day; both are
+# invalidated whenever an entry or subject is saved, by bumping a version in
+# the default cache. That only reaches every worker when the cache is shared
+# (see CACHES above); a per-process cache fails the school.E001 system check
+# outside DEBUG. The timeout only bounds staleness from other edits, e.g. a
+# teacher being renamed.
+TIMETABLE_GRID_CACHE_TIMEOUT = 24 * 60 * 60
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
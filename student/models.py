@@ -49,6 +49,11 @@ class Student(models.Model):
         related_name='student_profile' 
     )
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['student_class', 'section'], name='student_class_section_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         # Delete old image when updating
         if self.pk:
@@ -5,6 +5,7 @@ from django.http import HttpResponseForbidden
 from .models import *
 from school.utils import create_notification
 from school.models import Notification
+from school.notifications import get_unread_count, unread_notifications_for
 from django.contrib.auth.decorators import login_required
 
 
@@ -62,14 +63,16 @@ def student_list(request):
     
     # Handle notifications for both students and teachers
     try:
-        unread_notifications = Notification.objects.filter(user=request.user, is_read=False)
+        unread_notifications = unread_notifications_for(request.user)
+        unread_notification_count = get_unread_count(request.user)
     except:
         unread_notifications = []
+        unread_notification_count = 0
     
     context = {
         'student_list': student_list,
         'unread_notifications': unread_notifications,
-        'unread_notification_count': unread_notifications.count(),
+        'unread_notification_count': unread_notification_count,
         'default_avatar': 'img/profiles/avatar-02.jpg'
     }
     return render(request, "students/students.html", context)
@@ -123,10 +126,7 @@ def edit_profile(request):
     # Prepare context
     context = {
         'user': request.user,
-        'unread_notification_count': Notification.objects.filter(
-            user=request.user, 
-            is_read=False
-        ).count()
+        'unread_notification_count': get_unread_count(request.user)
     }
     
     # Only add student-specific context if user is a student
@@ -196,10 +196,7 @@ def edit_student_profile(request):
         'class_options': CLASS_CHOICES,
         'section_options': SECTION_CHOICES,
         'blood_groups': BLOOD_GROUPS,
-        'unread_notification_count': Notification.objects.filter(
-            user=request.user, 
-            is_read=False
-        ).count()
+        'unread_notification_count': get_unread_count(request.user)
     }
     return render(request, "students/edit_profile.html", context)
 
@@ -262,10 +259,7 @@ def edit_student(request, slug):
 def view_profile(request):
     context = {
         'user': request.user,
-        'unread_notification_count': Notification.objects.filter(
-            user=request.user, 
-            is_read=False
-        ).count()
+        'unread_notification_count': get_unread_count(request.user)
     }
     
     if request.user.is_student: